@@ -52,14 +52,49 @@ __version__ = "0.0.8"
 import argparse
 import json
 import logging
+import os
 import sys
 import time
 import pdb
+from concurrent.futures import Future, ThreadPoolExecutor
 
 from gridappsd import GridAPPSD, DifferenceBuilder, utils, GOSS, topics
 from gridappsd.topics import simulation_input_topic, simulation_output_topic, simulation_log_topic, simulation_output_topic
 
+from recorder import MeasurementRecorder
+from violations import VoltageViolationEngine
+from lifecycle import SimulationLifecycle, DEFAULT_DRAIN_TIMEOUT, DEFAULT_IDLE_TIMEOUT
+from dispatch import LagAwareDispatcher, LagMonitor, StartupBuffer, DEFAULT_LAG_THRESHOLD, DEFAULT_MAX_PENDING, \
+    DEFAULT_STARTUP_FRAMES
+from command_tracker import CommandTracker, DEFAULT_MAX_TIMESTEPS
+from request_pool import RequestChannelPool, DEFAULT_POOL_SIZE
+from resilient import ResilientRequester, DEFAULT_RETRIES, DEFAULT_DEADLINE, DEFAULT_HEDGE_PERCENTILE
+from rules import RuleEngine, load_rules
+from pipeline import Pipeline
+from profiler import TimestepProfiler, profiler_control_topic, DEFAULT_TIMESTEPS
+from stages import (measurement_groups, SWITCH_POS, REG_POS, SwitchStatusStage, RegulatorTapStage, VoltageBandStage,
+	BusAggregationStage, AnomalyStage, NeighbourhoodStage, ControlStage, SchedulerStage, OperatorConsoleStage,
+	CommandQueueStage, SnapshotStage, AnalyticsStage, PartialResultStage, OutputStage)
+from publisher import AnalyticsPublisher, analytics_output_topic, DEFAULT_MAX_RATE
+from streamstats import DEFAULT_Z_THRESHOLD
+from batch import BatchReplay, DryRunConnection, load_model, recording_chunks, save_model, timeseries_messages, \
+    message_chunks
+from recorder import RecordingReader
+from partition import (ShardLock, PartialResultMerger, PartialResultSender, partial_results_topic, select_shard,
+	SHARD_KEYS, MERGER)
+from topology import TopologyIndex, DEFAULT_MAX_HOPS
+from journal import CommandJournal, DEFAULT_FSYNC_INTERVAL
+from snapshot import SnapshotStore, DEFAULT_HISTORY
+from query_server import QueryServer, CommandQueue
+from chunking import ChunkedSender, DEFAULT_MAX_BYTES, DEFAULT_MAX_DIFFERENCES, DEFAULT_PACE
+from scheduler import Scheduler, load_schedule
+
 DEFAULT_MESSAGE_PERIOD = 5
+DEFAULT_STEP_THRESHOLD = 0.05
+DEFAULT_HOPS = 2
+# the interactive operator console has nobody to talk to in a replay
+REPLAY_STAGES = ['switch_status', 'regulator_tap', 'voltage_bands', 'bus_aggregation', 'anomalies', 'neighbourhood',
+                 'control', 'schedule', 'snapshot', 'analytics', 'partial', 'output']
 
 # logging.basicConfig(stream=sys.stdout, level=logging.DEBUG,
 #                     format="%(asctime)s - %(name)s;%(levelname)s|%(message)s",
@@ -81,7 +116,11 @@ class NodalVoltage(object):
 	message to the simulation_input_topic with the forward and reverse difference specified.
 	"""
 
-	def __init__(self, simulation_id, gridappsd_obj, ACline, obj_msr_loadsw, obj_msr_reg, switches, regulators):
+	def __init__(self, simulation_id, gridappsd_obj, ACline, obj_msr_loadsw, obj_msr_reg, switches, regulators,
+			base_voltages=None, tracker=None, rules=None, stages=None, stage_workers=0,
+			publisher=None, shard=None, partial_sink=None, anomaly_z=DEFAULT_Z_THRESHOLD,
+			anomaly_step=DEFAULT_STEP_THRESHOLD, topology=None, hops=DEFAULT_HOPS,
+			journal=None, snapshot_history=DEFAULT_HISTORY, commands=None, sender=None, schedule=None):
 		""" Create a ``CapacitorToggler`` object
 
 		This object should be used as a subscription callback from a ``GridAPPSD``
@@ -104,8 +143,61 @@ class NodalVoltage(object):
 		    isn't required.
 		capacitor_list: list(str)
 		    A list of capacitors mrids to turn on/off
+		base_voltages: dict
+		    Nominal voltage keyed by bus name, enables the per-unit violation report.
+		tracker: CommandTracker
+		    Optional tracker of the latency between a command and its effect.
+		rules: list(dict)
+		    Control rule definitions, needs ``base_voltages`` as rules work in per-unit.
+		stages: list(str)
+		    Names of the pipeline stages to run, all of them when None.
+		stage_workers: int
+		    Threads running independent pipeline stages concurrently, opt-in
+		    as it is only faster with several heavy stages per wave.
+		publisher: AnalyticsPublisher
+		    Publishes the results of every timestep when given.
+		shard: int
+		    Shard of the feeder this instance analyses when the work is split
+		    across several instances.
+		partial_sink: object
+		    Receives the results of the shard, a ``PartialResultMerger`` or
+		    ``PartialResultSender``.
+		anomaly_z: float
+		    z-score of a per-unit PNV above which it is reported as an outlier.
+		anomaly_step: float
+		    Per-unit change of a PNV between two timesteps reported as a step.
+		topology: TopologyIndex
+		    Bus connectivity of the feeder, enables the report of the out of
+		    band buses near every switch and regulator and the rules selecting
+		    buses by device.
+		hops: int
+		    How far from a switch or regulator a bus counts as near it.
+		journal: CommandJournal
+		    Keeps an audit trail of every difference message sent.
+		snapshot_history: int
+		    Timesteps kept in ``snapshots``, the results other threads may read.
+		commands: CommandQueue
+		    Operator commands sent with the next timestep, replaces the
+		    interactive console when given.
+		sender: ChunkedSender
+		    Sends the difference messages in bounded chunks, one with the
+		    default bounds writing to ``journal`` when None.
+		schedule: list(dict)
+		    Commands sent at given simulation times or periodically, more
+		    can be added to ``scheduler`` later.
 		"""
 		self._gapps = gridappsd_obj
+		self._tracker = tracker
+		self._violations = None
+		self._rules = None
+		if base_voltages:
+			self._violations = VoltageViolationEngine(ACline, base_voltages)
+			if rules:
+				self._rules = RuleEngine(rules, self._violations, switches, regulators,
+					get_regulator_pos_measids(obj_msr_reg, regulators),
+					get_switch_pos_measids(obj_msr_loadsw, switches), topology)
+		elif rules:
+			_log.warning("Control rules need base voltages and are disabled")
 
 		# the five variables below are different than the ones presented on original file
 		# have been created by Shiva to see AC lines and switch
@@ -115,8 +207,6 @@ class NodalVoltage(object):
 		self._obj_msr_reg = obj_msr_reg
 		self._flag = 0
 		self._start_time = 0
-		self.check = True
-		self.inp = False
 		self._switches = switches
 		self._regulators = regulators
 
@@ -125,11 +215,93 @@ class NodalVoltage(object):
 		self._open_diff = DifferenceBuilder(simulation_id)
 		self._close_diff = DifferenceBuilder(simulation_id)
 		self._tap_close_diff = DifferenceBuilder(simulation_id)
+		self._rule_diff = DifferenceBuilder(simulation_id)
+		self._schedule_diff = DifferenceBuilder(simulation_id)
 		
 		self._publish_to_topic = simulation_input_topic(simulation_id)
+		if sender is None:
+			sender = ChunkedSender(gridappsd_obj, self._publish_to_topic, journal=journal)
+		self._sender = sender
 		_log.info("Building capacitor list")
+
+		# every timestep goes through these stages, a stage is skipped when its inputs did not change
+		pipeline_stages = [SwitchStatusStage(obj_msr_loadsw), RegulatorTapStage(obj_msr_reg)]
+		if self._violations is not None:
+			pipeline_stages.append(VoltageBandStage(self._violations))
+			pipeline_stages.append(BusAggregationStage(self._violations, ACline))
+			pipeline_stages.append(AnomalyStage(self._violations, anomaly_z, anomaly_step))
+			if topology is not None:
+				pipeline_stages.append(NeighbourhoodStage(topology, self._violations, hops))
+		if self._rules is not None:
+			pipeline_stages.append(ControlStage(self._rules, self._rule_diff, self._send))
+		# actions keyed on the simulation timestamp, registered now or by other code later
+		self.scheduler = Scheduler()
+		if schedule:
+			devices = {d['name']: d['mrid'] for d in switches + regulators}
+			self.scheduler.schedule_commands(schedule, devices)
+		pipeline_stages.append(SchedulerStage(self.scheduler, self._schedule_diff, self._send))
+		if commands is not None:
+			pipeline_stages.append(CommandQueueStage(commands, obj_msr_reg, regulators, self._open_diff, self._send))
+		else:
+			pipeline_stages.append(OperatorConsoleStage(ACline, switches, regulators, self._open_diff,
+				self._tap_close_diff, self._send))
+		# other threads only ever read the results through these snapshots
+		self.snapshots = SnapshotStore(snapshot_history)
+		pipeline_stages.append(SnapshotStage(self.snapshots, self._violations))
+		if publisher is not None:
+			pipeline_stages.append(AnalyticsStage(publisher))
+		if partial_sink is not None:
+			pipeline_stages.append(PartialResultStage(shard, partial_sink))
+		pipeline_stages.append(OutputStage())
+		groups = measurement_groups(ACline, obj_msr_loadsw, obj_msr_reg)
+		self._pipeline = Pipeline(groups, pipeline_stages, enabled=stages, workers=stage_workers)
+		_log.info("Pipeline waves: {}".format(self._pipeline.waves))
+		# the Pos measurements are all that commands are checked against
+		slots = self._pipeline.decoder.slots
+		self._pos_slots = [(measid, slots[measid]) for measid in groups[SWITCH_POS] + groups[REG_POS]]
+
+	@property
+	def measids(self):
+		""" Measids of the arrays ``on_decoded`` takes, in slot order """
+		return self._pipeline.decoder.measids
+
+	@property
+	def stages(self):
+		""" Names of the pipeline stages run on every timestep, in order """
+		return self._pipeline.stages
+
+	def close(self, timeout=None):
+		return self._pipeline.close(timeout)
+
+	def _send(self, diff):
+		""" Publish the differences collected in ``diff`` and start over with an empty builder """
+		msg = diff.get_message()
+		print(msg)
+		self._sender.send(msg)
+		if self._tracker is not None:
+			self._tracker.track_message(msg)
+		diff.clear()
         
 
+	def on_decoded(self, timestamp, values, present):
+		""" Handle a timestep already decoded into arrays in the order of ``measids``, as replayed in batch mode
+
+		Parameters
+		----------
+		timestamp: int
+		    Simulation timestamp of the timestep.
+		values: numpy.ndarray
+		    Structured array with the ``magnitude``, ``angle`` and ``value`` of every measid.
+		present: numpy.ndarray
+		    Mask of the measids present in the timestep.
+		"""
+		value = values['value']
+		meas_value = {measid: {'measurement_mrid': measid, 'value': value[slot]}
+			for measid, slot in self._pos_slots if present[slot]}
+		if self._tracker is not None:
+			self._tracker.observe(timestamp, meas_value)
+		self._pipeline.run_decoded(timestamp, values, present, meas_value)
+
 	def on_message(self, headers, message):
 		# this section is modified by shiva
 		""" Handle incoming messages on the simulation_output_topic for the simulation_id
@@ -148,168 +320,15 @@ class NodalVoltage(object):
 		if type(message) == str:
 			message = json.loads(message)
 
-		# Some demo for understanding object and measurement mrids.
-		# Print the status of several switches
 		timestamp = message["message"] ["timestamp"]
 		meas_value = message['message']['measurements']
 		
+		# confirm the commands sent on earlier timesteps
+		if self._tracker is not None:
+			self._tracker.observe(timestamp, meas_value)
 		
+		self._pipeline.run(timestamp, meas_value)
 		
-		print(self._obj_msr_reg)
-		print(sh)
-		
-		# *************************** Regulator ********************************
-		
-		# get the operating position of regulator
-		reg_position = [d for d in self._obj_msr_reg if d['type'] == 'Pos']
-		#print ("\n ******* reg_position ********* \n ")
-		#print(reg_position) 
-		#print(sh)         
-
-		# Store the regulator positions
-		regulators_tap= []
-		for iter_reg_pos in reg_position:                
-			if iter_reg_pos['measid'] in meas_value:
-				v = iter_reg_pos['measid']
-				p = meas_value[v]
-				regulators_tap.append(p)
-		            
-		print('\n.................   regulator tap   ...............\n')
-		#print('The total regulators', len(set(regulators_tap)))
-		#print(timestamp, set(regulators_tap))
-		#print(regulators_tap)		
-		# print (sh)
-		
-		# changing the tap position of the regulator
-		reg_mrid = [x for x in regulators_tap if x['value'] == 0]
-		print (reg_mrid)
-		#print(sh)
-		
-		print ("################ self regulators #####################")
-		print(self._regulators)
-		
-		
-		
-		measid = [d for d in self._regulators if d['name']=='creg2a']
-		print ("############# measid ###############")
-		print (measid[0]['mrid'])
-		print ('############# measidtype ###############')
-		print (type(measid[0]))
-		
-		self._tap_close_diff.add_difference(measid[0]['mrid'], "TapChanger.step", 5, 0) 
-		# send the message to platform
-		msg = self._tap_close_diff.get_message()
-		print(msg)
-		self._gapps.send(self._publish_to_topic, json.dumps(msg))
-		#print(sh)
-		
-		
-		
-		
-		# *************************** SWITCHES ********************************
-		# Find interested mrids. We are only interested in Pos of the switches
-		switch_position = [d for d in self._obj_msr_loadsw if d['type'] == 'Pos']
-		#print ("\n ******* switch_position ********* \n ")
-		#print(switch_position)          
-
-		# Store the open switches
-		Loadbreak = []
-		for iter_sw_pos in switch_position:                
-			if iter_sw_pos['measid'] in meas_value:
-				v = iter_sw_pos['measid']
-				p = meas_value[v]
-				if p['value'] == 0:
-					Loadbreak.append(iter_sw_pos['eqname'])
-		            
-		print('.....................................................')
-		print('The total number of open switches:', len(set(Loadbreak)))
-		print(timestamp, set(Loadbreak))
-		
-		
-		
-		
-		print ("For now we can only allow you to view Phase-to-Neutral Voltage related information")
-		phase_checking = ['A', 'B', 'C']
-		while (self.check):
-			
-			while not (self.inp):
-				phase_val = input("Which phase are you interested in (A/B/C)? ")
-				self.inp = True if phase_val in phase_checking else print('Unidentified phase')
-			print ("Selecting Phase as ** {} ** -- ...".format(phase_val))
-			time.sleep(3)       	
-			
-			# PNV
-			# Find interested mrids. We are only interested in PNV of specific phase
-			phase_check = [d for d in self._ACline if d['phases'] == phase_val]
-			# print ("\n ******* phase check ********* \n ")
-			# print (phase_check)
-			# print(sh)   
-
-			# get the ranges
-			min_volt = float (input("Minimum value of voltage at phase {}? ".format(phase_val)))
-			max_volt = float (input("Maximum value of voltage at phase {}? ".format(phase_val)))
-
-			phase_PNV = []
-			for d1 in phase_check:                
-				if d1['measid'] in meas_value:
-					v = d1['measid']
-					p = meas_value[v]
-					# print ('\n p \n', p) 
-					# print(sh)
-					if p['magnitude'] > min_volt and p['magnitude'] < max_volt :
-				    		phase_PNV.append(d1['bus'])
-
-			print('.....................................................')
-			print('The total number of nodes with PNV > {} and PNV < {} = {} '.format(min_volt, max_volt, len(set(phase_PNV))))
-			print("timestamp: {} and the set of buses are: {}".format(timestamp, set(phase_PNV)))
-			recheck = input("Do you want another option (Y/N)? ")
-			if recheck == 'N':
-				self.check = False
-								
-			self.inp = False 	
-				
-		# print(sh) 
-		self.check = True
-		print ('---------------------------------------')
-		print ("Now let's try working on the switches")
-		print ('---------------------------------------')
-		
-		switch_val = input("Are you interesting in toggling the switches (Y/N)? ")
-		# print("\n ************** check ********************* \n")
-		# print(self._switches[0]['mrid'])
-		#print(sh)
-		
-		if (switch_val == 'Y'):
-			sel_sw = int (input("select the switch to toggle (0-7)"))
-			
-			# Open one of the switches
-			if self._flag == 0:
-			    # swmrid = '_BC63E102-37AD-4269-BB19-8351403B9B60'
-			    # self._open_diff.add_difference(swmrid, "Switch.open", 1, 0) # (1,0) -> (current_state, next_state)
-			    # msg = self._open_diff.get_message()
-			    # print(msg)
-			    # send the message to platform
-			    # self._gapps.send(self._publish_to_topic, json.dumps(msg))
-
-			    #swmrid = '_7262F9C3-2E8B-4069-AA13-BF4A655ACE35'
-			    #self._open_diff.add_difference(swmrid, "Switch.open", 0, 1)
-			    #msg = self._open_diff.get_message()
-			    #print(msg)
-			    #self._gapps.send(self._publish_to_topic, json.dumps(msg))  
-			    #self._flag = 1
-			    
-			    swmrid = self._switches[sel_sw]['mrid']
-			    self._open_diff.add_difference(swmrid, "Switch.open", 1, 0) 
-			    # (1,0) -> (current_state, next_state)
-			    msg = self._open_diff.get_message()
-			    print(msg)
-			    # send the message to platform
-			    self._gapps.send(self._publish_to_topic, json.dumps(msg))
-		# print(sh)
-		
-		
-		
-	
 		# Time series data
 		# if self._flag == 0:
 		#     timestamp = message["message"] ["timestamp"]
@@ -334,6 +353,19 @@ class NodalVoltage(object):
 		 
 		# python runsample.py 858290661 '{"power_system_config":  {"Line_name":"_C1C3E687-6FFD-C753-582B-632A27E28507"}}'
 
+def _submit(gapps, method, *args, **kwargs):
+	""" Start a ``get_response``/``query_data`` request and return a ``Future`` of its result
+
+	Requests only run concurrently on a ``RequestChannelPool``, a plain
+	``GridAPPSD`` connection answers them one after the other.
+	"""
+	if hasattr(gapps, 'submit'):
+		return gapps.submit(method, *args, **kwargs)
+	future = Future()
+	future.set_result(getattr(gapps, method)(*args, **kwargs))
+	return future
+
+
 def get_meas_mrid(gapps, model_mrid, topic):
 
 	# for AC line segment
@@ -343,11 +375,8 @@ def get_meas_mrid(gapps, model_mrid, topic):
 		"requestType": "QUERY_OBJECT_MEASUREMENTS",
 		"resultFormat": "JSON",
 		"objectType": "ACLineSegment"}
-	obj_msr_ACline = gapps.get_response(topic, message, timeout=180)
-	obj_msr_ACline = obj_msr_ACline['data']
-
-	# get the measurement MRID if the type is PNV = Phase to neutral voltage
-	obj_msr_ACline = [measid for measid in obj_msr_ACline if measid['type'] == 'PNV']
+	# a request pool runs all the requests below concurrently, results are collected at the end
+	ACline_request = _submit(gapps, 'get_response', topic, message, timeout=180)
 
 	# this is for load break switch
 	# Note: the objectType is pre-defined (case-sensitive as well))
@@ -356,10 +385,7 @@ def get_meas_mrid(gapps, model_mrid, topic):
 		"requestType": "QUERY_OBJECT_MEASUREMENTS",
 		"resultFormat": "JSON",
 		"objectType": "LoadBreakSwitch"}     
-	obj_msr_loadsw = gapps.get_response(topic, message, timeout=180)
-
-	# get all of the data here
-	obj_msr_loadsw = obj_msr_loadsw['data']
+	loadsw_request = _submit(gapps, 'get_response', topic, message, timeout=180)
 
 	query = """
 	PREFIX r:  <http://www.w3.org/1999/02/22-rdf-syntax-ns#>
@@ -390,14 +416,14 @@ def get_meas_mrid(gapps, model_mrid, topic):
 	GROUP BY ?cimtype ?name ?bus1 ?bus2 ?id
 	ORDER BY ?cimtype ?name
 		""" % model_mrid
-	sw_results = gapps.query_data(query, timeout=60)
+	sw_request = _submit(gapps, 'query_data', query, timeout=60)
 	
 	
 	# voltage regulators - DistRegulator
 	query = """
 	PREFIX r:  <http://www.w3.org/1999/02/22-rdf-syntax-ns#>
 	PREFIX c:  <http://iec.ch/TC57/CIM100#>
-	SELECT ?rname ?pname ?tname ?wnum ?phs ?incr ?mode ?enabled ?highStep ?lowStep ?neutralStep ?normalStep ?neutralU 
+	SELECT ?rname ?id ?pname ?pxfid ?tname ?wnum ?phs ?incr ?mode ?enabled ?highStep ?lowStep ?neutralStep ?normalStep ?neutralU 
 	 ?step ?initDelay ?subDelay ?ltc ?vlim 
 		?vset ?vbw ?ldc ?fwdR ?fwdX ?revR ?revX ?discrete ?ctl_enabled ?ctlmode ?monphs ?ctRating ?ctRatio ?ptRatio ?fdrid
 	WHERE {
@@ -406,6 +432,7 @@ def get_meas_mrid(gapps, model_mrid, topic):
 	 ?fdr c:IdentifiedObject.mRID ?fdrid.
 	 ?rtc r:type c:RatioTapChanger.
 	 ?rtc c:IdentifiedObject.name ?rname.
+	 ?rtc c:IdentifiedObject.mRID ?id.
 	 ?rtc c:RatioTapChanger.TransformerEnd ?end.
 	 ?end c:TransformerEnd.endNumber ?wnum.
 	{?end c:PowerTransformerEnd.PowerTransformer ?pxf.}
@@ -416,6 +443,7 @@ def get_meas_mrid(gapps, model_mrid, topic):
 	  bind(strafter(str(?phsraw),"PhaseCode.") as ?phs)}
 	 ?tank c:TransformerTank.PowerTransformer ?pxf.}
 	 ?pxf c:IdentifiedObject.name ?pname.
+	 ?pxf c:IdentifiedObject.mRID ?pxfid.
 	 ?rtc c:RatioTapChanger.stepVoltageIncrement ?incr.
 	 ?rtc c:RatioTapChanger.tculControlMode ?moderaw.
 	  bind(strafter(str(?moderaw),"TransformerControlMode.") as ?mode)
@@ -452,7 +480,7 @@ def get_meas_mrid(gapps, model_mrid, topic):
 	}
 	ORDER BY ?pname ?tname ?rname ?wnum ?bus
 	""" % model_mrid
-	reg_results = gapps.query_data(query, timeout=60)
+	reg_request = _submit(gapps, 'query_data', query, timeout=60)
 	
 	
 	# Get measurement MRIDS for regulators in the feeder
@@ -462,9 +490,18 @@ def get_meas_mrid(gapps, model_mrid, topic):
 		"requestType": "QUERY_OBJECT_MEASUREMENTS",
 		"resultFormat": "JSON",
 		"objectType": "PowerTransformer"}     
-	obj_msr_reg = gapps.get_response(topic, message, timeout=180)
-        # get all of the data here
-	obj_msr_reg = obj_msr_reg['data']
+	reg_msr_request = _submit(gapps, 'get_response', topic, message, timeout=180)
+
+	obj_msr_ACline = ACline_request.result()['data']
+
+	# get the measurement MRID if the type is PNV = Phase to neutral voltage
+	obj_msr_ACline = [measid for measid in obj_msr_ACline if measid['type'] == 'PNV']
+
+	# get all of the data here
+	obj_msr_loadsw = loadsw_request.result()['data']
+	obj_msr_reg = reg_msr_request.result()['data']
+	sw_results = sw_request.result()
+	reg_results = reg_request.result()
         
 	# print ("*********** regulator measurement message *************")
 	# print(obj_msr_reg)
@@ -504,13 +541,18 @@ def get_meas_mrid(gapps, model_mrid, topic):
 	regulators = []
 	for p in reg_data:
 		#print(p)
-		reg_obj_id = p['fdrid']['value']
+		reg_obj_id = p['id']['value']
 		status = p['step']['value']
 		incr_value = p['incr']['value']
+		# the tap position is measured on the power transformer, per phase for tank regulators
 		message = dict(name = p['rname']['value'],
 				mrid = reg_obj_id,
 				op_con = status,
-				increment = incr_value)
+				increment = incr_value,
+				low_step = int(p['lowStep']['value']),
+				high_step = int(p['highStep']['value']),
+				eqid = p['pxfid']['value'],
+				phases = p['phs']['value'] if 'phs' in p else None)
 		regulators.append(message)
 	
 	# print("\n **************** Swtiches data ********************** \n")
@@ -530,6 +572,112 @@ def get_meas_mrid(gapps, model_mrid, topic):
 	return obj_msr_ACline, obj_msr_loadsw, obj_msr_reg, switches, regulators
 
 
+def get_base_voltages(gapps, model_mrid):
+	""" Nominal line-to-line voltage of every bus in the feeder keyed by upper case bus name
+
+	The base voltage is taken from the ``BaseVoltage.nominalVoltage`` of the
+	conducting equipment connected to the bus, the same attribute the capacitor
+	query uses.  It only needs to be fetched once per model.
+	"""
+	query = """
+	PREFIX r:  <http://www.w3.org/1999/02/22-rdf-syntax-ns#>
+	PREFIX c:  <http://iec.ch/TC57/CIM100#>
+	SELECT ?bus (MAX(?basev) AS ?nomv) WHERE {
+	VALUES ?fdrid {"%s"}
+	?fdr c:IdentifiedObject.mRID ?fdrid.
+	?s c:Equipment.EquipmentContainer ?fdr.
+	?s c:ConductingEquipment.BaseVoltage ?bv.
+	?bv c:BaseVoltage.nominalVoltage ?basev.
+	?t c:Terminal.ConductingEquipment ?s.
+	?t c:Terminal.ConnectivityNode ?cn.
+	?cn c:IdentifiedObject.name ?bus
+	}
+	GROUP BY ?bus
+	ORDER BY ?bus
+	""" % model_mrid
+	results = gapps.query_data(query, timeout=60)
+	base_voltages = {}
+	for p in results['data']['results']['bindings']:
+		base_voltages[p['bus']['value'].upper()] = float(p['nomv']['value'])
+	return base_voltages
+
+
+def get_line_terminals(gapps, model_mrid):
+	""" The two buses of every ACLineSegment of the feeder
+
+	Returns a list of dicts with the ``name`` and ``mrid`` of the line and
+	its upper case ``bus1`` and ``bus2``.
+	"""
+	query = """
+	PREFIX r:  <http://www.w3.org/1999/02/22-rdf-syntax-ns#>
+	PREFIX c:  <http://iec.ch/TC57/CIM100#>
+	SELECT ?name ?id ?bus1 ?bus2 WHERE {
+	VALUES ?fdrid {"%s"}
+	?fdr c:IdentifiedObject.mRID ?fdrid.
+	?s r:type c:ACLineSegment.
+	?s c:Equipment.EquipmentContainer ?fdr.
+	?s c:IdentifiedObject.name ?name.
+	?s c:IdentifiedObject.mRID ?id.
+	?t1 c:Terminal.ConductingEquipment ?s.
+	?t1 c:ACDCTerminal.sequenceNumber "1".
+	?t1 c:Terminal.ConnectivityNode ?cn1.
+	?cn1 c:IdentifiedObject.name ?bus1.
+	?t2 c:Terminal.ConductingEquipment ?s.
+	?t2 c:ACDCTerminal.sequenceNumber "2".
+	?t2 c:Terminal.ConnectivityNode ?cn2.
+	?cn2 c:IdentifiedObject.name ?bus2
+	}
+	ORDER BY ?name
+	""" % model_mrid
+	results = gapps.query_data(query, timeout=60)
+	lines = []
+	for p in results['data']['results']['bindings']:
+		lines.append(dict(name = p['name']['value'],
+				mrid = p['id']['value'],
+				bus1 = p['bus1']['value'].upper(),
+				bus2 = p['bus2']['value'].upper()))
+	return lines
+
+
+def get_topology(lines, switches, regulators, obj_msr_reg, max_hops=DEFAULT_MAX_HOPS):
+	""" ``TopologyIndex`` of the feeder with the neighbourhoods of its switches and regulators
+
+	Transformers are not edges of the graph, a regulator sits on the bus(es)
+	its tap position is measured at.
+	"""
+	edges = [(line['bus1'], line['bus2']) for line in lines]
+	edges += [tuple(sw['sw_con']) for sw in switches]
+	devices = {}
+	for sw in switches:
+		devices['switch:' + sw['name']] = sw['sw_con']
+	for reg in regulators:
+		buses = sorted({d['bus'].upper() for d in obj_msr_reg if d['type'] == 'Pos' and d['eqid'] == reg['eqid']})
+		if buses:
+			devices['regulator:' + reg['name']] = buses
+	return TopologyIndex(edges, devices, max_hops=max_hops)
+
+
+def get_switch_pos_measids(obj_msr_loadsw, switches):
+	""" Map every switch mrid to the Pos measids of its phases """
+	aliases = {}
+	for sw in switches:
+		measids = [d['measid'] for d in obj_msr_loadsw if d['type'] == 'Pos' and d['eqid'] == sw['mrid']]
+		if measids:
+			aliases[sw['mrid']] = measids
+	return aliases
+
+
+def get_regulator_pos_measids(obj_msr_reg, regulators):
+	""" Map every tap changer mrid to the Pos measids of its transformer phase(s) """
+	aliases = {}
+	for reg in regulators:
+		measids = [d['measid'] for d in obj_msr_reg if d['type'] == 'Pos' and d['eqid'] == reg['eqid']
+			and (not reg['phases'] or d['phases'] in reg['phases'])]
+		if measids:
+			aliases[reg['mrid']] = measids
+	return aliases
+
+
 def _main():
     _log.debug("Starting application")
     print("Application starting!!!-------------------------------------------------------")
@@ -544,16 +692,134 @@ def _main():
     parser.add_argument("--message_period",
                         help="How often the sample app will send open/close capacitor message.",
                         default=DEFAULT_MESSAGE_PERIOD)
+    parser.add_argument("--record_dir",
+                        help="Record PNV, switch and regulator measurements of every timestep to this directory.")
+    parser.add_argument("--record_compress", action="store_true",
+                        help="Write compressed recording segments (not memory mappable).")
+    parser.add_argument("--lag_threshold", default=DEFAULT_LAG_THRESHOLD,
+                        help="Seconds behind the simulation after which stale timesteps are skipped (0 disables).")
+    parser.add_argument("--confirm_timesteps", default=DEFAULT_MAX_TIMESTEPS,
+                        help="Timesteps to wait for a command to show in the Pos measurements.")
+    parser.add_argument("--request_channels", default=DEFAULT_POOL_SIZE,
+                        help="Connections dedicated to model and timeseries requests, one request in flight on each.")
+    parser.add_argument("--request_retries", default=DEFAULT_RETRIES,
+                        help="Retries of a failed model or timeseries request.")
+    parser.add_argument("--request_deadline", default=DEFAULT_DEADLINE,
+                        help="Seconds a request may take including all of its retries.")
+    parser.add_argument("--hedge_percentile", default=DEFAULT_HEDGE_PERCENTILE,
+                        help="Latency percentile after which a duplicate request is sent (0 disables).")
+    parser.add_argument("--rules",
+                        help="JSON or YAML file of control rules evaluated every timestep.")
+    parser.add_argument("--schedule",
+                        help="JSON or YAML file of commands sent at given simulation times or periodically.")
+    parser.add_argument("--stages",
+                        help="Comma separated pipeline stages to run (switch_status, regulator_tap, voltage_bands, "
+                             "bus_aggregation, anomalies, neighbourhood, control, schedule, operator or commands, "
+                             "snapshot, analytics, partial, output), all of them by default.")
+    parser.add_argument("--stage_workers", default=0,
+                        help="Threads running independent pipeline stages concurrently (0, the default, runs them "
+                             "in order). Only faster with several heavy stages per wave, compare the stage timings.")
+    parser.add_argument("--profile_dir",
+                        help="Enable on-demand profiling (SIGUSR1 or the control topic), captures go to this directory.")
+    parser.add_argument("--profile_timesteps", default=DEFAULT_TIMESTEPS,
+                        help="Timesteps profiled per capture.")
+    parser.add_argument("--publish_analytics", action="store_true",
+                        help="Publish the results of every timestep on the analytics topic.")
+    parser.add_argument("--analytics_topic",
+                        help="Topic of the analytics results, a per-simulation topic by default.")
+    parser.add_argument("--analytics_rate", default=DEFAULT_MAX_RATE,
+                        help="Analytics messages per second at most (0 publishes every timestep).")
+    parser.add_argument("--analytics_compress", action="store_true",
+                        help="Compress the analytics messages.")
+    parser.add_argument("--anomaly_z", default=DEFAULT_Z_THRESHOLD,
+                        help="z-score of a per-unit PNV above which it is reported as an outlier.")
+    parser.add_argument("--anomaly_step", default=DEFAULT_STEP_THRESHOLD,
+                        help="Per-unit PNV change between two timesteps reported as a step.")
+    parser.add_argument("--hops", default=DEFAULT_HOPS,
+                        help="Buses this many lines or switches away from a switch or regulator count as near it.")
+    parser.add_argument("--shards", default=1,
+                        help="Number of app instances splitting the PNV analysis of the feeder.")
+    parser.add_argument("--shard_index",
+                        help="Shard of this instance, claimed through lock files in --shard_lock_dir if not given.")
+    parser.add_argument("--shard_lock_dir",
+                        help="Directory shared by every instance (a volume mounted in all of their containers) to "
+                             "claim shards. Either this or --shard_index is required with --shards.")
+    parser.add_argument("--shard_key", default='bus', choices=SHARD_KEYS,
+                        help="How the PNV measurements are split between the instances.")
+    parser.add_argument("--replay",
+                        help="Replay a --record_dir recording of the simulation as fast as possible and exit, "
+                             "with the model saved in the recording and no platform connection.")
+    parser.add_argument("--replay_timeseries",
+                        help="Replay the START:END simulation seconds of the simulation from the timeseries store.")
+    parser.add_argument("--journal_dir",
+                        help="Keep an append-only journal of every difference message sent in this directory.")
+    parser.add_argument("--journal_fsync", default=DEFAULT_FSYNC_INTERVAL,
+                        help="Seconds between two syncs of the command journal to disk.")
+    parser.add_argument("--chunk_bytes", default=DEFAULT_MAX_BYTES,
+                        help="Serialized size above which a difference message is split into chunks.")
+    parser.add_argument("--chunk_differences", default=DEFAULT_MAX_DIFFERENCES,
+                        help="Differences a chunk of a difference message holds at most.")
+    parser.add_argument("--chunk_pace", default=DEFAULT_PACE,
+                        help="Seconds between two chunks of difference messages (0 sends them right away).")
+    parser.add_argument("--query_port",
+                        help="Serve queries and operator commands over HTTP on this local port instead of "
+                             "prompting on stdin (0 picks a free port).")
+    parser.add_argument("--query_socket",
+                        help="Serve queries and operator commands on this Unix socket instead of prompting on stdin.")
+    parser.add_argument("--startup_frames", default=DEFAULT_STARTUP_FRAMES,
+                        help="Output messages held while the model is discovered, older ones are folded together.")
+    parser.add_argument("--startup_collapse", action="store_true",
+                        help="Process the output held at startup as a single timestep instead of one by one.")
+    parser.add_argument("--drain_timeout", default=DEFAULT_DRAIN_TIMEOUT,
+                        help="Seconds allowed for flushing buffers once the simulation is over.")
+    parser.add_argument("--idle_timeout", default=DEFAULT_IDLE_TIMEOUT,
+                        help="Seconds without any message of a running simulation after which it is considered "
+                             "over (0 waits for its final status forever).")
     opts = parser.parse_args()
+    if int(opts.shards) > 1:
+        if opts.rules:
+            parser.error("--rules need the PNV of the whole feeder and cannot be combined with --shards")
+        # every container has its own /tmp, a default lock directory would let each instance claim shard 0
+        if opts.shard_index is None and not opts.shard_lock_dir:
+            parser.error("--shards needs --shard_index or a --shard_lock_dir shared by the instances")
+        if opts.shard_index is not None and not 0 <= int(opts.shard_index) < int(opts.shards):
+            parser.error("--shard_index must be between 0 and {}".format(int(opts.shards) - 1))
+        if opts.replay:
+            parser.error("--replay runs without the platform the shards exchange their results over")
     listening_to_topic = simulation_output_topic(opts.simulation_id)
     message_period = int(opts.message_period)
     sim_request = json.loads(opts.request.replace("\'",""))
     model_mrid = sim_request["power_system_config"]["Line_name"]
     _log.debug("Model mrid is: {}".format(model_mrid))
 
-    # Interaction with the web-based GridAPPSD interface
-    gapps = GridAPPSD(opts.simulation_id, address=utils.get_gridappsd_address(),
-                      username=utils.get_gridappsd_user(), password=utils.get_gridappsd_pass())
+    def connect():
+        return GridAPPSD(opts.simulation_id, address=utils.get_gridappsd_address(),
+                         username=utils.get_gridappsd_user(), password=utils.get_gridappsd_pass())
+
+    # a replayed simulation is over, commands are kept instead of sent and never show in the measurements
+    replaying = bool(opts.replay or opts.replay_timeseries)
+
+    if opts.replay:
+        # a recording holds the model it was recorded with, replaying it needs no platform at all
+        gapps = DryRunConnection()
+        requests = None
+    else:
+        # Interaction with the web-based GridAPPSD interface, this connection carries the subscriptions
+        gapps = connect()
+
+        # model and timeseries requests go over their own connections, retried and hedged when slow
+        pool = RequestChannelPool(connect, size=int(opts.request_channels))
+        requests = ResilientRequester(pool, retries=int(opts.request_retries),
+                                      deadline=float(opts.request_deadline),
+                                      hedge_percentile=float(opts.hedge_percentile))
+
+    # subscribe right away, the output of the simulation waits here while the model is discovered and
+    # a status reported meanwhile, even the final one, is not missed
+    lifecycle = SimulationLifecycle(opts.simulation_id, idle_timeout=float(opts.idle_timeout))
+    startup = StartupBuffer(int(opts.startup_frames), collapse=opts.startup_collapse, taps=[lifecycle.seen])
+    if not replaying:
+        gapps.subscribe(simulation_log_topic(opts.simulation_id), lifecycle)
+        gapps.subscribe(listening_to_topic, startup)
 
     # the three lines (uncommented) below are from Shiva
 
@@ -567,8 +833,40 @@ def _main():
     '''
     topic = "goss.gridappsd.process.request.data.powergridmodel"
 
-    # returns the MRID for AC lines and switch
-    ACline, obj_msr_loadsw, obj_msr_reg, switches, regulators = get_meas_mrid(gapps, model_mrid, topic)
+    if opts.replay:
+        model = load_model(opts.replay)
+    else:
+        # the three parts of the discovery do not depend on each other
+        with ThreadPoolExecutor(max_workers=3) as discovery:
+            # returns the MRID for AC lines and switch
+            meas_mrid = discovery.submit(get_meas_mrid, requests, model_mrid, topic)
+            # nominal voltages are needed once to report PNV in per-unit
+            base_voltages = discovery.submit(get_base_voltages, requests, model_mrid)
+            lines = discovery.submit(get_line_terminals, requests, model_mrid)
+            model = dict(zip(('ACline', 'obj_msr_loadsw', 'obj_msr_reg', 'switches', 'regulators'),
+                             meas_mrid.result()))
+            model.update(base_voltages=base_voltages.result(), lines=lines.result())
+    ACline, obj_msr_loadsw, obj_msr_reg, switches, regulators = (
+        model[key] for key in ('ACline', 'obj_msr_loadsw', 'obj_msr_reg', 'switches', 'regulators'))
+    base_voltages, lines = model['base_voltages'], model['lines']
+
+    # bus connectivity, to tell which switches and regulators are close to the out of band buses
+    hops = int(opts.hops)
+    topology = get_topology(lines, switches, regulators, obj_msr_reg, max_hops=max(hops, DEFAULT_MAX_HOPS))
+    _log.info("Topology of {} buses, {} switches and regulators".format(len(topology), len(topology.devices)))
+
+    # when the work is split, this instance only analyses its shard of the PNV measurements
+    shard_count = int(opts.shards)
+    shard = None
+    shard_lock = None
+    if shard_count > 1:
+        if opts.shard_index is not None:
+            shard = int(opts.shard_index)
+        else:
+            shard_lock = ShardLock(opts.shard_lock_dir, shard_count)
+            shard = shard_lock.index
+        ACline = select_shard(ACline, opts.shard_key, shard, shard_count)
+        _log.info("Shard {} of {} with {} PNV measurements".format(shard, shard_count, len(ACline)))
     
     # print("\n ************ ACLine ********* \n")
     # print(ACline)
@@ -577,13 +875,139 @@ def _main():
     # print(obj_msr_loadsw)
     # print(sh)
     
-    # toggling the switch ON and OFF
-    toggler = NodalVoltage(opts.simulation_id, gapps, ACline, obj_msr_loadsw, obj_msr_reg, switches, regulators)
+    recorder = None
+    if opts.record_dir and not opts.replay:
+        # the whole feeder, before the sharding below, so the recording can be replayed offline
+        save_model(opts.record_dir, model)
+        record_measids = [d['measid'] for d in ACline]
+        record_measids += [d['measid'] for d in obj_msr_loadsw + obj_msr_reg if d['type'] == 'Pos']
+        recorder = MeasurementRecorder(opts.record_dir, record_measids, compress=opts.record_compress)
+
+    app_conn = DryRunConnection() if replaying else gapps
+
+    # watch the Pos measurements for the effect of every command we send
+    tracker = None
+    if not replaying:
+        pos_measurements = [d for d in obj_msr_loadsw + obj_msr_reg if d['type'] == 'Pos']
+        tracker = CommandTracker(pos_measurements, aliases=get_regulator_pos_measids(obj_msr_reg, regulators),
+                                 max_timesteps=int(opts.confirm_timesteps))
+
+    journal = None
+    if opts.journal_dir and not replaying:
+        journal = CommandJournal(opts.journal_dir, fsync_interval=float(opts.journal_fsync))
+
+    sender = ChunkedSender(app_conn, simulation_input_topic(opts.simulation_id), max_bytes=int(opts.chunk_bytes),
+                           max_differences=int(opts.chunk_differences), pace=float(opts.chunk_pace), journal=journal)
+
+    publisher = None
+    if opts.publish_analytics:
+        publisher = AnalyticsPublisher(gapps, opts.analytics_topic or analytics_output_topic(opts.simulation_id),
+                                       max_rate=float(opts.analytics_rate), compress=opts.analytics_compress)
+
+    stages = opts.stages.split(',') if opts.stages else None
+    if replaying and stages is None:
+        stages = REPLAY_STAGES
+    partial_sink = None
+    merger = None
+    if shard_count > 1:
+        if shard == MERGER:
+            def on_merged(timestamp, merged, missing):
+                print("Merged results of timestep {} ({} shards missing): {}".format(timestamp, len(missing), merged))
+                if publisher is not None:
+                    publisher.publish(timestamp, merged)
+            merger = PartialResultMerger(shard_count, on_merged)
+            gapps.subscribe(partial_results_topic(opts.simulation_id), merger)
+            partial_sink = merger
+        else:
+            # the other instances only analyse their shard, commands and output stay with the merger
+            partial_sink = PartialResultSender(gapps, partial_results_topic(opts.simulation_id))
+            stages = ['voltage_bands', 'bus_aggregation', 'anomalies', 'neighbourhood', 'partial']
+
+    # operators talk to the query server, the simulation never waits for them
+    serving = not replaying and (opts.query_port is not None or opts.query_socket is not None)
+    commands = CommandQueue(switches, regulators) if serving else None
 
-    # gapps.subscribe calls the on_message function
-    gapps.subscribe(listening_to_topic, toggler)
-    while True:
-        time.sleep(0.1)
+    # toggling the switch ON and OFF
+    toggler = NodalVoltage(opts.simulation_id, app_conn, ACline, obj_msr_loadsw, obj_msr_reg, switches, regulators,
+                           base_voltages=base_voltages, tracker=tracker,
+                           rules=load_rules(opts.rules) if opts.rules else None,
+                           stages=stages,
+                           stage_workers=int(opts.stage_workers),
+                           publisher=publisher if partial_sink is None else None,
+                           shard=shard, partial_sink=partial_sink,
+                           anomaly_z=float(opts.anomaly_z), anomaly_step=float(opts.anomaly_step),
+                           topology=topology, hops=hops, commands=commands, sender=sender,
+                           schedule=load_schedule(opts.schedule) if opts.schedule else None)
+
+    if replaying:
+        if opts.replay:
+            chunks = recording_chunks(RecordingReader(opts.replay), toggler.measids)
+        else:
+            start, end = (int(t) for t in opts.replay_timeseries.split(':'))
+            chunks = message_chunks(timeseries_messages(requests, opts.simulation_id, start, end), toggler.measids)
+        replay = BatchReplay(toggler).run(chunks)
+        print("Replayed {} timesteps in {:.1f}s ({:.0f}x real time), {} command messages not sent".format(
+            replay.timesteps, replay.elapsed, replay.speedup, len(app_conn.sent)))
+        for close in (toggler.close, sender.close, publisher.close if publisher is not None else None,
+                      recorder.close if recorder is not None else None,
+                      requests.close if requests is not None else None):
+            if close is not None:
+                close(float(opts.drain_timeout))
+        if not opts.replay:
+            gapps.disconnect()
+        return
+
+    server = None
+    if serving:
+        server = QueryServer(toggler.snapshots, commands, port=opts.query_port, path=opts.query_socket,
+                             topology=topology)
+        print("Query server listening on {}".format(server.address))
+
+    # profiling stays idle until asked for by SIGUSR1 or a message on the control topic
+    handler = toggler
+    profiler = None
+    if opts.profile_dir:
+        profiler = TimestepProfiler(toggler, opts.profile_dir, default_timesteps=int(opts.profile_timesteps))
+        profiler.install_signal_handler()
+        gapps.subscribe(profiler_control_topic(opts.simulation_id), profiler.on_control)
+        handler = profiler
+
+    # every timestep is recorded, but analysis skips stale ones when it falls behind; the queue takes
+    # the whole startup buffer at once so none of the timesteps received during discovery is dropped
+    taps = [recorder.record] if recorder is not None else []
+    dispatcher = LagAwareDispatcher(handler, LagMonitor(float(opts.lag_threshold)), taps=taps,
+                                    max_pending=max(DEFAULT_MAX_PENDING, startup.max_frames))
+
+    # stop with the simulation or on a signal
+    lifecycle.install_signal_handlers()
+    if server is not None:
+        lifecycle.register("query server", server.close)
+    lifecycle.register("output dispatcher", dispatcher.close)
+    lifecycle.register("pipeline", toggler.close)
+    if merger is not None:
+        lifecycle.register("partial result merger", merger.close)
+    if publisher is not None:
+        lifecycle.register("analytics publisher", publisher.close)
+    if shard_lock is not None:
+        lifecycle.register("shard lock", shard_lock.close)
+    if profiler is not None:
+        lifecycle.register("profiler", profiler.close)
+    if recorder is not None:
+        lifecycle.register("measurement recorder", recorder.close)
+    lifecycle.register("command tracker", tracker.close)
+    lifecycle.register("difference sender", sender.close)
+    if journal is not None:
+        lifecycle.register("command journal", journal.close)
+    lifecycle.register("request pool", requests.close)
+
+    # the output received during discovery goes first, then every message as it arrives
+    startup.attach(dispatcher)
+    print("Processing started with {} timesteps received during discovery ({} folded)".format(
+        startup.buffered, startup.folded))
+    lifecycle.wait()
+    print("Simulation {}, draining buffers before exit".format(lifecycle.reason))
+    lifecycle.drain(float(opts.drain_timeout))
+    gapps.disconnect()
 
 if __name__ == "__main__":
     _main()
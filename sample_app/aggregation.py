@@ -0,0 +1,112 @@
+"""
+Per-bus aggregation of the three phases of the PNV measurements.
+
+``BusAggregator`` sorts the PNV measurement slots by bus once, so the
+per-bus minimum, maximum and mean of a timestep are one ``reduceat`` each
+over the precomputed group offsets.  For buses that have all of phases A, B
+and C it also computes the voltage unbalance factor, the ratio of the
+negative to the positive sequence voltage::
+
+    V1 = (Va + a Vb + a^2 Vc) / 3
+    V2 = (Va + a^2 Vb + a Vc) / 3
+    VUF = |V2| / |V1|           a = 1 /_ 120 deg
+
+from the magnitude and angle (in degrees) of the phase voltages.
+"""
+
+import numpy as np
+
+# Unbalance above which a bus is reported, the 3% recommended by ANSI C84.1 Annex D
+VUF_LIMIT = 0.03
+
+_A = np.exp(2j * np.pi / 3)
+
+
+class BusAggregates(object):
+    """ Per-bus values of one timestep, arrays aligned with ``buses`` """
+
+    def __init__(self, buses, minimum, maximum, mean, vuf):
+        self.buses = buses
+        self.min = minimum
+        self.max = maximum
+        self.mean = mean
+        self.vuf = vuf
+
+    def unbalanced(self, limit=VUF_LIMIT):
+        """ Buses whose voltage unbalance factor exceeds ``limit`` """
+        with np.errstate(invalid='ignore'):
+            return self.buses[self.vuf > limit].tolist()
+
+    def __repr__(self):
+        return "BusAggregates(buses={}, max_vuf={})".format(
+            len(self.buses), np.nanmax(self.vuf) if np.isfinite(self.vuf).any() else None)
+
+
+class BusAggregator(object):
+    """ Reduce per-phase PNV arrays to per-bus values """
+
+    def __init__(self, buses, phases):
+        """ Create a ``BusAggregator``
+
+        Parameters
+        ----------
+        buses: sequence(str)
+            Bus of every PNV slot, in measurement order.
+        phases: sequence(str)
+            Phase of every PNV slot, in measurement order.
+        """
+        buses = np.asarray(buses)
+        phases = np.asarray(phases)
+        self._order = np.argsort(buses, kind='stable')
+        sorted_buses = buses[self._order]
+        starts = np.flatnonzero(np.r_[True, sorted_buses[1:] != sorted_buses[:-1]]) if len(buses) else \
+            np.zeros(0, dtype=np.intp)
+        self.buses = sorted_buses[starts]
+        self._offsets = starts
+
+        # first slot of each of phases A, B and C on the buses that have all three
+        group = np.repeat(np.arange(len(starts)), np.diff(np.r_[starts, len(buses)]))
+        first = {}
+        for phase in ('A', 'B', 'C'):
+            slot = np.full(len(starts), -1, dtype=np.intp)
+            ordered = np.flatnonzero(phases[self._order] == phase)
+            groups, index = np.unique(group[ordered], return_index=True)
+            slot[groups] = self._order[ordered[index]]
+            first[phase] = slot
+        self._three_phase = np.flatnonzero((first['A'] >= 0) & (first['B'] >= 0) & (first['C'] >= 0))
+        self._phase_slots = np.stack([first[p][self._three_phase] for p in ('A', 'B', 'C')])
+
+    def __len__(self):
+        return len(self.buses)
+
+    def reduce(self, values):
+        """ Per-bus ``(min, max, mean)`` of ``values`` in measurement order, NaN ignored """
+        if not len(self.buses):
+            empty = np.zeros(0)
+            return empty, empty, empty
+        ordered = values[self._order]
+        valid = ~np.isnan(ordered)
+        minimum = np.fmin.reduceat(ordered, self._offsets)
+        maximum = np.fmax.reduceat(ordered, self._offsets)
+        total = np.add.reduceat(np.where(valid, ordered, 0.0), self._offsets)
+        count = np.add.reduceat(valid, self._offsets)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = total / count
+        return minimum, maximum, mean
+
+    def unbalance(self, magnitude, angle):
+        """ Voltage unbalance factor of every bus, NaN unless it has phases A, B and C """
+        vuf = np.full(len(self.buses), np.nan)
+        if len(self._three_phase):
+            phasors = magnitude[self._phase_slots] * np.exp(1j * np.deg2rad(angle[self._phase_slots]))
+            va, vb, vc = phasors
+            positive = np.abs(va + _A * vb + _A * _A * vc)
+            negative = np.abs(va + _A * _A * vb + _A * vc)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                vuf[self._three_phase] = negative / positive
+        return vuf
+
+    def aggregate(self, values, magnitude, angle):
+        """ ``BusAggregates`` of ``values`` (e.g. per-unit) and of the phasors ``magnitude``/``angle`` """
+        minimum, maximum, mean = self.reduce(values)
+        return BusAggregates(self.buses, minimum, maximum, mean, self.unbalance(magnitude, angle))
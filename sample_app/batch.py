@@ -0,0 +1,167 @@
+"""
+Faster than real time replay of recorded simulations.
+
+A finished simulation is read back in chunks of timesteps, either from a
+``MeasurementRecorder`` directory or from the platform timeseries store,
+and decoded for a whole chunk at once into arrays in the slot order of the
+app's ``Pipeline``.  Every row is then handed to ``NodalVoltage.on_decoded``
+so the stages produce exactly the per-timestep results of live mode, without
+waiting for the simulation clock and without building the measurements
+dictionary of each message.
+
+Commands the control stages emit during a replay go to a ``DryRunConnection``
+instead of the platform.  A recording directory also keeps the model the app
+discovered when it was recorded (``save_model``), so replaying it needs no
+platform at all.
+"""
+
+import json
+import logging
+import os
+import time
+
+import numpy as np
+
+from decoder import DTYPE, FIELDS, MeasurementDecoder
+
+_log = logging.getLogger(__name__)
+
+TIMESERIES_TOPIC = 'goss.gridappsd.process.request.data.timeseries'
+DEFAULT_WINDOW = 300
+DEFAULT_CHUNK_ROWS = 256
+MODEL_FILE = 'model.json'
+
+
+class DryRunConnection(object):
+    """ Stands in for ``GridAPPSD`` when sending, keeps what would have been sent """
+
+    def __init__(self):
+        self.sent = []
+
+    def send(self, topic, message):
+        if isinstance(message, str):
+            message = json.loads(message)
+        self.sent.append((topic, message))
+
+
+def save_model(directory, model):
+    """ Keep the discovered ``model`` (a JSON serializable dictionary) with a recording """
+    os.makedirs(directory, exist_ok=True)
+    tmp = os.path.join(directory, '.' + MODEL_FILE)
+    with open(tmp, 'w') as f:
+        json.dump(model, f)
+    os.replace(tmp, os.path.join(directory, MODEL_FILE))
+
+
+def load_model(directory):
+    """ The model saved with a recording by ``save_model`` """
+    path = os.path.join(directory, MODEL_FILE)
+    if not os.path.exists(path):
+        raise ValueError("{} holds no model, it was not recorded with --record_dir".format(directory))
+    with open(path) as f:
+        return json.load(f)
+
+
+def recording_chunks(reader, measids):
+    """ Yield ``(timestamps, values, present)`` per segment of a ``RecordingReader``
+
+    ``values`` is a structured (rows, len(measids)) array in the order of
+    ``measids``; measids that were not recorded are missing on every row.
+    """
+    recorded = {measid: i for i, measid in enumerate(reader.measids)}
+    columns = np.array([recorded.get(measid, -1) for measid in measids], dtype=np.intp)
+    known = columns >= 0
+    if not known.all():
+        _log.warning("{} of {} measids are not in the recording".format(int((~known).sum()), len(measids)))
+    take = np.where(known, columns, 0)
+
+    for segment in reader.segments():
+        timestamps = np.asarray(segment['timestamp'])
+        rows = len(timestamps)
+        values = np.empty((rows, len(measids)), dtype=DTYPE)
+        for field in FIELDS:
+            column = np.asarray(segment[field])[:, take]
+            column[:, ~known] = np.nan
+            values[field] = column
+        present = np.asarray(segment['present'])[:, take] & known
+        yield timestamps, values, present
+
+
+def timeseries_messages(requester, simulation_id, start, end, window=DEFAULT_WINDOW, timeout=120):
+    """ Yield the output messages of a simulation stored in the timeseries store
+
+    The store is queried ``window`` seconds of simulation time at a time.
+    """
+    t = start
+    while t <= end:
+        stop = min(end, t + window - 1)
+        message = {
+            "queryMeasurement": "simulation",
+            "queryFilter": {"simulation_id": str(simulation_id), "startTime": str(t), "endTime": str(stop),
+                            "hasSimulationMessageType": "OUTPUT"},
+            "responseFormat": "JSON"}
+        response = requester.get_response(TIMESERIES_TOPIC, message, timeout=timeout)
+        rows = response.get('data', []) if isinstance(response, dict) else []
+        by_time = {}
+        for row in rows:
+            by_time.setdefault(int(row['time']), {})[row['measurement_mrid']] = row
+        for timestamp in sorted(by_time):
+            yield {'simulation_id': str(simulation_id),
+                   'message': {'timestamp': timestamp, 'measurements': by_time[timestamp]}}
+        t = stop + 1
+
+
+def message_chunks(messages, measids, chunk_rows=DEFAULT_CHUNK_ROWS):
+    """ Yield ``(timestamps, values, present)`` chunks of ``chunk_rows`` messages """
+    decoder = MeasurementDecoder(measids, buffers=1)
+    timestamps = []
+    values = np.empty((chunk_rows, len(measids)), dtype=DTYPE)
+    present = np.zeros((chunk_rows, len(measids)), dtype=bool)
+    for message in messages:
+        row = len(timestamps)
+        values[row], present[row] = decoder.decode(message['message']['measurements'])
+        timestamps.append(message['message']['timestamp'])
+        if len(timestamps) == chunk_rows:
+            yield np.array(timestamps), values, present
+            timestamps = []
+            values = np.empty_like(values)
+            present = np.zeros_like(present)
+    if timestamps:
+        rows = len(timestamps)
+        yield np.array(timestamps), values[:rows], present[:rows]
+
+
+class BatchReplay(object):
+    """ Feed decoded chunks through an app as fast as it processes them """
+
+    def __init__(self, app):
+        """ Create a ``BatchReplay``
+
+        Parameters
+        ----------
+        app: NodalVoltage
+            The app, built like in live mode but on a ``DryRunConnection``.
+        """
+        self._app = app
+        self.timesteps = 0
+        self.elapsed = 0.0
+        self.simulated = 0
+
+    @property
+    def speedup(self):
+        """ Simulated seconds replayed per second of processing """
+        return self.simulated / self.elapsed if self.elapsed else float('nan')
+
+    def run(self, chunks):
+        first = None
+        start = time.perf_counter()
+        for timestamps, values, present in chunks:
+            for row, timestamp in enumerate(timestamps.tolist()):
+                self._app.on_decoded(timestamp, values[row], present[row])
+                first = timestamp if first is None else first
+                self.simulated = timestamp - first
+                self.timesteps += 1
+        self.elapsed = time.perf_counter() - start
+        _log.info("Replayed {} timesteps ({}s of simulation) in {:.1f}s, {:.0f}x real time".format(
+            self.timesteps, self.simulated, self.elapsed, self.speedup))
+        return self
@@ -0,0 +1,204 @@
+"""
+Size bounded sending of difference messages.
+
+A ``DifferenceBuilder`` message carries every difference added to it, one
+per capacitor of the feeder for ``CapacitorToggler`` or one per device for a
+batch of switch and tap commands.  ``ChunkedSender`` sends small messages
+unchanged and splits large ones into chunks of at most ``max_bytes``
+serialized bytes and ``max_differences`` differences, each a complete
+difference message of its own with the forward and reverse differences of
+the same devices.  Differences are ordered by the priority of their attribute
+first (switches before taps before capacitors by default), so the most
+important actions reach the simulator first.
+
+With ``pace`` set, the chunks are sent by a background thread at least
+``pace`` seconds apart, in the order the messages were given, and the caller
+never waits.  The time every ``send`` to the platform took is kept per chunk.
+"""
+
+import collections
+import json
+import logging
+import threading
+import time
+import uuid
+
+import numpy as np
+
+_log = logging.getLogger(__name__)
+
+DEFAULT_MAX_BYTES = 64 * 1024
+DEFAULT_MAX_DIFFERENCES = 500
+DEFAULT_PACE = 0.0
+DEFAULT_PRIORITIES = {'Switch.open': 0, 'TapChanger.step': 1, 'RegulatingControl.targetValue': 1,
+                      'ShuntCompensator.sections': 2}
+DEFAULT_LATENCY_WINDOW = 1000
+
+
+def _size(value):
+    return len(json.dumps(value))
+
+
+def split(message, max_bytes=DEFAULT_MAX_BYTES, max_differences=DEFAULT_MAX_DIFFERENCES, priorities=None):
+    """ Split a difference message into messages within the size bounds
+
+    A message within the bounds is returned as the only chunk.  A single
+    difference larger than ``max_bytes`` still gets a chunk of its own.
+    """
+    priorities = DEFAULT_PRIORITIES if priorities is None else priorities
+    body = message['input']['message']
+    forward = body.get('forward_differences', [])
+    reverse = body.get('reverse_differences', [])
+    if len(forward) + len(reverse) <= max_differences and _size(message) <= max_bytes:
+        return [message]
+
+    # pair every forward difference with the reverse one of the same object and attribute
+    reverse_of = collections.defaultdict(collections.deque)
+    for d in reverse:
+        reverse_of[(d.get('object'), d.get('attribute'))].append(d)
+    pairs = []
+    for d in forward:
+        pending = reverse_of.get((d.get('object'), d.get('attribute')))
+        pairs.append(([d], [pending.popleft()] if pending else []))
+    pairs += [([], list(pending)) for pending in reverse_of.values() if pending]
+    rank = len(priorities)
+    pairs.sort(key=lambda pair: priorities.get((pair[0] or pair[1])[0].get('attribute'), rank))
+
+    empty = dict(body, forward_differences=[], reverse_differences=[])
+    # room for the new difference_mrid of the later chunks
+    envelope = _size(dict(message, input=dict(message['input'], message=empty))) + len(str(uuid.uuid4()))
+    chunks = []
+    current, size, count = [], envelope, 0
+    for pair in pairs:
+        pair_size = sum(_size(d) + 2 for part in pair for d in part)
+        pair_count = len(pair[0]) + len(pair[1])
+        if current and (size + pair_size > max_bytes or count + pair_count > max_differences):
+            chunks.append(current)
+            current, size, count = [], envelope, 0
+        current.append(pair)
+        size += pair_size
+        count += pair_count
+    if current:
+        chunks.append(current)
+
+    messages = []
+    for i, chunk in enumerate(chunks):
+        chunk_body = dict(body, forward_differences=[d for pair in chunk for d in pair[0]],
+                          reverse_differences=[d for pair in chunk for d in pair[1]])
+        if i:
+            chunk_body['difference_mrid'] = str(uuid.uuid4())
+        messages.append(dict(message, input=dict(message['input'], message=chunk_body)))
+    return messages
+
+
+class ChunkedSender(object):
+    """ Send difference messages to a topic in bounded, prioritized and paced chunks """
+
+    def __init__(self, gapps, topic, max_bytes=DEFAULT_MAX_BYTES, max_differences=DEFAULT_MAX_DIFFERENCES,
+                 pace=DEFAULT_PACE, priorities=None, journal=None, latency_window=DEFAULT_LATENCY_WINDOW):
+        """ Create a ``ChunkedSender``
+
+        Parameters
+        ----------
+        gapps: GridAPPSD
+            Connection used to send the chunks.
+        topic: str
+            The simulation input topic.
+        max_bytes: int
+            Serialized size a chunk stays within.
+        max_differences: int
+            Differences, forward and reverse, a chunk holds at most.
+        pace: float
+            Seconds between two chunks, 0 sends all of them right away.
+        priorities: dict
+            Attribute to rank, lower ranks are sent first.
+        journal: CommandJournal
+            Keeps every chunk sent.
+        latency_window: int
+            Number of the latest chunk send times kept.
+        """
+        self._gapps = gapps
+        self.topic = topic
+        self._max_bytes = int(max_bytes)
+        self._max_differences = int(max_differences)
+        self._pace = float(pace)
+        self._priorities = priorities
+        self._journal = journal
+        self.latencies = collections.deque(maxlen=latency_window)
+        self.messages = 0
+        self.chunks = 0
+        self.bytes_sent = 0
+
+        self._condition = threading.Condition()
+        self._pending = collections.deque()
+        self._closing = False
+        self._thread = None
+        if self._pace > 0:
+            self._thread = threading.Thread(target=self._run, name='chunked-sender', daemon=True)
+            self._thread.start()
+
+    def send(self, message):
+        """ Send a difference message (a dict), split when it is too large """
+        chunks = split(message, self._max_bytes, self._max_differences, self._priorities)
+        self.messages += 1
+        if len(chunks) > 1:
+            _log.info("Splitting a difference message into {} chunks".format(len(chunks)))
+        if self._thread is None:
+            for chunk in chunks:
+                self._send_chunk(chunk)
+            return len(chunks)
+        with self._condition:
+            self._pending.extend(chunks)
+            self._condition.notify()
+        return len(chunks)
+
+    def _send_chunk(self, chunk):
+        body = json.dumps(chunk)
+        start = time.perf_counter()
+        self._gapps.send(self.topic, body)
+        latency = time.perf_counter() - start
+        self.latencies.append(latency)
+        _log.debug("Sent a difference chunk of {} bytes in {:.1f}ms".format(len(body), 1e3 * latency))
+        self.chunks += 1
+        self.bytes_sent += len(body)
+        if self._journal is not None:
+            self._journal.append(self.topic, body)
+
+    def latency(self):
+        """ Count, mean, median, 95th percentile and maximum of the kept chunk send times in seconds """
+        if not self.latencies:
+            return dict(count=0)
+        values = np.array(self.latencies)
+        return dict(count=len(values), mean=float(values.mean()), p50=float(np.percentile(values, 50)),
+                    p95=float(np.percentile(values, 95)), max=float(values.max()))
+
+    def close(self, timeout=None):
+        """ Send the chunks still waiting and stop the thread """
+        if self._thread is not None:
+            with self._condition:
+                self._closing = True
+                self._condition.notify()
+            self._thread.join(timeout)
+        _log.info("Sent {} difference messages in {} chunks ({} bytes), send latency {}".format(
+            self.messages, self.chunks, self.bytes_sent, self.latency()))
+        return self._thread is None or not self._thread.is_alive()
+
+    def _run(self):
+        next_send = 0.0
+        while True:
+            with self._condition:
+                while not self._pending and not self._closing:
+                    self._condition.wait()
+                if not self._pending:
+                    break
+                # a close sends what is left without waiting
+                delay = next_send - time.monotonic()
+                if delay > 0 and not self._closing:
+                    self._condition.wait(delay)
+                    continue
+                chunk = self._pending.popleft()
+            try:
+                self._send_chunk(chunk)
+            except Exception:
+                _log.exception("Failed to send a difference chunk to {}".format(self.topic))
+            next_send = time.monotonic() + self._pace
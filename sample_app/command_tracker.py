@@ -0,0 +1,133 @@
+"""
+Closed-loop tracking of the commands sent to the simulator.
+
+Every difference message sent to the ``simulation_input_topic`` is noted with
+the value its target should reach.  The ``Pos`` measurements of the following
+timesteps are compared to that value to find out when the simulator applied
+the command.  Command-to-effect latency is kept both in seconds and in
+timesteps, and commands that are not confirmed within a number of timesteps
+are reported as lost.
+"""
+
+import logging
+import time
+
+from metrics import LatencyHistogram
+
+_log = logging.getLogger(__name__)
+
+DEFAULT_MAX_TIMESTEPS = 5
+
+
+def _switch_position(value):
+    # Switch.open = 1 means the switch is open, whose Pos measurement is 0
+    return 0 if int(value) else 1
+
+
+# Conversion from a commanded attribute value to the expected Pos measurement value
+POSITION_OF = {
+    'Switch.open': _switch_position,
+    'TapChanger.step': int,
+    'ShuntCompensator.sections': int,
+}
+
+
+class PendingCommand(object):
+    """ A command waiting for its effect to show in the measurements """
+
+    __slots__ = ('mrid', 'attribute', 'value', 'expected', 'measids', 'sent_at', 'timesteps')
+
+    def __init__(self, mrid, attribute, value, expected, measids, sent_at):
+        self.mrid = mrid
+        self.attribute = attribute
+        self.value = value
+        self.expected = expected
+        self.measids = measids
+        self.sent_at = sent_at
+        self.timesteps = 0
+
+    def __repr__(self):
+        return "PendingCommand({} {}={})".format(self.mrid, self.attribute, self.value)
+
+
+class CommandTracker(object):
+    """ Match outbound commands with the ``Pos`` measurements that confirm them """
+
+    def __init__(self, pos_measurements, aliases=None, max_timesteps=DEFAULT_MAX_TIMESTEPS):
+        """ Create a ``CommandTracker``
+
+        Parameters
+        ----------
+        pos_measurements: list(dict)
+            ``Pos`` measurement descriptions from ``QUERY_OBJECT_MEASUREMENTS``,
+            indexed by their ``eqid``.
+        aliases: dict
+            Measids to watch for command targets that are not the measured
+            equipment itself, e.g. a tap changer mrid mapped to the ``Pos``
+            measid of its transformer phase.
+        max_timesteps: int
+            Number of timesteps after which an unconfirmed command is given up.
+        """
+        self._measids = {}
+        for d in pos_measurements:
+            self._measids.setdefault(d['eqid'], []).append(d['measid'])
+        self._measids.update(aliases or {})
+        self._max_timesteps = max_timesteps
+        self._pending = []
+        self.latency = LatencyHistogram()
+        self.timesteps = {}
+        self.confirmed = 0
+        self.unconfirmed = []
+        self.untracked = 0
+
+    def track(self, mrid, attribute, value, sent_at=None):
+        """ Note a command sent to the simulator """
+        measids = self._measids.get(mrid)
+        convert = POSITION_OF.get(attribute)
+        if not measids or convert is None:
+            self.untracked += 1
+            _log.debug("No Pos measurement to confirm {} {}".format(mrid, attribute))
+            return
+        self._pending.append(PendingCommand(mrid, attribute, value, convert(value), measids,
+                                            time.time() if sent_at is None else sent_at))
+
+    def track_message(self, message, sent_at=None):
+        """ Note every forward difference of a ``DifferenceBuilder`` message """
+        sent_at = time.time() if sent_at is None else sent_at
+        for diff in message['input']['message']['forward_differences']:
+            self.track(diff['object'], diff['attribute'], diff['value'], sent_at)
+
+    def observe(self, timestamp, measurements):
+        """ Check pending commands against the measurements of a new timestep """
+        if not self._pending:
+            return
+        now = time.time()
+        still_pending = []
+        for command in self._pending:
+            command.timesteps += 1
+            values = [measurements[m].get('value') for m in command.measids if m in measurements]
+            if values and all(v == command.expected for v in values):
+                self.confirmed += 1
+                self.latency.record(now - command.sent_at)
+                self.timesteps[command.timesteps] = self.timesteps.get(command.timesteps, 0) + 1
+            elif command.timesteps >= self._max_timesteps:
+                self.unconfirmed.append(command)
+                _log.warning("{} not confirmed after {} timesteps (at {})".format(
+                    command, command.timesteps, timestamp))
+            else:
+                still_pending.append(command)
+        self._pending = still_pending
+
+    @property
+    def pending(self):
+        return len(self._pending)
+
+    def summary(self):
+        return dict(confirmed=self.confirmed, unconfirmed=len(self.unconfirmed), pending=self.pending,
+                    untracked=self.untracked, latency=self.latency.summary(),
+                    timesteps=dict(sorted(self.timesteps.items())))
+
+    def close(self, timeout=None):
+        """ Log the final statistics, for use as a shutdown drainer """
+        _log.info("Command latency: {}".format(self.summary()))
+        return True
@@ -0,0 +1,94 @@
+"""
+Decoding of the measurements dictionary of a simulation output message.
+
+``MeasurementDecoder`` maps a fixed list of measids to integer slots once and
+decodes every timestep into a NumPy structured array with the ``magnitude``,
+``angle`` and ``value`` of each slot, plus a mask of the slots whose measid was
+present in the message.  Missing fields are NaN.  The arrays are allocated once
+and reused, alternating between two buffers so the previous timestep stays
+available for change detection.
+"""
+
+import numpy as np
+
+FIELDS = ('magnitude', 'angle', 'value')
+DTYPE = np.dtype([(field, np.float64) for field in FIELDS])
+
+_NAN = float('nan')
+
+
+class MeasurementDecoder(object):
+    """ Decode measurements of a fixed set of measids into reused arrays """
+
+    def __init__(self, measids, buffers=2):
+        """ Create a ``MeasurementDecoder``
+
+        Parameters
+        ----------
+        measids: list(str)
+            The measids to decode, in slot order.
+        buffers: int
+            Arrays used in turn, a decoded timestep is overwritten ``buffers``
+            calls to ``decode`` later.
+        """
+        self.measids = list(measids)
+        self.slots = {measid: i for i, measid in enumerate(self.measids)}
+        n = len(self.measids)
+        self._values = [np.empty(n, dtype=DTYPE) for _ in range(buffers)]
+        self._present = [np.zeros(n, dtype=bool) for _ in range(buffers)]
+        self._current = -1
+
+    def __len__(self):
+        return len(self.measids)
+
+    def slot_of(self, measids):
+        """ Slots of ``measids`` as an index array """
+        return np.fromiter((self.slots[measid] for measid in measids), dtype=np.intp, count=len(measids))
+
+    @property
+    def values(self):
+        """ Structured array of the last decoded timestep """
+        return self._values[self._current]
+
+    @property
+    def present(self):
+        """ Mask of the slots present in the last decoded timestep """
+        return self._present[self._current]
+
+    def load(self, values, present):
+        """ Take a timestep decoded elsewhere (e.g. a row of a recording) in slot order """
+        self._current = (self._current + 1) % len(self._values)
+        self._values[self._current][...] = values
+        self._present[self._current][...] = present
+        return self._values[self._current], self._present[self._current]
+
+    def decode(self, measurements):
+        """ Decode the ``measurements`` dictionary of a message
+
+        Returns the structured array of values and the present mask, both
+        reused by later calls.
+        """
+        self._current = (self._current + 1) % len(self._values)
+        values = self._values[self._current]
+        present = self._present[self._current]
+        n = len(self.measids)
+
+        if len(measurements) < n:
+            # incremental output: walk the message
+            values[...] = (_NAN, _NAN, _NAN)
+            present[:] = False
+            slots = self.slots
+            for measid, meas in measurements.items():
+                slot = slots.get(measid)
+                if slot is None:
+                    continue
+                present[slot] = True
+                values[slot] = (meas.get('magnitude', _NAN), meas.get('angle', _NAN), meas.get('value', _NAN))
+        else:
+            # full output: one lookup per known measid
+            found = list(map(measurements.get, self.measids))
+            present[:] = np.fromiter((meas is not None for meas in found), dtype=bool, count=n)
+            for field in FIELDS:
+                values[field] = np.fromiter((meas.get(field, _NAN) if meas is not None else _NAN
+                                             for meas in found), dtype=np.float64, count=n)
+        return values, present
@@ -0,0 +1,271 @@
+"""
+Lag aware dispatch of simulation output messages.
+
+The STOMP callback only parses the message, hands it to the taps that must
+see every timestep (recorders) and queues it.  A worker thread feeds the
+queue to the real handler.  The worker measures how far behind the
+simulation it is and, once the lag crosses a threshold, skips every queued
+timestep but the newest so control decisions are made on fresh state.  It
+returns to processing every timestep once the lag falls back under the
+recovery threshold.
+
+``StartupBuffer`` is subscribed before the model is discovered and holds the
+output of the simulation until the handler exists, so the first timesteps
+are not lost while the app starts.  A dispatcher it hands over to must queue
+at least ``max_frames`` timesteps or the oldest of them are dropped.
+"""
+
+import collections
+import json
+import logging
+import threading
+import time
+
+_log = logging.getLogger(__name__)
+
+DEFAULT_LAG_THRESHOLD = 6.0
+DEFAULT_MAX_PENDING = 100
+DEFAULT_STARTUP_FRAMES = 200
+
+
+class LagMonitor(object):
+    """ Track processing lag behind the simulation clock with hysteresis
+
+    Simulation timestamps do not have to match the wall clock (a simulation
+    can start at any date), so the lag of a timestep is measured against the
+    smallest offset between wall clock and simulation time seen since the
+    handler was last idle.  Once everything received has been processed the
+    next timestep sets a new baseline, so a pause of the simulation or a
+    simulation running slower than real time does not count as lag.
+    """
+
+    def __init__(self, threshold=DEFAULT_LAG_THRESHOLD, recover=None):
+        """ Create a ``LagMonitor``
+
+        Parameters
+        ----------
+        threshold: float
+            Lag in seconds above which the handler is considered overloaded.
+            ``None`` or 0 disables skipping.
+        recover: float
+            Lag in seconds under which an overloaded handler recovers,
+            half of ``threshold`` by default.
+        """
+        self.threshold = threshold or None
+        self.recover = recover if recover is not None else (threshold or 0) / 2.0
+        self._base_offset = None
+        self.lag = 0.0
+        self.max_lag = 0.0
+        self.lagging = False
+        self.overloads = 0
+
+    def idle(self):
+        """ The handler caught up with every timestep received, the next one sets the baseline """
+        self._base_offset = None
+
+    def update(self, timestamp, now=None):
+        """ Update the lag with a timestep about to be processed and return it """
+        offset = (time.time() if now is None else now) - float(timestamp)
+        if self._base_offset is None or offset < self._base_offset:
+            self._base_offset = offset
+        self.lag = offset - self._base_offset
+        self.max_lag = max(self.max_lag, self.lag)
+
+        if self.threshold is not None:
+            if not self.lagging and self.lag > self.threshold:
+                self.lagging = True
+                self.overloads += 1
+                _log.warning("Processing is {:.1f}s behind the simulation, skipping stale timesteps".format(
+                    self.lag))
+            elif self.lagging and self.lag < self.recover:
+                self.lagging = False
+                _log.info("Processing caught up with the simulation ({:.1f}s behind)".format(self.lag))
+        return self.lag
+
+
+class LagAwareDispatcher(object):
+    """ Queue simulation output for a handler and skip stale timesteps under overload
+
+    The object should be subscribed to the ``simulation_output_topic`` in place
+    of the handler it wraps.
+    """
+
+    def __init__(self, handler, monitor=None, taps=(), max_pending=DEFAULT_MAX_PENDING,
+                 merge_skipped=False):
+        """ Create a ``LagAwareDispatcher`` and start its worker thread
+
+        Parameters
+        ----------
+        handler: object
+            Object with an ``on_message(headers, message)`` method.
+        monitor: LagMonitor
+            Lag tracking and thresholds, a default ``LagMonitor`` if not given.
+        taps: list(callable)
+            Called with ``(timestamp, measurements)`` for every timestep on the
+            subscription thread, before any skipping.  Must not block.
+        max_pending: int
+            Queued timesteps beyond this are dropped oldest first.
+        merge_skipped: bool
+            Carry the measurements of skipped timesteps into the next one, for
+            outputs that only contain the measurements that changed.
+        """
+        self._handler = handler
+        self.monitor = monitor if monitor is not None else LagMonitor()
+        self._taps = list(taps)
+        self._merge_skipped = merge_skipped
+        self._pending = collections.deque(maxlen=max_pending)
+        self._condition = threading.Condition()
+        self._closing = False
+        self.received = 0
+        self.processed = 0
+        self.skipped = 0
+
+        self._thread = threading.Thread(target=self._run, name='output-dispatcher', daemon=True)
+        self._thread.start()
+
+    def on_message(self, headers, message):
+        if isinstance(message, str):
+            message = json.loads(message)
+        timestamp = message['message']['timestamp']
+        for tap in self._taps:
+            tap(timestamp, message['message']['measurements'])
+
+        with self._condition:
+            if len(self._pending) == self._pending.maxlen:
+                self.skipped += 1
+            self._pending.append((headers, message))
+            self.received += 1
+            self._condition.notify()
+
+    def close(self, timeout=None):
+        """ Process what is still queued and stop the worker
+
+        Returns True when the queue was emptied within ``timeout`` seconds.
+        """
+        with self._condition:
+            self._closing = True
+            self._condition.notify()
+        self._thread.join(timeout)
+        return not self._thread.is_alive()
+
+    def _next(self):
+        with self._condition:
+            while not self._pending:
+                if self._closing:
+                    return None
+                self.monitor.idle()
+                self._condition.wait()
+            headers, message = self._pending.popleft()
+            lag = self.monitor.update(message['message']['timestamp'])
+            while self.monitor.lagging and self._pending:
+                # a newer timestep is waiting, this one is stale
+                self.skipped += 1
+                newer = self._pending.popleft()
+                if self._merge_skipped:
+                    newer = (newer[0], _merge(message, newer[1]))
+                headers, message = newer
+                lag = self.monitor.update(message['message']['timestamp'])
+            _log.debug("Processing timestep {} with {:.1f}s lag".format(message['message']['timestamp'], lag))
+            return headers, message
+
+    def _run(self):
+        while True:
+            item = self._next()
+            if item is None:
+                break
+            try:
+                self._handler.on_message(*item)
+            except Exception:
+                _log.exception("Handler failed on timestep {}".format(item[1]['message']['timestamp']))
+            self.processed += 1
+
+
+def _merge(older, newer):
+    """ A copy of ``newer`` whose measurements fall back to those of ``older`` """
+    measurements = dict(older['message']['measurements'])
+    measurements.update(newer['message']['measurements'])
+    merged = dict(newer)
+    merged['message'] = dict(newer['message'], measurements=measurements)
+    return merged
+
+
+class StartupBuffer(object):
+    """ Hold simulation output until the handler is ready, then hand it over
+
+    The object should be subscribed to the ``simulation_output_topic`` as soon
+    as the connection is up.  Frames are kept as received, at most
+    ``max_frames`` of them: beyond that the oldest frame is folded into the
+    next one, so the measurements it carried are kept while its timestep is
+    given up.
+    """
+
+    def __init__(self, max_frames=DEFAULT_STARTUP_FRAMES, collapse=False, taps=()):
+        """ Create a ``StartupBuffer``
+
+        Parameters
+        ----------
+        max_frames: int
+            Frames held before the oldest are folded together.
+        collapse: bool
+            Hand the buffered frames over as a single timestep with the latest
+            value of every measurement instead of one by one.
+        taps: list(callable)
+            Called with ``(headers, message)`` for every frame as it is
+            received, buffered or not.  Must not block.
+        """
+        self.max_frames = max(1, int(max_frames))
+        self._collapse = collapse
+        self._frames = collections.deque()
+        self._lock = threading.Lock()
+        self._handler = None
+        self._taps = list(taps)
+        self.buffered = 0
+        self.folded = 0
+
+    def on_message(self, headers, message):
+        for tap in self._taps:
+            tap(headers, message)
+        with self._lock:
+            handler = self._handler
+            if handler is None:
+                self._frames.append((headers, message))
+                self.buffered += 1
+                if len(self._frames) > self.max_frames:
+                    self._fold()
+                return
+        handler.on_message(headers, message)
+
+    def _fold(self):
+        _, older = self._frames.popleft()
+        headers, newer = self._frames.popleft()
+        self._frames.appendleft((headers, _merge(_parsed(older), _parsed(newer))))
+        self.folded += 1
+
+    def attach(self, handler):
+        """ Hand the buffered frames to ``handler`` and every later one as it arrives
+
+        Frames received while the buffer is handed over follow in order.
+        Returns the number of frames handed over.
+        """
+        count = 0
+        while True:
+            with self._lock:
+                frames, self._frames = self._frames, collections.deque()
+                if not frames:
+                    self._handler = handler
+                    break
+            if self._collapse and len(frames) > 1:
+                headers, message = frames.popleft()
+                message = _parsed(message)
+                for _, newer in frames:
+                    message = _merge(message, _parsed(newer))
+                frames = [(headers, message)]
+            for headers, message in frames:
+                handler.on_message(headers, message)
+                count += 1
+        _log.info("Handed over {} frames buffered at startup ({} folded)".format(count, self.folded))
+        return count
+
+
+def _parsed(message):
+    return json.loads(message) if isinstance(message, str) else message
@@ -0,0 +1,265 @@
+"""
+Append-only journal of the difference messages sent to the simulation.
+
+``CommandJournal.append`` takes the serialized message right after it was
+sent and only places it on a list, so the send path does not wait for the
+disk.  A background thread splits every message into one JSON line per
+difference (simulation id, message timestamp, mRID, attribute, forward and
+reverse values), writes whatever accumulated since its last pass in one go
+and fsyncs at most every ``fsync_interval`` seconds.  When a segment grows
+past ``segment_bytes`` it is closed with an index of the byte offsets of
+every mRID and its time range, and a new segment is started.
+
+Layout on disk::
+
+    <directory>/journal_00000.jsonl         one difference per line
+    <directory>/journal_00000.index.json    offsets per mRID, first/last timestamp
+    <directory>/journal_00001.jsonl         segment being written, no index yet
+
+``JournalReader`` answers queries by mRID and time range from the indexes,
+scanning only the segments that have none (the current one, or one left by a
+crash).
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+
+_log = logging.getLogger(__name__)
+
+DEFAULT_SEGMENT_BYTES = 8 * 1024 * 1024
+DEFAULT_FSYNC_INTERVAL = 1.0
+
+SEGMENT_PREFIX = 'journal_'
+SEGMENT_SUFFIX = '.jsonl'
+INDEX_SUFFIX = '.index.json'
+
+
+def _segment_names(directory):
+    return sorted(name for name in os.listdir(directory)
+                  if name.startswith(SEGMENT_PREFIX) and name.endswith(SEGMENT_SUFFIX))
+
+
+def entries(topic, message, sequence, sent):
+    """ One journal entry per difference of a serialized difference message """
+    if isinstance(message, str):
+        message = json.loads(message)
+    inner = message.get('input', message)
+    body = inner.get('message', {})
+    reverse = {(d.get('object'), d.get('attribute')): d.get('value')
+               for d in body.get('reverse_differences', [])}
+    common = dict(sequence=sequence, sent=sent, topic=topic, simulation_id=inner.get('simulation_id'),
+                  timestamp=body.get('timestamp'), difference_mrid=body.get('difference_mrid'))
+    found = []
+    for d in body.get('forward_differences', []):
+        key = (d.get('object'), d.get('attribute'))
+        found.append(dict(common, mrid=key[0], attribute=key[1], forward=d.get('value'),
+                          reverse=reverse.pop(key, None)))
+    # reverse differences without a forward one
+    for (mrid, attribute), value in reverse.items():
+        found.append(dict(common, mrid=mrid, attribute=attribute, forward=None, reverse=value))
+    return found
+
+
+class CommandJournal(object):
+    """ Write every outbound difference message to rotating, indexed segments """
+
+    def __init__(self, directory, segment_bytes=DEFAULT_SEGMENT_BYTES, fsync_interval=DEFAULT_FSYNC_INTERVAL):
+        """ Create a ``CommandJournal`` and start its writer thread
+
+        Parameters
+        ----------
+        directory: str
+            Directory of the segments, created if missing.  A journal opened on
+            a directory written before continues after its last segment.
+        segment_bytes: int
+            Size after which a segment is closed and a new one started.
+        fsync_interval: float
+            Seconds between two fsyncs of the current segment, 0 syncs after
+            every batch.
+        """
+        self.directory = directory
+        self._segment_bytes = int(segment_bytes)
+        self._fsync_interval = float(fsync_interval)
+        self._condition = threading.Condition()
+        self._pending = []
+        self._closing = False
+        self.messages = 0
+        self.written = 0
+        self.syncs = 0
+
+        os.makedirs(directory, exist_ok=True)
+        existing = _segment_names(directory)
+        self._segment = int(existing[-1][len(SEGMENT_PREFIX):-len(SEGMENT_SUFFIX)]) + 1 if existing else 0
+        self._file = None
+        self._open_segment()
+
+        self._thread = threading.Thread(target=self._run, name='command-journal', daemon=True)
+        self._thread.start()
+
+    def append(self, topic, message):
+        """ Queue a sent message, a dict or its JSON string, never blocking on the disk """
+        sent = time.time()
+        with self._condition:
+            self._pending.append((self.messages, topic, message, sent))
+            self.messages += 1
+            self._condition.notify()
+
+    def close(self, timeout=None):
+        """ Write and sync everything queued, index the current segment and stop the thread """
+        with self._condition:
+            self._closing = True
+            self._condition.notify()
+        self._thread.join(timeout)
+        _log.info("Command journal wrote {} differences of {} messages".format(self.written, self.messages))
+        return not self._thread.is_alive()
+
+    def _open_segment(self):
+        self._name = '{}{:05d}'.format(SEGMENT_PREFIX, self._segment)
+        self._file = open(os.path.join(self.directory, self._name + SEGMENT_SUFFIX), 'ab')
+        self._offset = self._file.tell()
+        self._index = {}
+        self._first = None
+        self._last = None
+        self._dirty = False
+
+    def _close_segment(self):
+        self._sync()
+        self._file.close()
+        if not self._offset:
+            os.remove(self._file.name)
+            return
+        _write_index(self.directory, self._name, self._index, self._first, self._last)
+        self._segment += 1
+
+    def _sync(self):
+        if self._dirty:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._dirty = False
+            self.syncs += 1
+
+    def _write(self, batch):
+        lines = []
+        for sequence, topic, message, sent in batch:
+            try:
+                found = entries(topic, message, sequence, sent)
+            except (ValueError, AttributeError, TypeError):
+                _log.exception("Failed to journal a message sent to {}".format(topic))
+                continue
+            for entry in found:
+                line = (json.dumps(entry, separators=(',', ':')) + '\n').encode('utf-8')
+                self._index.setdefault(entry['mrid'], []).append(self._offset)
+                timestamp = entry['timestamp']
+                if timestamp is not None:
+                    self._first = timestamp if self._first is None else min(self._first, timestamp)
+                    self._last = timestamp if self._last is None else max(self._last, timestamp)
+                self._offset += len(line)
+                lines.append(line)
+        if lines:
+            self._file.write(b''.join(lines))
+            self._dirty = True
+            self.written += len(lines)
+
+    def _run(self):
+        last_sync = time.monotonic()
+        while True:
+            with self._condition:
+                while not self._pending and not self._closing:
+                    wait = None
+                    if self._dirty:
+                        wait = max(0.0, last_sync + self._fsync_interval - time.monotonic())
+                    if wait == 0.0 or not self._condition.wait(wait):
+                        break
+                batch, self._pending = self._pending, []
+                closing = self._closing
+            try:
+                self._write(batch)
+                if closing or time.monotonic() - last_sync >= self._fsync_interval:
+                    self._sync()
+                    last_sync = time.monotonic()
+                if self._offset >= self._segment_bytes and not closing:
+                    self._close_segment()
+                    self._open_segment()
+            except Exception:
+                _log.exception("Failed to write the command journal")
+            if closing:
+                with self._condition:
+                    if self._pending:
+                        continue
+                break
+        self._close_segment()
+
+
+def _write_index(directory, name, index, first, last):
+    tmp = os.path.join(directory, '.' + name + INDEX_SUFFIX)
+    with open(tmp, 'w') as f:
+        json.dump(dict(first=first, last=last, mrids=index), f)
+    os.replace(tmp, os.path.join(directory, name + INDEX_SUFFIX))
+
+
+class JournalReader(object):
+    """ Query a directory written by ``CommandJournal`` by mRID and time range """
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def segments(self):
+        return [name[:-len(SEGMENT_SUFFIX)] for name in _segment_names(self.directory)]
+
+    def index(self, name):
+        """ ``(first, last, offsets by mrid)`` of a segment, scanning it when it has no index """
+        path = os.path.join(self.directory, name + INDEX_SUFFIX)
+        if os.path.exists(path):
+            with open(path) as f:
+                index = json.load(f)
+            return index['first'], index['last'], index['mrids']
+        first = last = None
+        offsets = {}
+        for offset, entry in self._scan(name):
+            offsets.setdefault(entry['mrid'], []).append(offset)
+            timestamp = entry['timestamp']
+            if timestamp is not None:
+                first = timestamp if first is None else min(first, timestamp)
+                last = timestamp if last is None else max(last, timestamp)
+        return first, last, offsets
+
+    def _scan(self, name):
+        offset = 0
+        with open(os.path.join(self.directory, name + SEGMENT_SUFFIX), 'rb') as f:
+            for line in f:
+                if line.endswith(b'\n'):
+                    try:
+                        yield offset, json.loads(line)
+                    except ValueError:
+                        _log.warning("Skipping a damaged line of {} at {}".format(name, offset))
+                # a line cut short by a crash is left out
+                offset += len(line)
+
+    def query(self, mrid=None, start=None, end=None):
+        """ Yield the entries of ``mrid`` (all when None) with ``start <= timestamp <= end`` in order """
+        for name in self.segments():
+            first, last, offsets = self.index(name)
+            if first is not None and ((start is not None and last < start) or (end is not None and first > end)):
+                continue
+            if mrid is None:
+                found = (entry for _, entry in self._scan(name))
+            elif mrid in offsets:
+                found = self._read(name, offsets[mrid])
+            else:
+                continue
+            for entry in found:
+                timestamp = entry['timestamp']
+                if start is not None and (timestamp is None or timestamp < start):
+                    continue
+                if end is not None and (timestamp is None or timestamp > end):
+                    continue
+                yield entry
+
+    def _read(self, name, offsets):
+        with open(os.path.join(self.directory, name + SEGMENT_SUFFIX), 'rb') as f:
+            for offset in offsets:
+                f.seek(offset)
+                yield json.loads(f.readline())
@@ -0,0 +1,174 @@
+"""
+Simulation lifecycle tracking and clean shutdown.
+
+``SimulationLifecycle`` is subscribed to the ``simulation_log_topic`` of the
+simulation and follows the ``processStatus`` the platform reports.  The main
+thread blocks on it until the simulation completes, stops or fails (or the
+process receives SIGTERM/SIGINT) and then drains every registered buffer
+within a shared deadline before the application exits.
+
+It is subscribed before the model is discovered so a status reported during
+discovery is not missed.  Should the final status still never arrive (a log
+message dropped by the broker, a platform that died), ``wait`` gives up once
+nothing was heard from the simulation for ``idle_timeout`` seconds; the
+output subscription reports every message with ``seen``.
+"""
+
+import json
+import logging
+import signal
+import threading
+import time
+
+_log = logging.getLogger(__name__)
+
+DEFAULT_DRAIN_TIMEOUT = 30.0
+DEFAULT_IDLE_TIMEOUT = 300.0
+
+RUNNING = 'RUNNING'
+PAUSED = 'PAUSED'
+COMPLETE = 'COMPLETE'
+STOPPED = 'STOPPED'
+ERROR = 'ERROR'
+# reason of a simulation given up on by ``wait``
+IDLE = 'IDLE'
+
+# Statuses after which no more simulation output will arrive
+FINAL_STATUSES = (COMPLETE, STOPPED, ERROR)
+
+
+class SimulationLifecycle(object):
+    """ Follow the status of a simulation and coordinate the shutdown of the app
+
+    The object should be used as a callback from a GridAPPSD object subscribed
+    to ``simulation_log_topic(simulation_id)``.
+    """
+
+    def __init__(self, simulation_id=None, idle_timeout=None):
+        """ Create a ``SimulationLifecycle``
+
+        Parameters
+        ----------
+        simulation_id: str
+            Log messages of other processes are ignored.
+        idle_timeout: float
+            Seconds without output or log messages after which ``wait``
+            considers the simulation over, never when None or 0.  A paused
+            simulation is waited for indefinitely.
+        """
+        self._simulation_id = simulation_id
+        self._idle_timeout = idle_timeout or None
+        self._last_seen = time.monotonic()
+        self._finished = threading.Event()
+        self._drainers = []
+        self.status = None
+        self.reason = None
+
+    def on_message(self, headers, message):
+        """ Handle a log message of the simulation and update its status """
+        if isinstance(message, str):
+            try:
+                message = json.loads(message)
+            except ValueError:
+                return
+        if not isinstance(message, dict):
+            return
+        if self._simulation_id is not None and 'processId' in message \
+                and str(message['processId']) != str(self._simulation_id):
+            return
+        self.seen()
+
+        # older platform builds spell the key with a single 's'
+        status = message.get('processStatus', message.get('procesStatus'))
+        if not status or status == self.status:
+            return
+        self.status = status
+        _log.info("Simulation status changed to {}".format(status))
+        if status == PAUSED:
+            print("Simulation paused")
+        elif status in FINAL_STATUSES:
+            self.finish(status, message.get('logMessage'))
+
+    def seen(self, *args):
+        """ Note that the simulation is alive, usable as an output tap of any signature """
+        self._last_seen = time.monotonic()
+
+    def finish(self, reason, detail=None):
+        """ Release ``wait`` so the application can drain and exit """
+        if self._finished.is_set():
+            return
+        self.reason = reason
+        if detail:
+            _log.info("Simulation finished ({}): {}".format(reason, detail))
+        self._finished.set()
+
+    @property
+    def finished(self):
+        return self._finished.is_set()
+
+    def install_signal_handlers(self):
+        """ Treat SIGTERM and SIGINT like the end of the simulation
+
+        Must be called from the main thread.
+        """
+        def _handler(signum, frame):
+            self.finish(signal.Signals(signum).name)
+        signal.signal(signal.SIGTERM, _handler)
+        signal.signal(signal.SIGINT, _handler)
+
+    def register(self, name, close):
+        """ Register a buffer to drain at shutdown
+
+        Parameters
+        ----------
+        name: str
+            Name used in log messages.
+        close: callable
+            Called with the remaining timeout in seconds, flushes and stops the
+            buffer and returns True when everything was written out in time.
+        """
+        self._drainers.append((name, close))
+
+    def wait(self, timeout=None):
+        """ Block until the simulation is over, returns False on timeout
+
+        The idle time only counts from the call, the app may have spent longer
+        than ``idle_timeout`` discovering the model.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        self.seen()
+        while True:
+            now = time.monotonic()
+            step = None if deadline is None else max(0.0, deadline - now)
+            if self._idle_timeout is not None:
+                idle = self._last_seen + self._idle_timeout - now
+                if idle <= 0 and self.status != PAUSED:
+                    _log.warning("Nothing heard from the simulation for {:.0f}s, giving up on it".format(
+                        now - self._last_seen))
+                    self.finish(IDLE)
+                    return True
+                idle = max(idle, 0.0) if self.status != PAUSED else self._idle_timeout
+                step = idle if step is None else min(step, idle)
+            if self._finished.wait(step):
+                return True
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+
+    def drain(self, timeout=DEFAULT_DRAIN_TIMEOUT):
+        """ Drain registered buffers in registration order within ``timeout`` seconds
+
+        Returns True when every buffer finished before the deadline.
+        """
+        deadline = time.monotonic() + timeout
+        clean = True
+        for name, close in self._drainers:
+            remaining = max(0.0, deadline - time.monotonic())
+            try:
+                done = close(remaining)
+            except Exception:
+                _log.exception("Failed to drain {}".format(name))
+                done = False
+            if done is False:
+                _log.warning("{} was not drained before the deadline".format(name))
+                clean = False
+        return clean
@@ -0,0 +1,65 @@
+"""
+Small, thread safe latency statistics shared by the app components.
+"""
+
+import bisect
+import math
+import threading
+
+# Bucket upper bounds in seconds, roughly logarithmic from 1 ms to 10 minutes
+DEFAULT_BOUNDS = tuple(round(b * 10 ** e, 6) for e in range(-3, 3) for b in (1, 2, 5)) + (600.0,)
+
+
+class LatencyHistogram(object):
+    """ Fixed bucket histogram of latencies in seconds
+
+    Memory does not grow with the number of samples.  Percentiles are
+    interpolated inside the bucket that holds them.
+    """
+
+    def __init__(self, bounds=DEFAULT_BOUNDS):
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = math.inf
+        self.max = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, value):
+        with self._lock:
+            self.counts[bisect.bisect_left(self.bounds, value)] += 1
+            self.count += 1
+            self.total += value
+            self.min = min(self.min, value)
+            self.max = max(self.max, value)
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else math.nan
+
+    def percentile(self, p):
+        """ Approximate ``p``-th percentile (0-100), NaN without samples """
+        with self._lock:
+            if not self.count:
+                return math.nan
+            rank = p / 100.0 * self.count
+            seen = 0
+            for i, n in enumerate(self.counts):
+                if n and seen + n >= rank:
+                    low = self.bounds[i - 1] if i > 0 else 0.0
+                    high = self.bounds[i] if i < len(self.bounds) else self.max
+                    low, high = max(low, self.min), min(high, self.max)
+                    return low + (high - low) * (rank - seen) / n
+                seen += n
+            return self.max
+
+    def summary(self):
+        """ Dictionary of the usual statistics, suitable for logging or JSON """
+        return dict(count=self.count, mean=self.mean, min=self.min if self.count else math.nan,
+                    p50=self.percentile(50), p90=self.percentile(90), p99=self.percentile(99),
+                    max=self.max if self.count else math.nan)
+
+    def __repr__(self):
+        s = self.summary()
+        return "LatencyHistogram(count={count}, p50={p50:.3f}, p99={p99:.3f}, max={max:.3f})".format(**s)
@@ -0,0 +1,202 @@
+"""
+Splitting the PNV analysis of a feeder across several app instances.
+
+Every instance runs against the same simulation and takes a disjoint shard
+of the PNV measurements, chosen by ``--shard_key``:
+
+``bus``
+    Buses are spread by a stable hash of their name, all phases of a bus
+    stay together so per-bus aggregation still works.
+``phase``
+    Phases A, B, C (and secondaries) are spread over the shards.
+``equipment``
+    ACLineSegments are spread by a stable hash of their mRID.
+
+The shard index is given explicitly or claimed through lock files in a
+directory shared by the instances: the first instance to lock
+``shard_<i>.lock`` owns shard ``i`` for as long as it runs.  Each instance
+publishes the results of its shard on the partial results topic of the
+simulation and the instance of shard 0 merges them, per timestep, once all
+shards reported or after ``max_wait`` newer timesteps.
+"""
+
+import fcntl
+import json
+import logging
+import os
+import threading
+import zlib
+
+_log = logging.getLogger(__name__)
+
+SHARD_KEYS = ('bus', 'phase', 'equipment')
+MERGER = 0
+DEFAULT_MAX_WAIT = 2
+
+PHASE_ORDER = ('A', 'B', 'C', 's1', 's2')
+
+
+def partial_results_topic(simulation_id):
+    """ Topic the instances publish the results of their shard on """
+    return "/topic/goss.gridappsd.simulation.nodal_voltage.{}.partial".format(simulation_id)
+
+
+def _stable_hash(text):
+    return zlib.crc32(text.encode('utf-8'))
+
+
+def shard_of(measurement, key, count):
+    """ Shard of a PNV measurement description """
+    if key == 'bus':
+        return _stable_hash(measurement['bus'].upper()) % count
+    if key == 'phase':
+        phase = measurement['phases']
+        index = PHASE_ORDER.index(phase) if phase in PHASE_ORDER else _stable_hash(phase)
+        return index % count
+    if key == 'equipment':
+        return _stable_hash(measurement['eqid']) % count
+    raise ValueError("Unknown shard key '{}', expected one of {}".format(key, SHARD_KEYS))
+
+
+def select_shard(measurements, key, index, count):
+    """ The measurements of shard ``index`` out of ``count`` """
+    if count <= 1:
+        return list(measurements)
+    return [d for d in measurements if shard_of(d, key, count) == index]
+
+
+class ShardLock(object):
+    """ Claim the first free shard through lock files in a shared directory """
+
+    def __init__(self, directory, count):
+        self._file = None
+        self.index = None
+        os.makedirs(directory, exist_ok=True)
+        for i in range(count):
+            f = open(os.path.join(directory, 'shard_{}.lock'.format(i)), 'a+')
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                f.close()
+                continue
+            f.seek(0)
+            f.truncate()
+            f.write(str(os.getpid()))
+            f.flush()
+            self._file = f
+            self.index = i
+            break
+        if self.index is None:
+            raise RuntimeError("All {} shards in {} are taken".format(count, directory))
+
+    def close(self, timeout=None):
+        fcntl.flock(self._file, fcntl.LOCK_UN)
+        self._file.close()
+        return True
+
+
+def merge(partials):
+    """ Combine the results of several shards
+
+    Counts are summed, bus lists are joined and dictionaries merged; the other
+    values are taken from the first shard that has them.
+    """
+    merged = {}
+    for values in partials:
+        for key, value in values.items():
+            if key not in merged:
+                merged[key] = json.loads(json.dumps(value))
+            elif key == 'violations':
+                for phase, counts in value.items():
+                    target = merged[key].setdefault(phase, {})
+                    for name, count in counts.items():
+                        target[name] = target.get(name, 0) + count
+            elif isinstance(value, list):
+                merged[key] = sorted(set(merged[key]) | set(value))
+            elif key == 'devices_near_violations':
+                for device, buses in value.items():
+                    merged[key][device] = sorted(set(merged[key].get(device, [])) | set(buses))
+            elif key == 'bands':
+                for phase, classes in value.items():
+                    target = merged[key].setdefault(phase, {})
+                    for name, buses in classes.items():
+                        target[name] = sorted(set(target.get(name, [])) | set(buses))
+            elif isinstance(value, dict):
+                merged[key].update(value)
+    return merged
+
+
+class PartialResultMerger(object):
+    """ Collect the partial results of every shard and merge them per timestep
+
+    The object should be subscribed to ``partial_results_topic(simulation_id)``
+    by the instance of shard 0.
+    """
+
+    def __init__(self, count, on_merged, max_wait=DEFAULT_MAX_WAIT):
+        """ Create a ``PartialResultMerger``
+
+        Parameters
+        ----------
+        count: int
+            Number of shards.
+        on_merged: callable
+            Called with ``(timestamp, merged, missing)`` for every timestep,
+            ``missing`` lists the shards that did not report in time.
+        max_wait: int
+            Newer timesteps seen before an incomplete timestep is merged anyway.
+        """
+        self._count = count
+        self._on_merged = on_merged
+        self._max_wait = max_wait
+        self._lock = threading.Lock()
+        self._timesteps = {}
+        self.merged = 0
+        self.incomplete = 0
+
+    def add(self, timestamp, shard, values):
+        """ Results of ``shard`` for ``timestamp`` """
+        ready = []
+        with self._lock:
+            self._timesteps.setdefault(timestamp, {})[shard] = values
+            for ts in sorted(self._timesteps):
+                partials = self._timesteps[ts]
+                newer = sum(1 for other in self._timesteps if other > ts)
+                if len(partials) == self._count or newer >= self._max_wait:
+                    ready.append((ts, self._timesteps.pop(ts)))
+        for ts, partials in ready:
+            missing = [i for i in range(self._count) if i not in partials]
+            if missing:
+                self.incomplete += 1
+                _log.warning("Timestep {} merged without shards {}".format(ts, missing))
+            self.merged += 1
+            self._on_merged(ts, merge(partials[i] for i in sorted(partials)), missing)
+
+    def on_message(self, headers, message):
+        if isinstance(message, str):
+            message = json.loads(message)
+        self.add(message['timestamp'], int(message['shard']), message['values'])
+
+    def close(self, timeout=None):
+        """ Merge whatever is left """
+        with self._lock:
+            left = sorted(self._timesteps.items())
+            self._timesteps = {}
+        for ts, partials in left:
+            missing = [i for i in range(self._count) if i not in partials]
+            self.incomplete += 1
+            self.merged += 1
+            self._on_merged(ts, merge(partials[i] for i in sorted(partials)), missing)
+        _log.info("Merged {} timesteps, {} incomplete".format(self.merged, self.incomplete))
+        return True
+
+
+class PartialResultSender(object):
+    """ Publish the results of the shard of a non-merging instance """
+
+    def __init__(self, gapps, topic):
+        self._gapps = gapps
+        self._topic = topic
+
+    def add(self, timestamp, shard, values):
+        self._gapps.send(self._topic, json.dumps(dict(timestamp=timestamp, shard=shard, values=values)))
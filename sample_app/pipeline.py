@@ -0,0 +1,230 @@
+"""
+Stage pipeline for handling simulation output messages.
+
+A ``Pipeline`` decodes the measurement groups of every timestep (PNV, switch
+``Pos``, regulator ``Pos``...) into arrays with one ``MeasurementDecoder`` and
+runs its registered stages in order.  Each stage declares the measurement
+groups it reads and is skipped when none of them changed since the previous
+timestep; its earlier results stay available to the stages after it.
+Results a stage declares as ``events`` (rules fired, commands sent) only
+describe the timestep it ran in and are cleared at the start of every
+timestep.  Stages that declare no input run on every timestep.  Which
+stages run is chosen per deployment by name.
+
+With ``workers`` set, the stages are scheduled as a dependency graph built
+from their ``requires``/``provides`` declarations: stages of the same wave do
+not depend on each other and run concurrently on a thread pool, and a wave
+is joined before the next one starts.  This is opt-in: the stages are short
+NumPy operations, and handing them to threads only pays off when several
+heavy stages share a wave on a machine with idle cores.  Measure with the
+``timings`` of both modes before turning it on.  ``exclusive`` stages, the ones that publish commands or
+talk to the operator, always run alone after everything registered before
+them, so the control step sees a complete and deterministic set of results.
+"""
+
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from decoder import FIELDS, MeasurementDecoder
+
+_log = logging.getLogger(__name__)
+
+
+class Stage(object):
+    """ Base class of a pipeline stage
+
+    Subclasses set ``name`` and ``inputs`` (measurement group names) and
+    implement ``run``.  ``requires``/``provides`` name the result keys the
+    stage reads and writes, ``events`` those of its results that do not carry
+    over to the next timestep.  ``exclusive`` stages never run concurrently
+    with another stage.
+    """
+
+    name = None
+    inputs = ()
+    requires = ()
+    provides = ()
+    events = ()
+    exclusive = False
+
+    def run(self, context):
+        raise NotImplementedError()
+
+
+class GroupValues(object):
+    """ Decoded values of one measurement group for one timestep """
+
+    __slots__ = ('measids', 'magnitude', 'angle', 'value', 'present')
+
+    def __init__(self, measids, values, present):
+        self.measids = measids
+        self.magnitude = values['magnitude']
+        self.angle = values['angle']
+        self.value = values['value']
+        self.present = present
+
+    def same_as(self, other):
+        return other is not None and all(
+            np.array_equal(getattr(self, f), getattr(other, f), equal_nan=True) for f in FIELDS)
+
+
+class TimestepContext(object):
+    """ What the stages of one timestep share """
+
+    def __init__(self, timestamp, measurements, results):
+        self.timestamp = timestamp
+        self.measurements = measurements
+        self.values = None
+        self.present = None
+        self.groups = {}
+        self.changed = set()
+        self.results = results
+        self.ran = []
+        self.skipped = []
+
+
+class Pipeline(object):
+    """ Decode measurement groups and run the enabled stages on each timestep """
+
+    def __init__(self, groups, stages=(), enabled=None, workers=0):
+        """ Create a ``Pipeline``
+
+        Parameters
+        ----------
+        groups: dict
+            Measurement group name to the list of measids in the group.
+        stages: list(Stage)
+            Stages in execution order.
+        enabled: list(str)
+            Names of the stages to run, all of them when None.
+        workers: int
+            Threads running independent stages concurrently, sequential when
+            less than 2.
+        """
+        self._groups = {name: list(measids) for name, measids in groups.items()}
+        every = list(dict.fromkeys(measid for measids in self._groups.values() for measid in measids))
+        self.decoder = MeasurementDecoder(every)
+        self._group_slots = {name: self.decoder.slot_of(measids) for name, measids in self._groups.items()}
+        self._enabled = set(enabled) if enabled is not None else None
+        self._stages = []
+        self._waves = []
+        self._events = set()
+        self._previous = {}
+        self.results = {}
+        self.timings = {}
+        self._threads = None
+        if workers and workers > 1:
+            self._threads = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='pipeline')
+        for stage in stages:
+            self.register(stage)
+
+    def register(self, stage):
+        if self._enabled is not None and stage.name not in self._enabled:
+            _log.info("Stage {} is disabled".format(stage.name))
+            return
+        unknown = set(stage.inputs) - set(self._groups)
+        if unknown:
+            raise ValueError("Stage {} reads unknown measurement groups {}".format(stage.name, unknown))
+        self._stages.append(stage)
+        self._events.update(stage.events)
+        self._waves = self._plan(self._stages)
+
+    @property
+    def stages(self):
+        return [stage.name for stage in self._stages]
+
+    @property
+    def waves(self):
+        """ Names of the stages of every wave, in execution order """
+        return [[stage.name for stage in wave] for wave in self._waves]
+
+    @staticmethod
+    def _plan(stages):
+        """ Group stages into waves whose members only depend on earlier waves """
+        waves = []
+        wave_of = {}
+        floor = 0
+        for i, stage in enumerate(stages):
+            if stage.exclusive:
+                level = len(waves)
+                waves.append([stage])
+                floor = level + 1
+            else:
+                deps = [wave_of[j] for j, other in enumerate(stages[:i])
+                        if set(stage.requires) & set(other.provides)]
+                level = max([floor] + [d + 1 for d in deps])
+                # never join a wave that holds an exclusive stage
+                while level < len(waves) and waves[level][0].exclusive:
+                    level += 1
+                if level == len(waves):
+                    waves.append([])
+                waves[level].append(stage)
+            wave_of[i] = level
+        return waves
+
+    def decode(self, measurements):
+        """ Values of every measurement group in group order """
+        return self._group_values(*self.decoder.decode(measurements))
+
+    def _group_values(self, values, present):
+        return {name: GroupValues(self._groups[name], values[slots], present[slots])
+                for name, slots in self._group_slots.items()}
+
+    def should_run(self, stage, context):
+        return not stage.inputs or bool(context.changed.intersection(stage.inputs))
+
+    def run(self, timestamp, measurements):
+        """ Run one timestep through the pipeline and return its ``TimestepContext`` """
+        self.decoder.decode(measurements)
+        return self._run(timestamp, measurements)
+
+    def run_decoded(self, timestamp, values, present, measurements=None):
+        """ Run a timestep already decoded in the slot order of ``decoder``
+
+        ``measurements`` is what stages reading the raw message get, it may
+        only hold part of the timestep.
+        """
+        self.decoder.load(values, present)
+        return self._run(timestamp, measurements if measurements is not None else {})
+
+    def _run(self, timestamp, measurements):
+        for key in self._events:
+            self.results.pop(key, None)
+        context = TimestepContext(timestamp, measurements, self.results)
+        context.values, context.present = self.decoder.values, self.decoder.present
+        context.groups = self._group_values(context.values, context.present)
+        context.changed = {name for name, values in context.groups.items()
+                           if not values.same_as(self._previous.get(name))}
+        self._previous = context.groups
+
+        for wave in self._waves:
+            runnable = []
+            for stage in wave:
+                if self.should_run(stage, context):
+                    runnable.append(stage)
+                else:
+                    context.skipped.append(stage.name)
+            if self._threads is None or len(runnable) < 2:
+                for stage in runnable:
+                    self._run_stage(stage, context)
+            else:
+                futures = [self._threads.submit(self._run_stage, stage, context) for stage in runnable]
+                # join in registration order so errors and timings are reported deterministically
+                for future in futures:
+                    future.result()
+            context.ran.extend(stage.name for stage in runnable)
+        return context
+
+    def _run_stage(self, stage, context):
+        start = time.perf_counter()
+        stage.run(context)
+        self.timings[stage.name] = time.perf_counter() - start
+
+    def close(self, timeout=None):
+        """ Stop the worker threads """
+        if self._threads is not None:
+            self._threads.shutdown(wait=True)
+        return True
@@ -0,0 +1,168 @@
+"""
+On-demand profiling of the simulation output handler.
+
+``TimestepProfiler`` wraps the handler of the simulation output and stays
+idle until it is armed, by SIGUSR1 or by a ``{"command": "profile",
+"timesteps": N}`` message on the control topic of the application.  The next
+N timesteps are then run under ``cProfile`` while a sampling thread records
+the stack of the handler thread.  Each capture writes to ``output_dir``:
+
+``profile_<timestamp>.pstats``
+    ``cProfile`` statistics, for ``pstats``/``snakeviz``.
+``profile_<timestamp>.txt``
+    The functions of the ``on_message`` path sorted by cumulative time.
+``profile_<timestamp>.collapsed``
+    Sampled stacks in the collapsed format of ``flamegraph.pl`` and speedscope.
+"""
+
+import collections
+import cProfile
+import io
+import json
+import logging
+import os
+import pstats
+import signal
+import sys
+import threading
+import time
+
+_log = logging.getLogger(__name__)
+
+DEFAULT_TIMESTEPS = 10
+DEFAULT_SAMPLE_INTERVAL = 0.005
+
+
+def profiler_control_topic(simulation_id):
+    """ Private topic accepting profiling commands for the app of a simulation """
+    return "/topic/goss.gridappsd.simulation.nodal_voltage.{}.control".format(simulation_id)
+
+
+class TimestepProfiler(object):
+    """ Profile a number of timesteps of an ``on_message`` handler when asked to
+
+    The object should be used in place of the handler it wraps.
+    """
+
+    def __init__(self, handler, output_dir, default_timesteps=DEFAULT_TIMESTEPS,
+                 sample_interval=DEFAULT_SAMPLE_INTERVAL):
+        """ Create a ``TimestepProfiler``
+
+        Parameters
+        ----------
+        handler: object
+            Object with an ``on_message(headers, message)`` method.
+        output_dir: str
+            Directory the captures are written to.
+        default_timesteps: int
+            Timesteps profiled when a request does not say how many.
+        sample_interval: float
+            Seconds between two stack samples of the handler thread.
+        """
+        self._handler = handler
+        self._output_dir = output_dir
+        self._default_timesteps = default_timesteps
+        self._interval = sample_interval
+        self._requested = 0
+        self._remaining = 0
+        self._profile = None
+        self._samples = None
+        self._sampling = threading.Event()
+        self._sampler = None
+        self._thread_id = None
+        self.captures = []
+
+    def request(self, timesteps=None):
+        """ Profile the next ``timesteps`` timesteps, safe to call from any thread or a signal handler """
+        self._requested = int(timesteps or self._default_timesteps)
+
+    def install_signal_handler(self, signum=signal.SIGUSR1):
+        """ Arm the profiler on ``signum``, must be called from the main thread """
+        def _handler(signum, frame):
+            self.request()
+        signal.signal(signum, _handler)
+
+    def on_control(self, headers, message):
+        """ Handle a message of the control topic """
+        if isinstance(message, str):
+            try:
+                message = json.loads(message)
+            except ValueError:
+                return
+        if isinstance(message, dict) and message.get('command') == 'profile':
+            self.request(message.get('timesteps'))
+
+    def on_message(self, headers, message):
+        if not self._remaining and self._requested:
+            self._start(self._requested)
+            self._requested = 0
+        if not self._remaining:
+            return self._handler.on_message(headers, message)
+
+        self._sampling.set()
+        self._profile.enable()
+        try:
+            return self._handler.on_message(headers, message)
+        finally:
+            self._profile.disable()
+            self._sampling.clear()
+            self._remaining -= 1
+            if not self._remaining:
+                self._stop()
+
+    def close(self, timeout=None):
+        """ Write out a capture still in progress """
+        if self._remaining:
+            self._remaining = 0
+            self._stop()
+        return True
+
+    def _start(self, timesteps):
+        _log.info("Profiling the next {} timesteps".format(timesteps))
+        self._remaining = timesteps
+        self._profile = cProfile.Profile()
+        self._samples = collections.Counter()
+        self._thread_id = threading.get_ident()
+        self._sampler = threading.Thread(target=self._sample, args=(self._samples,), name='profiler-sampler',
+                                         daemon=True)
+        self._sampler.start()
+
+    def _sample(self, samples):
+        thread_id = self._thread_id
+        own = threading.get_ident()
+        while self._sampler is not None and self._sampler.ident == own:
+            if not self._sampling.wait(0.1):
+                continue
+            frame = sys._current_frames().get(thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append("{} ({}:{})".format(code.co_name, os.path.basename(code.co_filename),
+                                                 code.co_firstlineno))
+                frame = frame.f_back
+            if stack:
+                samples[';'.join(reversed(stack))] += 1
+            time.sleep(self._interval)
+
+    def _stop(self):
+        sampler, self._sampler = self._sampler, None
+        sampler.join(1.0)
+        os.makedirs(self._output_dir, exist_ok=True)
+        base = os.path.join(self._output_dir, "profile_{}_{}".format(time.strftime('%Y%m%dT%H%M%S'),
+                                                                     len(self.captures)))
+
+        self._profile.dump_stats(base + '.pstats')
+        report = io.StringIO()
+        stats = pstats.Stats(self._profile, stream=report)
+        stats.sort_stats('cumulative').print_stats(50)
+        with open(base + '.txt', 'w') as f:
+            f.write(report.getvalue())
+        with open(base + '.collapsed', 'w') as f:
+            for stack, count in sorted(self._samples.items()):
+                f.write("{} {}\n".format(stack, count))
+
+        self.captures.append(base)
+        _log.info("Profile written to {}.{{pstats,txt,collapsed}} ({} stack samples)".format(
+            base, sum(self._samples.values())))
+        self._profile = None
+        self._samples = None
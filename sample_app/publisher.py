@@ -0,0 +1,218 @@
+"""
+Rate limited publishing of the analytics results of the app.
+
+``AnalyticsPublisher`` takes the results of every timestep without blocking
+and publishes them from a background thread at most ``max_rate`` times a
+second; timesteps produced in between are coalesced, only the latest one is
+sent.  Results are flattened to dotted keys and only the keys that changed
+since the previous message are sent, with a full message every
+``keyframe_interval`` messages so late subscribers can catch up.  The keys
+under ``set_keys`` hold sets of names (the buses of a voltage band, the open
+switches...): a delta only carries the members added to or removed from
+them::
+
+    {"timestamp": 1590000000, "sequence": 12, "type": "delta",
+     "changed": {"violations.A.below_b": 3}, "removed": ["fired_rules"],
+     "members": {"bands.A.below_b": {"added": ["671"], "removed": ["652"]}}}
+
+``decode`` only applies a delta to the state of the message right before
+it; after a gap in the sequence numbers it waits for the next full message.
+
+With ``compress`` the JSON document is zlib compressed and base64 encoded
+into ``payload`` next to the ``timestamp``, ``sequence`` and ``encoding`` keys.
+"""
+
+import base64
+import json
+import logging
+import threading
+import time
+import zlib
+
+_log = logging.getLogger(__name__)
+
+DEFAULT_MAX_RATE = 1.0
+DEFAULT_KEYFRAME_INTERVAL = 30
+
+FULL = 'full'
+DELTA = 'delta'
+
+# keys, and the keys below them, whose values are sets of names
+DEFAULT_SET_KEYS = ('bands', 'open_switches', 'anomalous_buses', 'unbalanced_buses', 'devices_near_violations')
+
+
+def analytics_output_topic(simulation_id):
+    """ Topic the analytics results of the app are published on by default """
+    return "/topic/goss.gridappsd.simulation.nodal_voltage.{}.output".format(simulation_id)
+
+
+def flatten(values, prefix=''):
+    """ Nested dictionaries as a single level dictionary with dotted keys """
+    flat = {}
+    for key, value in values.items():
+        name = '{}{}'.format(prefix, key)
+        if isinstance(value, dict) and value:
+            flat.update(flatten(value, name + '.'))
+        else:
+            flat[name] = value
+    return flat
+
+
+def _is_set_key(key, set_keys):
+    return any(key == name or key.startswith(name + '.') for name in set_keys)
+
+
+class AnalyticsState(dict):
+    """ Flat results rebuilt by ``decode``, with the position of the message they are at """
+
+    def __init__(self, values, sequence, timestamp):
+        super(AnalyticsState, self).__init__(values)
+        self.sequence = sequence
+        self.timestamp = timestamp
+
+
+class AnalyticsPublisher(object):
+    """ Publish per-timestep results as rate limited deltas """
+
+    def __init__(self, gapps, topic, max_rate=DEFAULT_MAX_RATE, compress=False,
+                 keyframe_interval=DEFAULT_KEYFRAME_INTERVAL, set_keys=DEFAULT_SET_KEYS):
+        """ Create an ``AnalyticsPublisher`` and start its thread
+
+        Parameters
+        ----------
+        gapps: GridAPPSD
+            Connection used to send the messages.
+        topic: str
+            Topic the results are published on.
+        max_rate: float
+            Messages per second at most, 0 publishes every timestep.
+        compress: bool
+            Send zlib compressed, base64 encoded payloads.
+        keyframe_interval: int
+            Every this many messages all keys are sent, not only those that
+            changed.
+        set_keys: tuple(str)
+            Keys holding lists of names, sent as added and removed members.
+        """
+        self._gapps = gapps
+        self.topic = topic
+        self._interval = 1.0 / max_rate if max_rate else 0.0
+        self._compress = compress
+        self._keyframe_interval = max(1, int(keyframe_interval))
+        self._set_keys = tuple(set_keys)
+        self._condition = threading.Condition()
+        self._pending = None
+        self._closing = False
+        self._last = {}
+        self.sequence = 0
+        self.published = 0
+        self.coalesced = 0
+        self.bytes_sent = 0
+
+        self._thread = threading.Thread(target=self._run, name='analytics-publisher', daemon=True)
+        self._thread.start()
+
+    def publish(self, timestamp, values):
+        """ Queue the results of a timestep, replacing any not yet sent
+
+        ``values`` must be JSON serializable and not modified afterwards.
+        """
+        with self._condition:
+            if self._pending is not None:
+                self.coalesced += 1
+            self._pending = (timestamp, values)
+            self._condition.notify()
+
+    def close(self, timeout=None):
+        """ Send what is still pending and stop the thread """
+        with self._condition:
+            self._closing = True
+            self._condition.notify()
+        self._thread.join(timeout)
+        _log.info("Analytics published {} messages ({} bytes), {} timesteps coalesced".format(
+            self.published, self.bytes_sent, self.coalesced))
+        return not self._thread.is_alive()
+
+    def encode(self, timestamp, values):
+        """ The message for ``values``, a delta against the previous one unless a keyframe is due """
+        flat = flatten(values)
+        for key, value in flat.items():
+            if isinstance(value, list) and _is_set_key(key, self._set_keys):
+                flat[key] = sorted(set(value))
+        if self.sequence % self._keyframe_interval == 0:
+            document = dict(timestamp=timestamp, sequence=self.sequence, type=FULL, values=flat)
+        else:
+            changed = {}
+            members = {}
+            for key, value in flat.items():
+                last = self._last.get(key)
+                if key in self._last and last == value:
+                    continue
+                if isinstance(value, list) and isinstance(last, list) and _is_set_key(key, self._set_keys):
+                    members[key] = dict(added=sorted(set(value) - set(last)), removed=sorted(set(last) - set(value)))
+                else:
+                    changed[key] = value
+            removed = [key for key in self._last if key not in flat]
+            document = dict(timestamp=timestamp, sequence=self.sequence, type=DELTA,
+                            changed=changed, removed=removed, members=members)
+        self._last = flat
+        self.sequence += 1
+
+        body = json.dumps(document, separators=(',', ':'))
+        if self._compress:
+            payload = base64.b64encode(zlib.compress(body.encode('utf-8'))).decode('ascii')
+            body = json.dumps(dict(timestamp=timestamp, sequence=document['sequence'],
+                                   encoding='zlib+base64', payload=payload))
+        return body
+
+    def _run(self):
+        next_send = 0.0
+        while True:
+            with self._condition:
+                while self._pending is None and not self._closing:
+                    self._condition.wait()
+                if self._pending is None:
+                    break
+                # a close sends the latest results right away
+                delay = next_send - time.monotonic()
+                if delay > 0 and not self._closing:
+                    self._condition.wait(delay)
+                    continue
+                timestamp, values = self._pending
+                self._pending = None
+            try:
+                body = self.encode(timestamp, values)
+                self._gapps.send(self.topic, body)
+                self.published += 1
+                self.bytes_sent += len(body)
+            except Exception:
+                _log.exception("Failed to publish analytics of timestep {}".format(timestamp))
+            next_send = time.monotonic() + self._interval
+
+
+def decode(message, state=None):
+    """ Rebuild the flat results from a published message
+
+    ``state`` is the ``AnalyticsState`` returned for the previous message,
+    deltas are applied to it.  Returns None for a delta received without a
+    state or after a gap in the sequence numbers: the results can only be
+    rebuilt again from the next full message.
+    """
+    if isinstance(message, str):
+        message = json.loads(message)
+    if message.get('encoding') == 'zlib+base64':
+        message = json.loads(zlib.decompress(base64.b64decode(message['payload'])).decode('utf-8'))
+    if message['type'] == FULL:
+        return AnalyticsState(message['values'], message['sequence'], message['timestamp'])
+    if state is None or getattr(state, 'sequence', None) != message['sequence'] - 1:
+        if state is not None:
+            _log.warning("Analytics message {} does not follow {}, waiting for a full message".format(
+                message['sequence'], getattr(state, 'sequence', None)))
+        return None
+    values = dict(state)
+    for key in message['removed']:
+        values.pop(key, None)
+    values.update(message['changed'])
+    for key, members in message.get('members', {}).items():
+        values[key] = sorted(set(values.get(key, ())).difference(members['removed']).union(members['added']))
+    return AnalyticsState(values, message['sequence'], message['timestamp'])
@@ -0,0 +1,277 @@
+"""
+Local query server of the running app.
+
+``QueryServer`` answers HTTP requests, over TCP on localhost or over a Unix
+socket, from the ``SnapshotStore`` of the app, so any number of clients can
+look at the latest processed timestep while the simulation goes on.  Every
+request is served on its own thread and only reads immutable snapshots.
+
+``GET`` endpoints, all answering JSON:
+
+``/status``
+    Version and timestamp of the latest snapshot, commands waiting.
+``/switches``
+    Names of the open switches.
+``/taps``
+    Tap step of every regulator phase.
+``/bands``
+    Count and buses of every ANSI range class per phase.
+``/buses?phase=A&min=..&max=..[&per_unit=1]``
+    Buses of one phase whose PNV is strictly between ``min`` and ``max``, in
+    volts unless ``per_unit`` is set.
+``/history?start=..&end=..``
+    Summary of the kept timesteps between two simulation timestamps.
+``/neighbourhood?bus=..&hops=..``
+    Hop distance of the buses around a bus, the switches and regulators
+    among them and those of its buses out of ANSI range A in the latest
+    snapshot.  Needs the ``TopologyIndex`` of the feeder.
+
+``POST /commands`` takes ``{"switch": name, "action": "open"|"close"}`` or
+``{"regulator": name, "step": position}``.  The command is checked and put in
+the ``CommandQueue``; the pipeline sends everything queued with the next
+timestep it processes, so the simulation never waits on an operator.
+"""
+
+import collections
+import itertools
+import json
+import logging
+import os
+import socketserver
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+
+from stages import summarize
+
+_log = logging.getLogger(__name__)
+
+DEFAULT_HOST = '127.0.0.1'
+
+SWITCH_ACTIONS = ('open', 'close')
+
+
+class CommandError(ValueError):
+    """ A command that names an unknown device or an invalid setting """
+
+
+class CommandQueue(object):
+    """ Switch and tap commands waiting for the next timestep
+
+    ``submit`` is called from the server threads and ``drain`` from the
+    pipeline; both only touch a deque, whose appends and pops are atomic.
+    """
+
+    def __init__(self, switches, regulators):
+        self._switches = {sw['name']: sw for sw in switches}
+        self._regulators = {reg['name']: reg for reg in regulators}
+        self._queue = collections.deque()
+        self._ids = itertools.count(1)
+
+    def __len__(self):
+        return len(self._queue)
+
+    def submit(self, command):
+        """ Check ``command`` and queue it, returns the queued command with its ``id`` """
+        if not isinstance(command, dict):
+            raise CommandError("A command is a JSON object")
+        if 'switch' in command:
+            if command['switch'] not in self._switches:
+                raise CommandError("Unknown switch {}".format(command['switch']))
+            if command.get('action') not in SWITCH_ACTIONS:
+                raise CommandError("Switch action must be one of {}".format(', '.join(SWITCH_ACTIONS)))
+            queued = dict(switch=command['switch'], action=command['action'],
+                          mrid=self._switches[command['switch']]['mrid'])
+        elif 'regulator' in command:
+            regulator = self._regulators.get(command['regulator'])
+            if regulator is None:
+                raise CommandError("Unknown regulator {}".format(command['regulator']))
+            try:
+                step = int(command.get('step'))
+            except (TypeError, ValueError):
+                raise CommandError("Regulator step must be an integer")
+            if not regulator['low_step'] <= step <= regulator['high_step']:
+                raise CommandError("Step of {} must be between {} and {}".format(
+                    regulator['name'], regulator['low_step'], regulator['high_step']))
+            queued = dict(regulator=regulator['name'], step=step, mrid=regulator['mrid'])
+        else:
+            raise CommandError("A command names a switch or a regulator")
+        queued['id'] = next(self._ids)
+        self._queue.append(queued)
+        return queued
+
+    def drain(self):
+        """ Take every queued command, oldest first """
+        commands = []
+        while True:
+            try:
+                commands.append(self._queue.popleft())
+            except IndexError:
+                return commands
+
+
+def _number(query, name):
+    try:
+        return float(query[name][0])
+    except (KeyError, IndexError, ValueError):
+        raise ValueError("Query parameter {} must be a number".format(name))
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        _log.debug("Query server: " + format % args)
+
+    def address_string(self):
+        # Unix socket clients have no address
+        return str(self.client_address[0]) if self.client_address else 'local'
+
+    def _reply(self, status, document):
+        body = json.dumps(document).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        try:
+            status, document = self.server.query.get(url.path, parse_qs(url.query))
+        except ValueError as e:
+            status, document = 400, dict(error=str(e))
+        except Exception:
+            _log.exception("Query {} failed".format(self.path))
+            status, document = 500, dict(error="internal error")
+        self._reply(status, document)
+
+    def do_POST(self):
+        if urlparse(self.path).path != '/commands':
+            self._reply(404, dict(error="unknown endpoint"))
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            queued = self.server.query.commands.submit(json.loads(self.rfile.read(length) or b'null'))
+        except ValueError as e:
+            self._reply(400, dict(error=str(e)))
+            return
+        self._reply(202, dict(queued=queued))
+
+
+class _UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class QueryServer(object):
+    """ Serve the snapshots of the app and take commands on a local socket """
+
+    def __init__(self, snapshots, commands, port=None, host=DEFAULT_HOST, path=None, topology=None):
+        """ Create a ``QueryServer`` and start serving
+
+        Parameters
+        ----------
+        snapshots: SnapshotStore
+            Results of the processed timesteps.
+        commands: CommandQueue
+            Where the posted commands go.
+        port: int
+            TCP port on ``host``, 0 picks a free one.  Ignored when ``path``
+            is given.
+        host: str
+            Address to bind, localhost by default.
+        path: str
+            Unix socket to listen on instead of TCP.
+        topology: TopologyIndex
+            Bus connectivity of the feeder, enables ``/neighbourhood``.
+        """
+        self.snapshots = snapshots
+        self.commands = commands
+        self.topology = topology
+        self._path = path
+        if path is not None:
+            if os.path.exists(path):
+                os.remove(path)
+            self._server = _UnixHTTPServer(path, _Handler)
+            self.address = path
+        else:
+            self._server = ThreadingHTTPServer((host, int(port or 0)), _Handler)
+            self.address = '{}:{}'.format(*self._server.server_address[:2])
+        self._server.query = self
+        self._thread = threading.Thread(target=self._server.serve_forever, name='query-server', daemon=True)
+        self._thread.start()
+        _log.info("Query server listening on {}".format(self.address))
+
+    def close(self, timeout=None):
+        """ Stop accepting requests """
+        self._server.shutdown()
+        self._server.server_close()
+        if self._path is not None and os.path.exists(self._path):
+            os.remove(self._path)
+        self._thread.join(timeout)
+        return not self._thread.is_alive()
+
+    def get(self, path, query):
+        """ ``(status, document)`` answering ``GET path?query`` """
+        if path == '/history':
+            start = _number(query, 'start') if 'start' in query else None
+            end = _number(query, 'end') if 'end' in query else None
+            return 200, [dict(summarize(snapshot.values), version=snapshot.version, timestamp=snapshot.timestamp)
+                         for snapshot in self.snapshots.history(start, end)]
+
+        snapshot = self.snapshots.latest
+        if path == '/neighbourhood':
+            return self._neighbourhood(snapshot, query)
+        if path == '/status':
+            return 200, dict(version=snapshot.version if snapshot else 0,
+                             timestamp=snapshot.timestamp if snapshot else None, queued_commands=len(self.commands))
+        if path not in ('/switches', '/taps', '/bands', '/buses'):
+            return 404, dict(error="unknown endpoint")
+        if snapshot is None:
+            return 503, dict(error="no timestep processed yet")
+
+        document = dict(version=snapshot.version, timestamp=snapshot.timestamp)
+        if path == '/switches':
+            document['open_switches'] = list(snapshot.get('open_switches', ()))
+        elif path == '/taps':
+            document['regulator_taps'] = dict(snapshot.get('regulator_taps', {}))
+        elif path == '/bands':
+            report = snapshot.get('violations')
+            if report is None:
+                return 503, dict(error="voltage bands are not evaluated")
+            document['counts'] = report.counts
+            document['buses'] = report.buses
+        else:
+            key = 'pnv_per_unit' if query.get('per_unit', ['0'])[0] not in ('0', 'false') else 'pnv_magnitude'
+            if key not in snapshot:
+                return 503, dict(error="PNV of the feeder is not evaluated")
+            phase = query.get('phase', [None])[0]
+            low, high = _number(query, 'min'), _number(query, 'max')
+            voltages = snapshot[key]
+            with np.errstate(invalid='ignore'):
+                selected = (voltages > low) & (voltages < high)
+            if phase is not None:
+                selected &= snapshot['pnv_phases'] == phase
+            document['buses'] = sorted(set(snapshot['pnv_buses'][selected].tolist()))
+        return 200, document
+
+    def _neighbourhood(self, snapshot, query):
+        if self.topology is None:
+            return 503, dict(error="the topology of the feeder is not indexed")
+        bus = query.get('bus', [''])[0].upper()
+        if bus not in self.topology.index:
+            return 404, dict(error="unknown bus {}".format(bus))
+        hops = int(_number(query, 'hops')) if 'hops' in query else self.topology.max_hops
+        buses, distance = self.topology.around(bus, hops)
+        reached = set(buses.tolist())
+        devices = [device for device in self.topology.devices
+                   if reached.intersection(self.topology.within(device, 0).tolist())]
+        document = dict(bus=bus, hops=hops, buses=dict(zip(buses.tolist(), distance.tolist())), devices=devices)
+        report = snapshot.get('violations') if snapshot is not None else None
+        if report is not None:
+            document['version'] = snapshot.version
+            document['timestamp'] = snapshot.timestamp
+            document['out_of_band'] = sorted(reached.intersection(
+                name for phase in report.buses.values() for names in phase.values() for name in names))
+        return 200, document
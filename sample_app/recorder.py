@@ -0,0 +1,271 @@
+"""
+Columnar recorder for the simulation output stream.
+
+Every timestep handed to ``MeasurementRecorder.record`` is queued as-is and
+decoded on a background writer thread into fixed-width NumPy columns, one
+column per measurement field (``magnitude``, ``angle``, ``value``) with one
+row per timestep and one column slot per measid.  Rows are accumulated into
+chunks and flushed as a segment directory of ``.npy`` files, so a finished
+recording can be opened with ``numpy.load(..., mmap_mode='r')`` without
+reading it into memory.  Compressed segments (``.npz``) are available as an
+option for archival at the cost of memory mapping.
+
+Layout on disk::
+
+    <output_dir>/index.json             measids and field names
+    <output_dir>/segment_00000/         timestamp.npy, present.npy,
+                                        magnitude.npy, angle.npy, value.npy
+    <output_dir>/segment_00001.npz      (compress=True)
+
+A recorder opened on a directory written before with the same measids and
+fields continues after its last segment, like the command journal does.
+"""
+
+import json
+import logging
+import os
+import queue
+import shutil
+import threading
+
+import numpy as np
+
+from decoder import FIELDS, MeasurementDecoder
+
+_log = logging.getLogger(__name__)
+
+DEFAULT_CHUNK_ROWS = 256
+DEFAULT_MAX_PENDING = 64
+
+SEGMENT_PREFIX = 'segment_'
+
+_STOP = object()
+
+
+class RecorderError(RuntimeError):
+    """ A segment could not be written, the timesteps it held are lost """
+
+
+def _segment_number(name):
+    return int(name[len(SEGMENT_PREFIX):].split('.')[0])
+
+
+class MeasurementRecorder(object):
+    """ Append decoded measurements to chunked, memory mappable column files
+
+    ``record`` only places a reference to the message on a bounded queue so the
+    cost paid inside ``on_message`` does not depend on the feeder size.  When
+    the writer falls behind by more than ``max_pending`` timesteps new frames
+    are dropped and counted in ``dropped`` rather than blocking the simulation
+    callback.
+    """
+
+    def __init__(self, output_dir, measids, chunk_rows=DEFAULT_CHUNK_ROWS,
+                 max_pending=DEFAULT_MAX_PENDING, compress=False):
+        """ Create a ``MeasurementRecorder`` and start its writer thread
+
+        Parameters
+        ----------
+        output_dir: str
+            Directory the segments are written to.  Created if missing.  A
+            directory recorded before must hold the same measids and fields.
+        measids: list(str)
+            The measurement mrids to record, in column order.
+        chunk_rows: int
+            Number of timesteps held in memory before a segment is flushed.
+        max_pending: int
+            Number of undecoded timesteps allowed to wait for the writer.
+        compress: bool
+            Write ``.npz`` compressed segments instead of plain ``.npy`` files.
+        """
+        self._output_dir = output_dir
+        self._measids = list(measids)
+        self._decoder = MeasurementDecoder(self._measids, buffers=1)
+        self._chunk_rows = int(chunk_rows)
+        self._compress = compress
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._segment = 0
+        self._rows = 0
+        self.recorded = 0
+        self.dropped = 0
+        self.lost = 0
+        self.error = None
+
+        width = len(self._measids)
+        self._timestamp = np.zeros(self._chunk_rows, dtype=np.int64)
+        self._present = np.zeros((self._chunk_rows, width), dtype=bool)
+        self._columns = {field: np.full((self._chunk_rows, width), np.nan)
+                         for field in FIELDS}
+
+        os.makedirs(output_dir, exist_ok=True)
+        self._open_directory()
+
+        self._thread = threading.Thread(target=self._run, name='measurement-recorder',
+                                        daemon=True)
+        self._thread.start()
+
+    def _open_directory(self):
+        index = dict(measids=self._measids, fields=list(FIELDS), compressed=self._compress)
+        path = os.path.join(self._output_dir, 'index.json')
+        if os.path.exists(path):
+            with open(path) as f:
+                previous = json.load(f)
+            if previous.get('measids') != index['measids'] or previous.get('fields') != index['fields']:
+                raise ValueError("{} holds a recording of other measurements".format(self._output_dir))
+            index['compressed'] = previous.get('compressed', False) or self._compress
+
+        segments = []
+        for name in os.listdir(self._output_dir):
+            if name.startswith('.' + SEGMENT_PREFIX):
+                # a segment whose flush was cut short by a crash
+                stale = os.path.join(self._output_dir, name)
+                if os.path.isdir(stale):
+                    shutil.rmtree(stale)
+                else:
+                    os.remove(stale)
+            elif name.startswith(SEGMENT_PREFIX):
+                segments.append(_segment_number(name))
+        self._segment = max(segments) + 1 if segments else 0
+        if segments:
+            _log.info("Recorder continues {} after segment {}".format(self._output_dir, self._segment - 1))
+
+        with open(path, 'w') as f:
+            json.dump(index, f)
+
+    def record(self, timestamp, measurements):
+        """ Queue one timestep for the writer thread, never blocking the caller
+
+        Parameters
+        ----------
+        timestamp: int
+            Simulation timestamp of the message.
+        measurements: dict
+            The ``measurements`` dictionary of the message keyed by measid.
+            It must not be modified by the caller afterwards.
+        """
+        try:
+            self._queue.put_nowait((timestamp, measurements))
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self, timeout=None):
+        """ Write out everything queued so far and stop the writer thread
+
+        Returns True when the writer finished within ``timeout`` seconds and
+        raises ``RecorderError`` when a segment could not be written.
+        """
+        if self._thread.is_alive():
+            self._queue.put(_STOP)
+            self._thread.join(timeout)
+        if self.dropped:
+            _log.warning("Recorder dropped {} timesteps".format(self.dropped))
+        if self.error is not None:
+            raise RecorderError("Recorder lost {} timesteps: {}".format(self.lost, self.error)) from self.error
+        return not self._thread.is_alive()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is _STOP:
+                break
+            try:
+                self._append(*item)
+            except Exception:
+                _log.exception("Failed to record timestep {}".format(item[0]))
+        if self._rows:
+            self._flush()
+
+    def _failed(self, error, rows):
+        # the chunk is given up so recording goes on, close() reports the loss
+        _log.exception("Recorder failed to write {} timesteps".format(rows))
+        if self.error is None:
+            self.error = error
+        self.lost += rows
+        self.recorded -= rows
+        self._rows = 0
+
+    def _append(self, timestamp, measurements):
+        row = self._rows
+        values, present = self._decoder.decode(measurements)
+        self._present[row] = present
+        for field in FIELDS:
+            self._columns[field][row] = values[field]
+        self._timestamp[row] = timestamp
+        self._rows += 1
+        self.recorded += 1
+        if self._rows == self._chunk_rows:
+            self._flush()
+
+    def _flush(self):
+        try:
+            self._write_segment()
+        except Exception as e:
+            self._failed(e, self._rows)
+
+    def _write_segment(self):
+        rows = self._rows
+        arrays = dict(timestamp=self._timestamp[:rows], present=self._present[:rows])
+        for field in FIELDS:
+            arrays[field] = self._columns[field][:rows]
+
+        name = 'segment_{:05d}'.format(self._segment)
+        if self._compress:
+            tmp = os.path.join(self._output_dir, '.' + name + '.npz')
+            np.savez_compressed(tmp, **arrays)
+            os.replace(tmp, os.path.join(self._output_dir, name + '.npz'))
+        else:
+            # Write into a hidden directory first so readers never see a partial segment
+            tmp = os.path.join(self._output_dir, '.' + name)
+            os.makedirs(tmp, exist_ok=True)
+            for key, array in arrays.items():
+                np.save(os.path.join(tmp, key + '.npy'), array)
+            os.replace(tmp, os.path.join(self._output_dir, name))
+        _log.debug("Recorder wrote {} with {} timesteps".format(name, rows))
+        self._segment += 1
+        self._rows = 0
+
+
+class RecordingReader(object):
+    """ Read back a directory written by ``MeasurementRecorder``
+
+    Plain segments are memory mapped, so selecting a few measids over a long
+    recording only touches the pages that hold them.
+    """
+
+    def __init__(self, output_dir):
+        self._output_dir = output_dir
+        with open(os.path.join(output_dir, 'index.json')) as f:
+            index = json.load(f)
+        self.measids = index['measids']
+        self.fields = index['fields']
+        self._slots = {measid: i for i, measid in enumerate(self.measids)}
+
+    def slots(self, measids):
+        """ Column positions of ``measids`` in the recorded arrays """
+        return np.array([self._slots[measid] for measid in measids], dtype=np.intp)
+
+    def segments(self):
+        """ Yield a dictionary of arrays per segment in recording order """
+        names = sorted((name for name in os.listdir(self._output_dir) if name.startswith(SEGMENT_PREFIX)),
+                       key=_segment_number)
+        for name in names:
+            path = os.path.join(self._output_dir, name)
+            if name.endswith('.npz'):
+                with np.load(path) as data:
+                    yield {key: data[key] for key in data.files}
+            else:
+                yield {key[:-4]: np.load(os.path.join(path, key), mmap_mode='r')
+                       for key in os.listdir(path)}
+
+    def column(self, field, measids=None):
+        """ Concatenate one field over all segments as a (timesteps, measids) array """
+        cols = None if measids is None else self.slots(measids)
+        parts = []
+        for segment in self.segments():
+            data = segment[field]
+            parts.append(data if cols is None or data.ndim == 1 else data[:, cols])
+        if not parts:
+            if field in ('timestamp',):
+                return np.empty(0, dtype=np.int64)
+            return np.empty((0, len(self.measids) if cols is None else len(cols)))
+        return np.concatenate(parts)
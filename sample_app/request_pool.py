@@ -0,0 +1,129 @@
+"""
+Pooled request/response channels for platform queries.
+
+``GridAPPSD.get_response`` shares the connection that carries the simulation
+subscriptions and polls for its answer once a second.  The pool keeps its own
+connections, separate from the subscription connection, and sends every
+request with the public ``get_response`` of one of them.  That call picks its
+reply destination from the time the request is sent, so two requests waiting
+on the same connection could take each other's answers: a channel has at most
+one request in flight and requests run concurrently on separate channels.
+Nothing ever guesses which request a response belongs to.
+
+The pool has the ``get_response``/``query_data`` methods of ``GridAPPSD`` so
+it can be passed anywhere a connection is used for queries.  A request waits
+for an idle channel at most its own ``timeout`` and gets what is left of it
+to wait for the answer, so no request holds a channel longer than it was
+given.
+"""
+
+import json
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+_log = logging.getLogger(__name__)
+
+DEFAULT_POOL_SIZE = 4
+
+REQUEST_POWERGRID_DATA = "goss.gridappsd.process.request.data.powergridmodel"
+
+
+class RequestTimeout(Exception):
+    """ Raised when the platform does not answer a request in time """
+
+
+class RequestChannel(object):
+    """ One platform connection dedicated to request/response traffic """
+
+    def __init__(self, gapps):
+        self._gapps = gapps
+        self._busy = threading.Lock()
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self.completed = 0
+
+    def get_response(self, topic, message, timeout=5):
+        """ Send ``message`` to ``topic`` and wait up to ``timeout`` seconds for the answer """
+        if isinstance(message, str):
+            message = json.loads(message)
+        with self._lock:
+            self.in_flight += 1
+        try:
+            with self._busy:
+                response = self._gapps.get_response(topic, json.dumps(message), timeout=timeout)
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+                self.completed += 1
+        if response is None:
+            raise RequestTimeout("No response to request on {} within {}s".format(topic, timeout))
+        return response
+
+    def query_data(self, query, timeout=30):
+        """ Run a SPARQL query against the powergrid model, like ``GridAPPSD.query_data`` """
+        payload = dict(requestType="QUERY", resultFormat="JSON", queryString=query)
+        return self.get_response(REQUEST_POWERGRID_DATA, payload, timeout=timeout)
+
+    def close(self):
+        self._gapps.disconnect()
+
+
+class RequestChannelPool(object):
+    """ A set of ``RequestChannel``, every request takes an idle one and waits for it if there is none """
+
+    def __init__(self, connect, size=DEFAULT_POOL_SIZE):
+        """ Create a ``RequestChannelPool``
+
+        Parameters
+        ----------
+        connect: callable
+            Returns a new connected ``GridAPPSD`` object, called once per channel.
+        size: int
+            Number of channels (connections) in the pool, which is the number
+            of requests waiting for an answer at a time.
+        """
+        self._channels = [RequestChannel(connect()) for _ in range(size)]
+        self._idle = queue.Queue()
+        for channel in self._channels:
+            self._idle.put(channel)
+        self._executor = ThreadPoolExecutor(max_workers=size, thread_name_prefix='request-pool')
+
+    @property
+    def idle(self):
+        """ Number of channels not waiting for an answer """
+        return self._idle.qsize()
+
+    def _call(self, method, *args, timeout):
+        start = time.monotonic()
+        try:
+            channel = self._idle.get(timeout=timeout)
+        except queue.Empty:
+            raise RequestTimeout("No request channel became idle within {}s".format(timeout))
+        try:
+            remaining = max(0.0, timeout - (time.monotonic() - start))
+            return getattr(channel, method)(*args, timeout=remaining)
+        finally:
+            self._idle.put(channel)
+
+    def get_response(self, topic, message, timeout=5):
+        return self._call('get_response', topic, message, timeout=timeout)
+
+    def query_data(self, query, timeout=30):
+        return self._call('query_data', query, timeout=timeout)
+
+    def submit(self, method, *args, **kwargs):
+        """ Run ``get_response`` or ``query_data`` in the background and return its ``Future`` """
+        return self._executor.submit(getattr(self, method), *args, **kwargs)
+
+    def close(self, timeout=None):
+        """ Wait for outstanding requests and disconnect every channel """
+        self._executor.shutdown(wait=True)
+        for channel in self._channels:
+            try:
+                channel.close()
+            except Exception:
+                _log.exception("Failed to close request channel")
+        return True
@@ -0,0 +1,205 @@
+"""
+Retry, backoff and hedging around platform requests.
+
+``ResilientRequester`` wraps anything with the ``get_response``/``query_data``
+methods of ``GridAPPSD`` (a connection or a ``RequestChannelPool``).  Failed
+requests are retried with jittered exponential backoff as long as the total
+deadline budget of the call allows; an error the platform answered with
+(``RequestFailed``, a bad query for instance) is not retried.  Once enough
+answers of a kind of request have been seen, a duplicate request is fired
+when the original is slower than a latency percentile and the first answer
+wins.  No duplicate is fired when the target is a pool without an idle
+channel, it would only queue behind the requests it is meant to race.
+"""
+
+import logging
+import random
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from metrics import LatencyHistogram
+
+_log = logging.getLogger(__name__)
+
+DEFAULT_RETRIES = 4
+DEFAULT_DEADLINE = 600.0
+DEFAULT_BASE_DELAY = 1.0
+DEFAULT_MAX_DELAY = 30.0
+DEFAULT_HEDGE_PERCENTILE = 95.0
+DEFAULT_HEDGE_MIN_SAMPLES = 5
+
+
+class RequestFailed(Exception):
+    """ Raised when the platform answered a request with an error """
+
+
+class RequestDeadlineExceeded(Exception):
+    """ Raised when retries used up the deadline budget of a request """
+
+
+def _request_key(method, args):
+    if method == 'get_response':
+        topic, message = args[0], args[1]
+        if isinstance(message, dict):
+            return "{}:{}".format(topic, message.get('objectType', message.get('requestType')))
+        return topic
+    return method
+
+
+class ResilientRequester(object):
+    """ Retry with backoff and hedge slow requests to the platform """
+
+    def __init__(self, target, retries=DEFAULT_RETRIES, deadline=DEFAULT_DEADLINE,
+                 base_delay=DEFAULT_BASE_DELAY, max_delay=DEFAULT_MAX_DELAY,
+                 hedge_percentile=DEFAULT_HEDGE_PERCENTILE, hedge_min_samples=DEFAULT_HEDGE_MIN_SAMPLES,
+                 max_workers=8):
+        """ Create a ``ResilientRequester``
+
+        Parameters
+        ----------
+        target: object
+            Object with ``get_response`` and ``query_data`` methods.
+        retries: int
+            Attempts made after the first one fails.
+        deadline: float
+            Total seconds a call may take, including retries and backoff.
+        base_delay: float
+            Backoff before the first retry, doubled on each following one.
+        max_delay: float
+            Upper bound of the backoff between two attempts.
+        hedge_percentile: float
+            Latency percentile of earlier answers after which a duplicate
+            request is sent.  0 disables hedging.
+        hedge_min_samples: int
+            Answers needed for a kind of request before it is hedged.
+        """
+        self._target = target
+        self._retries = retries
+        self._deadline = deadline
+        self._base_delay = base_delay
+        self._max_delay = max_delay
+        self._hedge_percentile = hedge_percentile
+        self._hedge_min_samples = hedge_min_samples
+        # calls and the attempts they hedge use separate threads so they cannot starve each other
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='resilient-call')
+        self._attempts = ThreadPoolExecutor(max_workers=2 * max_workers, thread_name_prefix='resilient-attempt')
+        self._lock = threading.Lock()
+        self.latency = {}
+        self.counters = dict(requests=0, retries=0, failures=0, hedges=0, hedge_wins=0)
+
+    def get_response(self, topic, message, timeout=5):
+        return self._call('get_response', (topic, message), timeout)
+
+    def query_data(self, query, timeout=30):
+        return self._call('query_data', (query,), timeout)
+
+    def submit(self, method, *args, **kwargs):
+        """ Run ``get_response`` or ``query_data`` in the background and return its ``Future`` """
+        return self._executor.submit(getattr(self, method), *args, **kwargs)
+
+    def stats(self):
+        """ Counters and per-request latency statistics """
+        with self._lock:
+            latency = {key: hist.summary() for key, hist in self.latency.items()}
+            return dict(self.counters, latency=latency)
+
+    def close(self, timeout=None):
+        self._executor.shutdown(wait=True)
+        self._attempts.shutdown(wait=True)
+        _log.info("Request statistics: {}".format(self.stats()))
+        if hasattr(self._target, 'close'):
+            return self._target.close(timeout)
+        return True
+
+    def _count(self, name):
+        with self._lock:
+            self.counters[name] += 1
+
+    def _histogram(self, key):
+        with self._lock:
+            if key not in self.latency:
+                self.latency[key] = LatencyHistogram()
+            return self.latency[key]
+
+    def _call(self, method, args, timeout):
+        key = _request_key(method, args)
+        self._count('requests')
+        deadline = time.monotonic() + self._deadline
+        attempt = 0
+        while True:
+            remaining = deadline - time.monotonic()
+            try:
+                return self._attempt(key, method, args, min(timeout, remaining))
+            except RequestFailed as e:
+                self._count('failures')
+                _log.error("{} failed: {}".format(key, e))
+                raise
+            except Exception as e:
+                attempt += 1
+                remaining = deadline - time.monotonic()
+                if attempt > self._retries or remaining <= 0:
+                    self._count('failures')
+                    _log.error("{} failed after {} attempts: {}".format(key, attempt, e))
+                    if remaining <= 0:
+                        raise RequestDeadlineExceeded("{} did not succeed within {}s".format(
+                            key, self._deadline)) from e
+                    raise
+                delay = min(self._max_delay, self._base_delay * 2 ** (attempt - 1))
+                delay = min(random.uniform(delay / 2.0, delay), remaining)
+                self._count('retries')
+                _log.warning("{} attempt {} failed ({}), retrying in {:.1f}s".format(key, attempt, e, delay))
+                time.sleep(delay)
+
+    def _attempt(self, key, method, args, timeout):
+        histogram = self._histogram(key)
+        hedge_after = None
+        if self._hedge_percentile and histogram.count >= self._hedge_min_samples:
+            hedge_after = histogram.percentile(self._hedge_percentile)
+
+        start = time.monotonic()
+        if hedge_after is None or hedge_after >= timeout:
+            response = self._invoke(method, args, timeout)
+        else:
+            response = self._hedged(method, args, timeout, hedge_after)
+        histogram.record(time.monotonic() - start)
+        return response
+
+    def _invoke(self, method, args, timeout):
+        response = getattr(self._target, method)(*args, timeout=timeout)
+        if isinstance(response, dict) and 'error' in response and 'data' not in response:
+            raise RequestFailed(response['error'])
+        return response
+
+    def _hedged(self, method, args, timeout, hedge_after):
+        start = time.monotonic()
+        primary = self._attempts.submit(self._invoke, method, args, timeout)
+        done, _ = wait([primary], timeout=hedge_after)
+        if done:
+            return primary.result()
+
+        if getattr(self._target, 'idle', 1) < 1:
+            # every channel is taken, wait for the original instead
+            done, _ = wait([primary], timeout=max(0.0, timeout - (time.monotonic() - start)))
+            if done:
+                return primary.result()
+            raise RequestDeadlineExceeded("No answer within {:.1f}s".format(timeout))
+
+        self._count('hedges')
+        hedge = self._attempts.submit(self._invoke, method, args, max(0.0, timeout - hedge_after))
+        pending = {primary, hedge}
+        error = None
+        while pending:
+            remaining = timeout - (time.monotonic() - start)
+            done, pending = wait(pending, timeout=max(0.0, remaining), return_when=FIRST_COMPLETED)
+            if not done:
+                break
+            for future in done:
+                if future.exception() is None:
+                    if future is hedge:
+                        self._count('hedge_wins')
+                    return future.result()
+                error = future.exception()
+        if error is not None:
+            raise error
+        raise RequestDeadlineExceeded("No answer within {:.1f}s".format(timeout))
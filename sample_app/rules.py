@@ -0,0 +1,282 @@
+"""
+Declarative control rules evaluated over the PNV measurement vector.
+
+Rules are loaded from a JSON (or YAML) file such as::
+
+    {"rules": [
+        {"name": "boost phase A",
+         "when": {"phases": ["A"], "buses": ["650", "632"], "reduce": "min", "op": "<", "value": 0.95},
+         "then": {"regulator": "creg2a", "step": 1},
+         "cooldown": 30},
+        {"name": "shed feeder end",
+         "when": {"reduce": "max", "op": ">", "value": 1.05},
+         "then": {"switch": "671692", "open": true}}
+    ]}
+
+``when`` selects a group of PNV measurements by phase and bus (all of them
+when omitted), reduces it with ``min``, ``max`` or ``mean`` and compares the
+result with ``value`` in per-unit (or volts with ``"unit": "V"``).  With the
+``TopologyIndex`` of the feeder, ``"near": "creg2a", "hops": 2`` keeps the
+buses within two hops of a switch or regulator and ``"downstream": "creg2a"``
+(optionally with ``hops``) the buses it feeds.  ``then``
+raises or lowers a regulator tap by ``step`` (or sets ``position``), opens or
+closes a switch, or sets any ``object``/``attribute``/``value`` directly.
+``cooldown`` is the minimum simulation time in seconds between two firings.
+A command is only sent when the ``Pos`` measurements of its device show it
+is not in the target state already.
+
+Rules are compiled once against the measurement order of the
+``VoltageViolationEngine``: every group becomes a run of indices in one flat
+array and every reduction a single ``reduceat`` over all rules sharing it.
+"""
+
+import json
+import logging
+import operator
+
+import numpy as np
+
+_log = logging.getLogger(__name__)
+
+REDUCERS = ('min', 'max', 'mean')
+OPERATORS = {'<': operator.lt, '<=': operator.le, '>': operator.gt, '>=': operator.ge}
+
+
+class RuleError(ValueError):
+    """ Raised for a rule that cannot be compiled """
+
+
+def load_rules(path):
+    """ Read the list of rule definitions from a JSON or YAML file """
+    with open(path) as f:
+        if path.endswith(('.yml', '.yaml')):
+            import yaml
+            document = yaml.safe_load(f)
+        else:
+            document = json.load(f)
+    return document['rules'] if isinstance(document, dict) else document
+
+
+class RuleAction(object):
+    """ The command a rule emits when it fires """
+
+    def __init__(self, mrid, attribute, value=None, step=None, measids=(), low=None, high=None):
+        """ ``measids`` are the ``Pos`` measurements of the device, its state before the command """
+        self.mrid = mrid
+        self.attribute = attribute
+        self.value = value
+        self.step = step
+        self.measids = list(measids)
+        self.low = low
+        self.high = high
+
+    def difference(self, measurements):
+        """ ``(forward, reverse)`` values for the current measurements, None if there is nothing to do """
+        positions = [int(measurements[m]['value']) for m in self.measids if m in measurements]
+        if self.attribute == 'Switch.open':
+            # the Pos of a closed switch is 1, ``Switch.open`` is 0
+            positions = [1 - p for p in positions]
+        current = positions[0] if positions else None
+        if self.step is None and positions and all(p == self.value for p in positions):
+            return None
+        if self.step is not None:
+            if current is None:
+                return None
+            target = current + self.step
+            if self.low is not None:
+                target = max(target, self.low)
+            if self.high is not None:
+                target = min(target, self.high)
+        else:
+            target = self.value
+        if self.step is not None and target == current:
+            return None
+        if self.attribute == 'Switch.open':
+            return target, 1 - target
+        return target, current if current is not None else target
+
+
+class RuleEngine(object):
+    """ Evaluate compiled rules against one timestep of PNV magnitudes """
+
+    def __init__(self, rules, violation_engine, switches=(), regulators=(), regulator_measids=None,
+                 switch_measids=None, topology=None):
+        """ Compile ``rules``
+
+        Parameters
+        ----------
+        rules: list(dict)
+            Rule definitions, see the module documentation.
+        violation_engine: VoltageViolationEngine
+            Provides the measurement order, buses, phases and base voltages.
+        switches: list(dict)
+            Switches from ``get_meas_mrid`` (``name`` and ``mrid``).
+        regulators: list(dict)
+            Regulators from ``get_meas_mrid`` (``name``, ``mrid`` and step limits).
+        regulator_measids: dict
+            Tap changer mrid to the ``Pos`` measids giving its current step.
+        switch_measids: dict
+            Switch mrid to the ``Pos`` measids giving its current position.
+        topology: TopologyIndex
+            Bus connectivity of the feeder, needed by ``near`` and
+            ``downstream`` selections.
+        """
+        self._engine = violation_engine
+        self.names = []
+        self._actions = []
+        self._per_unit = []
+        self._cooldown = []
+        groups = {reducer: [] for reducer in REDUCERS}
+        ops = []
+        thresholds = []
+
+        switch_mrids = {d['name']: d['mrid'] for d in switches}
+        regulator_by_name = {d['name']: d for d in regulators}
+        buses = violation_engine.buses
+        phase_codes = {p: i for i, p in enumerate(violation_engine.phase_names)}
+        slots_by_bus = {}
+        for slot, bus in enumerate(buses):
+            slots_by_bus.setdefault(bus, []).append(slot)
+
+        for i, rule in enumerate(rules):
+            name = rule.get('name', 'rule {}'.format(i))
+            when = rule['when']
+            reducer = when.get('reduce', 'min')
+            if reducer not in REDUCERS:
+                raise RuleError("{}: unknown reduce '{}'".format(name, reducer))
+            if when.get('op', '<') not in OPERATORS:
+                raise RuleError("{}: unknown op '{}'".format(name, when.get('op')))
+
+            mask = np.ones(len(buses), dtype=bool)
+            if 'phases' in when:
+                codes = [phase_codes[p] for p in when['phases'] if p in phase_codes]
+                mask &= np.isin(violation_engine.phase_codes, codes)
+            if 'buses' in when:
+                selected = np.zeros(len(buses), dtype=bool)
+                for bus in when['buses']:
+                    selected[slots_by_bus.get(bus.upper(), [])] = True
+                mask &= selected
+            if 'near' in when or 'downstream' in when:
+                mask &= np.isin(buses, self._device_buses(name, when, topology))
+            members = np.flatnonzero(mask)
+            if not len(members):
+                _log.warning("Rule '{}' selects no PNV measurement and will never fire".format(name))
+
+            groups[reducer].append((len(self.names), members))
+            ops.append(when.get('op', '<'))
+            thresholds.append(float(when['value']))
+            self._per_unit.append(when.get('unit', 'pu').lower() == 'pu')
+            self._cooldown.append(float(rule.get('cooldown', 0)))
+            self._actions.append(self._compile_action(name, rule['then'], switch_mrids, regulator_by_name,
+                                                      regulator_measids or {}, switch_measids or {}))
+            self.names.append(name)
+
+        n = len(self.names)
+        self._thresholds = np.array(thresholds)
+        self._per_unit = np.array(self._per_unit, dtype=bool)
+        self._cooldown = np.array(self._cooldown)
+        self._last_fired = np.full(n, -np.inf)
+        self._op_masks = {op: np.array([o == op for o in ops], dtype=bool) for op in OPERATORS}
+
+        # One flat index array per reducer, rules with an empty group are kept out of the reduction
+        self._groups = {}
+        for reducer, members in groups.items():
+            members = [(rule, idx) for rule, idx in members if len(idx)]
+            if not members:
+                continue
+            rule_ids = np.array([rule for rule, _ in members], dtype=np.intp)
+            flat = np.concatenate([idx for _, idx in members])
+            offsets = np.cumsum([0] + [len(idx) for _, idx in members[:-1]])
+            self._groups[reducer] = (rule_ids, flat, offsets)
+
+    @staticmethod
+    def _device_buses(name, when, topology):
+        """ Buses selected around or downstream of a device """
+        if topology is None:
+            raise RuleError("{}: 'near' and 'downstream' need the topology of the feeder".format(name))
+        hops = when.get('hops')
+        try:
+            if 'downstream' in when:
+                return topology.downstream(when['downstream'], None if hops is None else int(hops))
+            return topology.within(topology.device(when['near']), int(hops if hops is not None else 1))
+        except KeyError as e:
+            raise RuleError("{}: {}".format(name, e.args[0]))
+
+    @staticmethod
+    def _compile_action(name, then, switch_mrids, regulator_by_name, regulator_measids, switch_measids):
+        if 'regulator' in then:
+            reg = regulator_by_name.get(then['regulator'])
+            if reg is None:
+                raise RuleError("{}: unknown regulator '{}'".format(name, then['regulator']))
+            measids = regulator_measids.get(reg['mrid'], ())
+            if 'position' in then:
+                return RuleAction(reg['mrid'], 'TapChanger.step', value=int(then['position']), measids=measids)
+            return RuleAction(reg['mrid'], 'TapChanger.step', step=int(then.get('step', 1)), measids=measids,
+                              low=reg.get('low_step'), high=reg.get('high_step'))
+        if 'switch' in then:
+            mrid = switch_mrids.get(then['switch'])
+            if mrid is None:
+                raise RuleError("{}: unknown switch '{}'".format(name, then['switch']))
+            return RuleAction(mrid, 'Switch.open', value=1 if then.get('open', True) else 0,
+                              measids=switch_measids.get(mrid, ()))
+        if 'object' in then:
+            return RuleAction(then['object'], then['attribute'], value=then['value'])
+        raise RuleError("{}: 'then' needs a regulator, switch or object".format(name))
+
+    def __len__(self):
+        return len(self.names)
+
+    def reduce(self, magnitude):
+        """ Reduced group value of every rule for raw PNV magnitudes, NaN for empty groups """
+        per_unit = self._engine.per_unit(magnitude)
+        reduced = np.full(len(self.names), np.nan)
+        for reducer, (rule_ids, flat, offsets) in self._groups.items():
+            pu = per_unit[flat]
+            volts = magnitude[flat]
+            for values, selected in ((pu, self._per_unit[rule_ids]), (volts, ~self._per_unit[rule_ids])):
+                if not selected.any():
+                    continue
+                if reducer == 'min':
+                    out = np.fmin.reduceat(values, offsets)
+                elif reducer == 'max':
+                    out = np.fmax.reduceat(values, offsets)
+                else:
+                    valid = ~np.isnan(values)
+                    total = np.add.reduceat(np.where(valid, values, 0.0), offsets)
+                    count = np.add.reduceat(valid, offsets)
+                    with np.errstate(invalid='ignore', divide='ignore'):
+                        out = total / count
+                reduced[rule_ids[selected]] = out[selected]
+        return reduced
+
+    def fired(self, timestamp, magnitude):
+        """ Indices of the rules whose condition holds and that are out of cooldown """
+        reduced = self.reduce(magnitude)
+        hit = np.zeros(len(self.names), dtype=bool)
+        with np.errstate(invalid='ignore'):
+            for op, mask in self._op_masks.items():
+                if mask.any():
+                    hit[mask] = OPERATORS[op](reduced[mask], self._thresholds[mask])
+        hit &= (timestamp - self._last_fired) >= self._cooldown
+        return np.flatnonzero(hit)
+
+    def evaluate(self, timestamp, magnitude, measurements, diff):
+        """ Add the differences of every firing rule to the ``DifferenceBuilder`` ``diff``
+
+        Returns the names of the rules that emitted a difference.
+        """
+        emitted = []
+        targeted = set()
+        for i in self.fired(timestamp, magnitude):
+            action = self._actions[i]
+            # the first rule in file order wins when several act on the same attribute
+            if (action.mrid, action.attribute) in targeted:
+                continue
+            values = action.difference(measurements)
+            if values is None:
+                continue
+            diff.add_difference(action.mrid, action.attribute, values[0], values[1])
+            targeted.add((action.mrid, action.attribute))
+            self._last_fired[i] = timestamp
+            emitted.append(self.names[i])
+        return emitted
@@ -54,7 +54,15 @@ import time
 from gridappsd import GridAPPSD, DifferenceBuilder, utils
 from gridappsd.topics import simulation_input_topic, simulation_output_topic, simulation_log_topic, simulation_output_topic
 
+from lifecycle import SimulationLifecycle, DEFAULT_IDLE_TIMEOUT
+from journal import CommandJournal, DEFAULT_FSYNC_INTERVAL
+from chunking import ChunkedSender, DEFAULT_MAX_BYTES, DEFAULT_MAX_DIFFERENCES, DEFAULT_PACE
+from scheduler import Scheduler
+from dispatch import StartupBuffer, DEFAULT_STARTUP_FRAMES
+
 DEFAULT_MESSAGE_PERIOD = 5
+# simulation seconds between two output messages
+DEFAULT_OUTPUT_INTERVAL = 3
 
 # logging.basicConfig(stream=sys.stdout, level=logging.DEBUG,
 #                     format="%(asctime)s - %(name)s;%(levelname)s|%(message)s",
@@ -74,7 +82,8 @@ class CapacitorToggler(object):
     message to the simulation_input_topic with the forward and reverse difference specified.
     """
 
-    def __init__(self, simulation_id, gridappsd_obj, capacitor_list):
+    def __init__(self, simulation_id, gridappsd_obj, capacitor_list, journal=None, sender=None,
+                 period=DEFAULT_MESSAGE_PERIOD * DEFAULT_OUTPUT_INTERVAL):
         """ Create a ``CapacitorToggler`` object
 
         This object should be used as a subscription callback from a ``GridAPPSD``
@@ -95,6 +104,13 @@ class CapacitorToggler(object):
             isn't required.
         capacitor_list: list(str)
             A list of capacitors mrids to turn on/off
+        journal: CommandJournal
+            Keeps an audit trail of every difference message sent.
+        sender: ChunkedSender
+            Sends the difference messages in bounded chunks, one with the
+            default bounds writing to ``journal`` when None.
+        period: int
+            Simulation seconds between two toggles.
         """
         self._gapps = gridappsd_obj
         self._cap_list = capacitor_list
@@ -103,11 +119,17 @@ class CapacitorToggler(object):
         self._open_diff = DifferenceBuilder(simulation_id)
         self._close_diff = DifferenceBuilder(simulation_id)
         self._publish_to_topic = simulation_input_topic(simulation_id)
+        if sender is None:
+            sender = ChunkedSender(gridappsd_obj, self._publish_to_topic, journal=journal)
+        self._sender = sender
         _log.info("Building cappacitor list")
         for cap_mrid in capacitor_list:
             _log.debug(f"Adding cap sum difference to list: {cap_mrid}")
             self._open_diff.add_difference(cap_mrid, "ShuntCompensator.sections", 0, 1)
             self._close_diff.add_difference(cap_mrid, "ShuntCompensator.sections", 1, 0)
+        # toggle on simulation time, dropped or coalesced messages do not shift it
+        self._scheduler = Scheduler()
+        self._scheduler.every(period, self._toggle, name='capacitor toggle')
 
     def on_message(self, headers, message):
         """ Handle incoming messages on the simulation_output_topic for the simulation_id
@@ -126,19 +148,24 @@ class CapacitorToggler(object):
         self._message_count += 1
         _log.debug(f"new message count is: {self._message_count}")
 
-        # Every message_period messages we are going to turn the capcitors on or off depending
+        if isinstance(message, str):
+            message = json.loads(message)
+        self._scheduler.advance(message['message']['timestamp'])
+
+    def _toggle(self, timestamp):
+        # Every period we are going to turn the capcitors on or off depending
         # on the current capacitor state.
-        if self._message_count % message_period == 0:
-            if self._last_toggle_on:
-                _log.debug("count: {} toggling off".format(self._message_count))
-                msg = self._close_diff.get_message()
-                self._last_toggle_on = False
-            else:
-                _log.debug("count: {} toggling on".format(self._message_count))
-                msg = self._open_diff.get_message()
-                self._last_toggle_on = True
+        if self._last_toggle_on:
+            _log.debug("time: {} toggling off".format(timestamp))
+            msg = self._close_diff.get_message()
+            self._last_toggle_on = False
+        else:
+            _log.debug("time: {} toggling on".format(timestamp))
+            msg = self._open_diff.get_message()
+            self._last_toggle_on = True
 
-            self._gapps.send(self._publish_to_topic, json.dumps(msg))
+        # one difference per capacitor, split into bounded chunks on large feeders
+        self._sender.send(msg)
 
 
 def get_capacitor_mrids(gridappsd_obj, mrid):
@@ -210,8 +237,24 @@ def _main():
     parser.add_argument("request",
                         help="Simulation Request")
     parser.add_argument("--message_period",
-                        help="How often the sample app will send open/close capacitor message.",
+                        help="How often, in output messages of {}s of simulation time, the sample app will send "
+                             "open/close capacitor message.".format(DEFAULT_OUTPUT_INTERVAL),
                         default=DEFAULT_MESSAGE_PERIOD)
+    parser.add_argument("--journal_dir",
+                        help="Keep an append-only journal of every difference message sent in this directory.")
+    parser.add_argument("--journal_fsync", default=DEFAULT_FSYNC_INTERVAL,
+                        help="Seconds between two syncs of the command journal to disk.")
+    parser.add_argument("--chunk_bytes", default=DEFAULT_MAX_BYTES,
+                        help="Serialized size above which a difference message is split into chunks.")
+    parser.add_argument("--chunk_differences", default=DEFAULT_MAX_DIFFERENCES,
+                        help="Differences a chunk of a difference message holds at most.")
+    parser.add_argument("--chunk_pace", default=DEFAULT_PACE,
+                        help="Seconds between two chunks of difference messages (0 sends them right away).")
+    parser.add_argument("--startup_frames", default=DEFAULT_STARTUP_FRAMES,
+                        help="Output messages held while the capacitors are discovered, older ones are folded together.")
+    parser.add_argument("--idle_timeout", default=DEFAULT_IDLE_TIMEOUT,
+                        help="Seconds without any message of a running simulation after which it is considered "
+                             "over (0 waits for its final status forever).")
     # These are now set through the docker container interface via env variables or defaulted to
     # proper values.
     #
@@ -232,12 +275,34 @@ def _main():
     _log.debug("Model mrid is: {}".format(model_mrid)) # object MRID
     gapps = GridAPPSD(opts.simulation_id, address=utils.get_gridappsd_address(),
                       username=utils.get_gridappsd_user(), password=utils.get_gridappsd_pass())
-    
+
+    # subscribe right away, the output of the simulation waits here while the capacitors are discovered and
+    # a status reported meanwhile, even the final one, is not missed
+    lifecycle = SimulationLifecycle(opts.simulation_id, idle_timeout=float(opts.idle_timeout))
+    startup = StartupBuffer(int(opts.startup_frames), taps=[lifecycle.seen])
+    gapps.subscribe(simulation_log_topic(opts.simulation_id), lifecycle)
+    gapps.subscribe(listening_to_topic, startup)
+
     capacitors = get_capacitor_mrids(gapps, model_mrid)
-    toggler = CapacitorToggler(opts.simulation_id, gapps, capacitors)
-    gapps.subscribe(listening_to_topic, toggler)
-    while True:
-        time.sleep(0.1)
+    journal = None
+    if opts.journal_dir:
+        journal = CommandJournal(opts.journal_dir, fsync_interval=float(opts.journal_fsync))
+    sender = ChunkedSender(gapps, simulation_input_topic(opts.simulation_id), max_bytes=int(opts.chunk_bytes),
+                           max_differences=int(opts.chunk_differences), pace=float(opts.chunk_pace), journal=journal)
+    toggler = CapacitorToggler(opts.simulation_id, gapps, capacitors, sender=sender,
+                               period=message_period * DEFAULT_OUTPUT_INTERVAL)
+
+    # stop with the simulation or on a signal
+    lifecycle.install_signal_handlers()
+    lifecycle.register("difference sender", sender.close)
+    if journal is not None:
+        lifecycle.register("command journal", journal.close)
+
+    startup.attach(toggler)
+    lifecycle.wait()
+    print("Simulation {}, shutting down".format(lifecycle.reason))
+    lifecycle.drain()
+    gapps.disconnect()
 
 
 if __name__ == "__main__":
@@ -54,6 +54,8 @@ import time
 from gridappsd import GridAPPSD, DifferenceBuilder, utils, GOSS, topics
 from gridappsd.topics import simulation_input_topic, simulation_output_topic, simulation_log_topic, simulation_output_topic
 
+from lifecycle import SimulationLifecycle
+
 DEFAULT_MESSAGE_PERIOD = 5
 
 # logging.basicConfig(stream=sys.stdout, level=logging.DEBUG,
@@ -290,6 +292,10 @@ def _main():
     gapps = GridAPPSD(opts.simulation_id, address=utils.get_gridappsd_address(),
                       username=utils.get_gridappsd_user(), password=utils.get_gridappsd_pass())
 
+    # follow the simulation status from the start so a status reported during discovery is not missed
+    lifecycle = SimulationLifecycle(opts.simulation_id)
+    gapps.subscribe(simulation_log_topic(opts.simulation_id), lifecycle)
+
     # the three lines (uncommented) below are from Shiva
 
     '''
@@ -315,10 +321,15 @@ def _main():
     # toggling the switch ON and OFF
     toggler = NodalVoltage(opts.simulation_id, gapps, ACline, obj_msr_loadsw)
 
+    # stop with the simulation or on a signal
+    lifecycle.install_signal_handlers()
+
     # gapps.subscribe calls the on_message function
     gapps.subscribe(listening_to_topic, toggler)
-    while True:
-        time.sleep(0.1)
+    lifecycle.wait()
+    print("Simulation {}, shutting down".format(lifecycle.reason))
+    lifecycle.drain()
+    gapps.disconnect()
 
 if __name__ == "__main__":
     _main()
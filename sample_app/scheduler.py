@@ -0,0 +1,202 @@
+"""
+Control actions scheduled on simulation time.
+
+``Scheduler`` is a hashed timer wheel keyed on the ``timestamp`` of the
+simulation output messages rather than on the number of messages received,
+so dropped or coalesced timesteps do not shift when actions fire.  Every
+action sits in the bucket of the first tick at or after its due time (a due
+time that is not a whole number of ticks never fires early); ``advance``
+empties the buckets of the ticks passed since the previous timestep, so registering,
+cancelling and firing an action are O(1) amortized whatever the number of
+actions waiting.  A periodic action is put back in the bucket of its next
+period once it fired; periods missed while no timestep arrived fire once.
+
+An action is called with the timestamp of the timestep that fired it and
+may return a list of ``(mrid, attribute, forward, reverse)`` differences,
+which ``SchedulerStage`` sends in one message.
+"""
+
+import json
+import logging
+import math
+
+_log = logging.getLogger(__name__)
+
+DEFAULT_RESOLUTION = 1
+
+
+def load_schedule(path):
+    """ Read the list of scheduled command definitions from a JSON or YAML file """
+    with open(path) as f:
+        if path.endswith(('.yml', '.yaml')):
+            import yaml
+            document = yaml.safe_load(f)
+        else:
+            document = json.load(f)
+    return document['schedule'] if isinstance(document, dict) else document
+
+
+class ScheduledAction(object):
+    """ Handle of an action registered with a ``Scheduler`` """
+
+    __slots__ = ('due', 'period', 'action', 'name', 'cancelled', 'fired')
+
+    def __init__(self, due, period, action, name):
+        self.due = due
+        self.period = period
+        self.action = action
+        self.name = name
+        self.cancelled = False
+        self.fired = 0
+
+    def __repr__(self):
+        return "ScheduledAction(name={}, due={}, period={})".format(self.name, self.due, self.period)
+
+
+class Scheduler(object):
+    """ One-shot and periodic actions fired by simulation timestamps """
+
+    def __init__(self, resolution=DEFAULT_RESOLUTION):
+        """ Create a ``Scheduler``
+
+        Parameters
+        ----------
+        resolution: int
+            Simulation seconds per tick of the wheel.
+        """
+        self._resolution = resolution
+        self._buckets = {}
+        self._tick = None
+        self.now = None
+        self.pending = 0
+
+    def __len__(self):
+        return self.pending
+
+    def _defer(self, scheduled, offset):
+        # placed ``offset`` seconds after the first timestep once it tells the time
+        scheduled.due = offset
+        self._buckets.setdefault(None, []).append(scheduled)
+        self.pending += 1
+        return scheduled
+
+    def _add(self, scheduled):
+        # rounded up: firing in the tick before ``due`` would put it back in that same tick
+        tick = int(math.ceil(scheduled.due / self._resolution))
+        if self._tick is not None and tick <= self._tick:
+            # due already, fires with the next timestep
+            tick = self._tick + 1
+        self._buckets.setdefault(tick, []).append(scheduled)
+        self.pending += 1
+        return scheduled
+
+    def at(self, timestamp, action, name=None):
+        """ Call ``action`` once with the first timestep at or after ``timestamp`` """
+        return self._add(ScheduledAction(timestamp, None, action, name))
+
+    def after(self, delay, action, name=None):
+        """ Call ``action`` once ``delay`` simulation seconds after the last timestep """
+        if self.now is None:
+            return self._defer(ScheduledAction(None, None, action, name), delay)
+        return self.at(self.now + delay, action, name)
+
+    def every(self, period, action, start=None, name=None):
+        """ Call ``action`` every ``period`` simulation seconds
+
+        The first call is at ``start``, or one period after the next timestep
+        when not given.
+        """
+        if period <= 0:
+            raise ValueError("The period of {} must be positive".format(name or action))
+        scheduled = ScheduledAction(start, period, action, name)
+        if start is None:
+            if self.now is None:
+                return self._defer(scheduled, period)
+            scheduled.due = self.now + period
+        return self._add(scheduled)
+
+    def cancel(self, scheduled):
+        """ Stop ``scheduled`` from firing, it is dropped from its bucket when the wheel gets there """
+        if not scheduled.cancelled:
+            scheduled.cancelled = True
+            self.pending -= 1
+
+    def advance(self, timestamp):
+        """ Fire the actions due up to ``timestamp``
+
+        Returns ``(scheduled, result)`` for every action called, in due order.
+        """
+        self.now = timestamp
+        tick = int(timestamp // self._resolution)
+        for scheduled in self._buckets.pop(None, []):
+            if not scheduled.cancelled:
+                self.pending -= 1
+                scheduled.due += timestamp
+                self._add(scheduled)
+        if self._tick is None:
+            self._tick = min([t for t in self._buckets if t is not None] + [tick]) - 1
+        if tick <= self._tick:
+            return []
+
+        if tick - self._tick <= len(self._buckets):
+            ticks = range(self._tick + 1, tick + 1)
+        else:
+            # a long jump in time, only visit the buckets that exist
+            ticks = sorted(t for t in self._buckets if t <= tick)
+        due = []
+        for t in ticks:
+            bucket = self._buckets.pop(t, None)
+            if bucket:
+                due.extend(bucket)
+        self._tick = tick
+
+        fired = []
+        for scheduled in due:
+            if scheduled.cancelled:
+                continue
+            self.pending -= 1
+            try:
+                result = scheduled.action(timestamp)
+            except Exception:
+                _log.exception("Scheduled action {} failed".format(scheduled))
+                result = None
+            scheduled.fired += 1
+            fired.append((scheduled, result))
+            if scheduled.period and not scheduled.cancelled:
+                # missed periods collapse into the call just made
+                missed = (timestamp - scheduled.due) // scheduled.period + 1
+                scheduled.due += missed * scheduled.period
+                self._add(scheduled)
+        return fired
+
+    def schedule_commands(self, definitions, mrids=None):
+        """ Register the commands of ``load_schedule`` definitions
+
+        Every definition has an ``mrid`` (or a device ``name`` found in
+        ``mrids``), an ``attribute``, ``forward`` and ``reverse`` values and
+        either ``at`` (a timestamp), ``after`` (seconds from now) or ``every``
+        (a period, with an optional ``start``).
+        """
+        handles = []
+        for d in definitions:
+            mrid = d['mrid'] if 'mrid' in d else (mrids or {})[d['name']]
+            difference = (mrid, d['attribute'], d['forward'], d.get('reverse'))
+            action = _CommandAction([difference])
+            name = d.get('name', mrid)
+            if 'every' in d:
+                handles.append(self.every(d['every'], action, start=d.get('start'), name=name))
+            elif 'after' in d:
+                handles.append(self.after(d['after'], action, name=name))
+            else:
+                handles.append(self.at(d['at'], action, name=name))
+        return handles
+
+
+class _CommandAction(object):
+    """ An action returning fixed differences """
+
+    def __init__(self, differences):
+        self.differences = differences
+
+    def __call__(self, timestamp):
+        return self.differences
@@ -0,0 +1,97 @@
+"""
+Immutable, versioned snapshots of the per-timestep results.
+
+The pipeline thread is the only writer: after every timestep it freezes the
+results into a ``Snapshot`` and replaces the reference held by the
+``SnapshotStore``.  Replacing a reference is atomic, so readers on other
+threads (a query server, a metrics thread) take ``store.latest`` and get one
+consistent timestep without any lock, however long they keep it.  The last
+``history`` snapshots are kept in a tuple that is rebuilt, never modified, on
+every publish.
+
+Freezing does not copy: arrays are handed out as read-only views, lists become
+tuples and dictionaries read-only mappings.  The stages produce new objects
+every timestep, so nothing a snapshot refers to is changed afterwards.
+"""
+
+import types
+
+import numpy as np
+
+DEFAULT_HISTORY = 60
+
+
+def freeze(value):
+    """ A read-only version of ``value`` sharing its data """
+    if isinstance(value, np.ndarray):
+        view = value.view()
+        view.flags.writeable = False
+        return view
+    if isinstance(value, dict):
+        return types.MappingProxyType({key: freeze(item) for key, item in value.items()})
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(item) for item in value)
+    if isinstance(value, set):
+        return frozenset(value)
+    return value
+
+
+class Snapshot(object):
+    """ The frozen results of one timestep """
+
+    __slots__ = ('version', 'timestamp', 'values')
+
+    def __init__(self, version, timestamp, values):
+        object.__setattr__(self, 'version', version)
+        object.__setattr__(self, 'timestamp', timestamp)
+        object.__setattr__(self, 'values', freeze(values))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Snapshot is immutable")
+
+    def __getitem__(self, key):
+        return self.values[key]
+
+    def __contains__(self, key):
+        return key in self.values
+
+    def get(self, key, default=None):
+        return self.values.get(key, default)
+
+    def __repr__(self):
+        return "Snapshot(version={}, timestamp={}, keys={})".format(self.version, self.timestamp, list(self.values))
+
+
+class SnapshotStore(object):
+    """ The latest ``Snapshot`` and a bounded history, for one writer and any number of readers """
+
+    def __init__(self, history=DEFAULT_HISTORY):
+        """ Create a ``SnapshotStore``
+
+        Parameters
+        ----------
+        history: int
+            Number of past snapshots kept, the latest included.
+        """
+        self._size = max(1, int(history))
+        self._latest = None
+        self._history = ()
+        self.version = 0
+
+    @property
+    def latest(self):
+        """ The snapshot of the last timestep, None before the first one """
+        return self._latest
+
+    def publish(self, timestamp, values):
+        """ Freeze ``values`` as the next version and make it the latest """
+        snapshot = Snapshot(self.version + 1, timestamp, values)
+        self._history = self._history[1 - self._size:] + (snapshot,) if self._size > 1 else (snapshot,)
+        self._latest = snapshot
+        self.version = snapshot.version
+        return snapshot
+
+    def history(self, start=None, end=None):
+        """ Kept snapshots with ``start <= timestamp <= end``, oldest first """
+        return [snapshot for snapshot in self._history
+                if (start is None or snapshot.timestamp >= start) and (end is None or snapshot.timestamp <= end)]
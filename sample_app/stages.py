@@ -0,0 +1,430 @@
+"""
+The pipeline stages of the ``NodalVoltage`` application.
+
+Measurement groups used by the stages:
+
+``pnv``
+    Phase-to-neutral voltages of the ACLineSegment buses.
+``switch_pos``
+    ``Pos`` of the load break switches.
+``reg_pos``
+    ``Pos`` (tap step) of the regulators.
+"""
+
+import logging
+import time
+
+import numpy as np
+
+from aggregation import BusAggregator, VUF_LIMIT
+from streamstats import StreamingStatistics
+from violations import NORMAL
+from pipeline import Stage
+
+_log = logging.getLogger(__name__)
+
+PNV = 'pnv'
+SWITCH_POS = 'switch_pos'
+REG_POS = 'reg_pos'
+
+
+def measurement_groups(ACline, obj_msr_loadsw, obj_msr_reg):
+    """ Group name to measids for the ``Pipeline`` """
+    return {
+        PNV: [d['measid'] for d in ACline],
+        SWITCH_POS: [d['measid'] for d in obj_msr_loadsw if d['type'] == 'Pos'],
+        REG_POS: [d['measid'] for d in obj_msr_reg if d['type'] == 'Pos'],
+    }
+
+
+class SwitchStatusStage(Stage):
+    """ Names of the open switches """
+
+    name = 'switch_status'
+    inputs = (SWITCH_POS,)
+    provides = ('open_switches',)
+
+    def __init__(self, obj_msr_loadsw):
+        self._eqnames = np.array([d['eqname'] for d in obj_msr_loadsw if d['type'] == 'Pos'])
+
+    def run(self, context):
+        values = context.groups[SWITCH_POS]
+        is_open = values.present & (values.value == 0)
+        context.results['open_switches'] = sorted(set(self._eqnames[is_open].tolist()))
+
+
+class RegulatorTapStage(Stage):
+    """ Current tap step of every regulator phase """
+
+    name = 'regulator_tap'
+    inputs = (REG_POS,)
+    provides = ('regulator_taps',)
+
+    def __init__(self, obj_msr_reg):
+        pos = [d for d in obj_msr_reg if d['type'] == 'Pos']
+        self._keys = ['{}.{}'.format(d['eqname'], d['phases']) for d in pos]
+
+    def run(self, context):
+        values = context.groups[REG_POS]
+        context.results['regulator_taps'] = {key: int(values.value[i])
+                                             for i, key in enumerate(self._keys) if values.present[i]}
+
+
+class VoltageBandStage(Stage):
+    """ Per-unit ANSI range classification of the PNV measurements """
+
+    name = 'voltage_bands'
+    inputs = (PNV,)
+    provides = ('pnv_magnitude', 'violations')
+
+    def __init__(self, violation_engine):
+        self._engine = violation_engine
+
+    def run(self, context):
+        magnitude = context.groups[PNV].magnitude
+        context.results['pnv_magnitude'] = magnitude
+        context.results['violations'] = self._engine.evaluate(context.timestamp, magnitude)
+
+
+class BusAggregationStage(Stage):
+    """ Per-bus min/max/mean per-unit voltage and voltage unbalance factor """
+
+    name = 'bus_aggregation'
+    inputs = (PNV,)
+    provides = ('bus_voltages',)
+
+    def __init__(self, violation_engine, ACline):
+        self._engine = violation_engine
+        self._aggregator = BusAggregator(violation_engine.buses, [d['phases'] for d in ACline])
+
+    def run(self, context):
+        values = context.groups[PNV]
+        context.results['bus_voltages'] = self._aggregator.aggregate(
+            self._engine.per_unit(values.magnitude), values.magnitude, values.angle)
+
+
+class AnomalyStage(Stage):
+    """ Running per-unit PNV statistics and the buses whose voltage is anomalous """
+
+    name = 'anomalies'
+    inputs = (PNV,)
+    provides = ('pnv_statistics', 'anomalies', 'anomalous_buses')
+
+    def __init__(self, violation_engine, z_threshold, step_threshold):
+        self._engine = violation_engine
+        self._statistics = StreamingStatistics(len(violation_engine.measids), z_threshold=z_threshold,
+                                               step_threshold=step_threshold)
+
+    def run(self, context):
+        per_unit = self._engine.per_unit(context.groups[PNV].magnitude)
+        flags = self._statistics.update(context.timestamp, per_unit)
+        context.results['pnv_statistics'] = self._statistics
+        context.results['anomalies'] = flags
+        context.results['anomalous_buses'] = sorted(set(self._engine.buses[flags.any].tolist()))
+
+
+class NeighbourhoodStage(Stage):
+    """ The out of band buses within a few hops of every switch and regulator
+
+    The neighbourhoods are a (devices, PNV measurements) mask built once, a
+    timestep is the product of the mask with its out of band measurements.
+    """
+
+    name = 'neighbourhood'
+    inputs = (PNV,)
+    provides = ('devices_near_violations',)
+
+    def __init__(self, topology, violation_engine, hops):
+        self._engine = violation_engine
+        self._devices, self._masks = topology.device_masks(violation_engine.buses, hops)
+
+    def run(self, context):
+        codes = self._engine.classify(self._engine.per_unit(context.groups[PNV].magnitude))
+        near = self._masks & (codes != NORMAL)
+        buses = self._engine.buses
+        context.results['devices_near_violations'] = {
+            self._devices[d]: sorted(set(buses[near[d]].tolist())) for d in np.flatnonzero(near.any(axis=1))}
+
+
+class ControlStage(Stage):
+    """ Evaluate the control rules and send the differences they emit """
+
+    name = 'control'
+    exclusive = True
+    inputs = (PNV, REG_POS)
+    requires = ('pnv_magnitude',)
+    provides = ('fired_rules',)
+    events = ('fired_rules',)
+
+    def __init__(self, rule_engine, diff, send):
+        self._rules = rule_engine
+        self._diff = diff
+        self._send = send
+
+    def run(self, context):
+        magnitude = context.results.get('pnv_magnitude')
+        if magnitude is None:
+            return
+        fired = self._rules.evaluate(context.timestamp, magnitude, context.measurements, self._diff)
+        context.results['fired_rules'] = fired
+        if fired:
+            self._send(self._diff)
+
+
+class OperatorConsoleStage(Stage):
+    """ The interactive demo: fixed regulator tap, phase voltage bands and switch toggling from stdin """
+
+    name = 'operator'
+    exclusive = True
+
+    def __init__(self, ACline, switches, regulators, open_diff, tap_diff, send):
+        self._ACline = ACline
+        self._switches = switches
+        self._regulators = regulators
+        self._open_diff = open_diff
+        self._tap_diff = tap_diff
+        self._send = send
+        self._flag = 0
+
+    def run(self, context):
+        meas_value = context.measurements
+        timestamp = context.timestamp
+
+        # changing the tap position of the regulator
+        measid = [d for d in self._regulators if d['name'] == 'creg2a']
+        if measid:
+            self._tap_diff.add_difference(measid[0]['mrid'], "TapChanger.step", 5, 0)
+            # send the message to platform
+            self._send(self._tap_diff)
+
+        print("For now we can only allow you to view Phase-to-Neutral Voltage related information")
+        phase_checking = ['A', 'B', 'C']
+        check = True
+        while check:
+            phase_val = input("Which phase are you interested in (A/B/C)? ")
+            while phase_val not in phase_checking:
+                print('Unidentified phase')
+                phase_val = input("Which phase are you interested in (A/B/C)? ")
+            print("Selecting Phase as ** {} ** -- ...".format(phase_val))
+            time.sleep(3)
+
+            # PNV
+            # Find interested mrids. We are only interested in PNV of specific phase
+            phase_check = [d for d in self._ACline if d['phases'] == phase_val]
+
+            # get the ranges
+            min_volt = float(input("Minimum value of voltage at phase {}? ".format(phase_val)))
+            max_volt = float(input("Maximum value of voltage at phase {}? ".format(phase_val)))
+
+            phase_PNV = []
+            for d1 in phase_check:
+                if d1['measid'] in meas_value:
+                    p = meas_value[d1['measid']]
+                    if p['magnitude'] > min_volt and p['magnitude'] < max_volt:
+                        phase_PNV.append(d1['bus'])
+
+            print('.....................................................')
+            print('The total number of nodes with PNV > {} and PNV < {} = {} '.format(
+                min_volt, max_volt, len(set(phase_PNV))))
+            print("timestamp: {} and the set of buses are: {}".format(timestamp, set(phase_PNV)))
+            recheck = input("Do you want another option (Y/N)? ")
+            if recheck == 'N':
+                check = False
+
+        print('---------------------------------------')
+        print("Now let's try working on the switches")
+        print('---------------------------------------')
+
+        switch_val = input("Are you interesting in toggling the switches (Y/N)? ")
+        if switch_val == 'Y':
+            sel_sw = int(input("select the switch to toggle (0-{})".format(len(self._switches) - 1)))
+
+            # Open one of the switches
+            if self._flag == 0:
+                swmrid = self._switches[sel_sw]['mrid']
+                # (1,0) -> (current_state, next_state)
+                self._open_diff.add_difference(swmrid, "Switch.open", 1, 0)
+                # send the message to platform
+                self._send(self._open_diff)
+
+
+class SchedulerStage(Stage):
+    """ Fire the control actions due at the timestamp of the timestep and send their differences """
+
+    name = 'schedule'
+    exclusive = True
+    provides = ('scheduled_actions',)
+    events = ('scheduled_actions',)
+
+    def __init__(self, scheduler, diff, send):
+        self._scheduler = scheduler
+        self._diff = diff
+        self._send = send
+
+    def run(self, context):
+        fired = self._scheduler.advance(context.timestamp)
+        context.results['scheduled_actions'] = [scheduled.name for scheduled, _ in fired]
+        differences = [d for _, result in fired if result for d in result]
+        if differences:
+            for mrid, attribute, forward, reverse in differences:
+                self._diff.add_difference(mrid, attribute, forward, reverse)
+            self._send(self._diff)
+
+
+class CommandQueueStage(Stage):
+    """ Send the switch and tap commands queued by the query server since the last timestep """
+
+    name = 'commands'
+    exclusive = True
+    requires = ('regulator_taps',)
+    provides = ('operator_commands',)
+    events = ('operator_commands',)
+
+    def __init__(self, commands, obj_msr_reg, regulators, diff, send):
+        self._commands = commands
+        self._diff = diff
+        self._send = send
+        # the tap a regulator is at, to send as the reverse difference
+        self._tap_keys = {}
+        for reg in regulators:
+            for d in obj_msr_reg:
+                if d['type'] == 'Pos' and d['eqid'] == reg['eqid'] and (
+                        not reg['phases'] or d['phases'] in reg['phases']):
+                    self._tap_keys[reg['name']] = '{}.{}'.format(d['eqname'], d['phases'])
+                    break
+
+    def run(self, context):
+        commands = self._commands.drain()
+        context.results['operator_commands'] = commands
+        if not commands:
+            return
+        taps = context.results.get('regulator_taps', {})
+        for command in commands:
+            if 'switch' in command:
+                is_open = command['action'] == 'open'
+                self._diff.add_difference(command['mrid'], "Switch.open", int(is_open), int(not is_open))
+            else:
+                current = taps.get(self._tap_keys.get(command['regulator']), 0)
+                self._diff.add_difference(command['mrid'], "TapChanger.step", command['step'], current)
+        _log.info("Sending {} queued operator commands".format(len(commands)))
+        self._send(self._diff)
+
+
+def summarize(results):
+    """ The JSON serializable part of the results of a timestep """
+    values = {}
+    if 'open_switches' in results:
+        values['open_switches'] = list(results['open_switches'])
+    if 'regulator_taps' in results:
+        values['regulator_taps'] = dict(results['regulator_taps'])
+    report = results.get('violations')
+    if report is not None:
+        values['violations'] = {phase: dict(counts) for phase, counts in report.counts.items()}
+        values['bands'] = {phase: {name: sorted(set(map(str, buses))) for name, buses in classes.items()}
+                           for phase, classes in report.buses.items()}
+    aggregates = results.get('bus_voltages')
+    if aggregates is not None:
+        values['unbalanced_buses'] = aggregates.unbalanced()
+    if 'anomalous_buses' in results:
+        values['anomalous_buses'] = list(results['anomalous_buses'])
+    if 'devices_near_violations' in results:
+        values['devices_near_violations'] = dict(results['devices_near_violations'])
+    if 'fired_rules' in results:
+        values['fired_rules'] = list(results['fired_rules'])
+    return values
+
+
+class SnapshotStage(Stage):
+    """ Publish the results of the timestep as an immutable snapshot for other threads """
+
+    name = 'snapshot'
+    requires = ('open_switches', 'regulator_taps', 'pnv_magnitude', 'violations', 'bus_voltages', 'anomalous_buses',
+                'devices_near_violations', 'fired_rules')
+
+    def __init__(self, store, violation_engine=None):
+        self._store = store
+        self._engine = violation_engine
+        self._static = {}
+        if violation_engine is not None:
+            self._static = dict(pnv_measids=np.array(violation_engine.measids), pnv_buses=violation_engine.buses,
+                                pnv_phases=np.array(violation_engine.phase_names)[violation_engine.phase_codes])
+
+    def run(self, context):
+        values = dict(self._static)
+        for key in self.requires:
+            if key in context.results:
+                values[key] = context.results[key]
+        if self._engine is not None and 'pnv_magnitude' in values:
+            values['pnv_per_unit'] = self._engine.per_unit(values['pnv_magnitude'])
+        self._store.publish(context.timestamp, values)
+
+
+class AnalyticsStage(Stage):
+    """ Hand the results of the timestep to the ``AnalyticsPublisher`` """
+
+    name = 'analytics'
+    requires = ('open_switches', 'regulator_taps', 'violations', 'bus_voltages', 'anomalous_buses',
+                'devices_near_violations', 'fired_rules')
+
+    def __init__(self, publisher):
+        self._publisher = publisher
+
+    def run(self, context):
+        self._publisher.publish(context.timestamp, summarize(context.results))
+
+
+class PartialResultStage(Stage):
+    """ Hand the results of the shard of this instance to the merging instance """
+
+    name = 'partial'
+    requires = ('open_switches', 'regulator_taps', 'violations', 'bus_voltages', 'anomalous_buses',
+                'devices_near_violations', 'fired_rules')
+
+    def __init__(self, shard, sink):
+        self._shard = shard
+        self._sink = sink
+
+    def run(self, context):
+        self._sink.add(context.timestamp, self._shard, summarize(context.results))
+
+
+class OutputStage(Stage):
+    """ Print the results of the timestep """
+
+    name = 'output'
+    exclusive = True
+    requires = ('open_switches', 'regulator_taps', 'violations', 'bus_voltages', 'anomalies')
+
+    def run(self, context):
+        results = context.results
+        print('.....................................................')
+        if 'regulator_taps' in results:
+            print('Regulator taps:', results['regulator_taps'])
+        if 'open_switches' in results:
+            print('The total number of open switches:', len(results['open_switches']))
+            print(context.timestamp, set(results['open_switches']))
+        report = results.get('violations')
+        if report is not None:
+            print('Per-unit voltage violations (ANSI C84.1):', report.violations())
+            for phase, counts in report.counts.items():
+                print(phase, counts)
+        aggregates = results.get('bus_voltages')
+        if aggregates is not None:
+            unbalanced = aggregates.unbalanced()
+            print('Buses with voltage unbalance above {:.0%}: {}'.format(VUF_LIMIT, len(unbalanced)))
+            if unbalanced:
+                print(context.timestamp, unbalanced)
+        flags = results.get('anomalies')
+        if flags is not None and 'anomalies' in context.ran and len(flags):
+            buses = results['anomalous_buses']
+            print('Anomalous voltages: {} outliers, {} steps on {} buses {}{}'.format(
+                int(flags.outlier.sum()), int(flags.step.sum()), len(buses), buses[:20],
+                ' ...' if len(buses) > 20 else ''))
+        near = results.get('devices_near_violations')
+        if near and 'neighbourhood' in context.ran:
+            print('Devices with out of band buses nearby: {}'.format(
+                {device: len(buses) for device, buses in sorted(near.items())}))
+        if results.get('fired_rules') and 'control' in context.ran:
+            print('Control rules fired:', results['fired_rules'])
+        if context.skipped:
+            _log.debug("Unchanged inputs, skipped stages: {}".format(context.skipped))
@@ -0,0 +1,139 @@
+"""
+Streaming statistics of every measurement slot.
+
+``StreamingStatistics`` keeps, in fixed NumPy arrays with one entry per
+slot, the running mean and variance (Welford's algorithm), an exponentially
+weighted moving average and the rate of change since the previous value.
+Every timestep is one vectorized update; slots whose value is NaN (missing
+measurement) keep their state.
+
+Before a value is folded in it is checked against the statistics so far: a
+z-score above ``z_threshold`` (once ``warmup`` values were seen) or a jump
+from the previous value larger than ``step_threshold`` flags the slot as
+anomalous.  The standard deviation is floored at ``relative_std`` of the
+mean so a slot that held a constant value (a switch position, a tap in a
+noise-free simulation) does not turn rounding noise into outliers.
+"""
+
+import numpy as np
+
+DEFAULT_ALPHA = 0.1
+DEFAULT_Z_THRESHOLD = 4.0
+DEFAULT_WARMUP = 10
+DEFAULT_RELATIVE_STD = 1e-4
+
+
+class AnomalyFlags(object):
+    """ Anomalies of one timestep, boolean arrays over the slots """
+
+    def __init__(self, timestamp, zscore, outlier, step):
+        self.timestamp = timestamp
+        self.zscore = zscore
+        self.outlier = outlier
+        self.step = step
+
+    @property
+    def any(self):
+        return self.outlier | self.step
+
+    def __len__(self):
+        return int(np.count_nonzero(self.any))
+
+    def __repr__(self):
+        return "AnomalyFlags(timestamp={}, outliers={}, steps={})".format(
+            self.timestamp, int(self.outlier.sum()), int(self.step.sum()))
+
+
+class StreamingStatistics(object):
+    """ Per-slot running statistics and anomaly flags """
+
+    def __init__(self, size, alpha=DEFAULT_ALPHA, z_threshold=DEFAULT_Z_THRESHOLD, step_threshold=None,
+                 warmup=DEFAULT_WARMUP, relative_std=DEFAULT_RELATIVE_STD):
+        """ Create a ``StreamingStatistics``
+
+        Parameters
+        ----------
+        size: int
+            Number of slots.
+        alpha: float
+            Weight of the newest value in the moving average.
+        z_threshold: float
+            Absolute z-score above which a value is an outlier.
+        step_threshold: float
+            Absolute change from the previous value above which a value is a
+            step, no step detection when None.
+        warmup: int
+            Values needed in a slot before its z-score is used.
+        relative_std: float
+            Floor of the standard deviation used in z-scores, as a fraction of
+            the absolute mean.
+        """
+        self._alpha = alpha
+        self._z_threshold = z_threshold
+        self._step_threshold = step_threshold
+        self._warmup = warmup
+        self._relative_std = relative_std
+        self.count = np.zeros(size, dtype=np.int64)
+        self.mean = np.zeros(size)
+        self._m2 = np.zeros(size)
+        self.ewma = np.full(size, np.nan)
+        self.last = np.full(size, np.nan)
+        self.last_time = np.full(size, np.nan)
+        self.rate = np.full(size, np.nan)
+
+    def __len__(self):
+        return len(self.count)
+
+    @property
+    def variance(self):
+        """ Sample variance of every slot, NaN below two values """
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(self.count > 1, self._m2 / (self.count - 1), np.nan)
+
+    @property
+    def std(self):
+        return np.sqrt(self.variance)
+
+    def zscore(self, values):
+        """ z-score of ``values`` against the statistics so far, NaN during warmup
+
+        A value equal to the mean of a slot that never varied scores 0.
+        """
+        std = np.maximum(self.std, self._relative_std * np.abs(self.mean))
+        deviation = values - self.mean
+        with np.errstate(invalid='ignore', divide='ignore'):
+            z = deviation / std
+        z[(deviation == 0) & (std == 0)] = 0.0
+        z[self.count < self._warmup] = np.nan
+        return z
+
+    def update(self, timestamp, values):
+        """ Flag anomalies in ``values`` and fold them into the statistics
+
+        Returns the ``AnomalyFlags`` of the timestep.
+        """
+        valid = ~np.isnan(values)
+        z = self.zscore(values)
+        with np.errstate(invalid='ignore'):
+            outlier = np.abs(z) > self._z_threshold
+            if self._step_threshold is not None:
+                step = np.abs(values - self.last) > self._step_threshold
+            else:
+                step = np.zeros(len(values), dtype=bool)
+
+        idx = np.flatnonzero(valid)
+        x = values[idx]
+        count = self.count[idx] + 1
+        delta = x - self.mean[idx]
+        mean = self.mean[idx] + delta / count
+        self._m2[idx] += delta * (x - mean)
+        self.mean[idx] = mean
+        self.count[idx] = count
+
+        ewma = self.ewma[idx]
+        self.ewma[idx] = np.where(np.isnan(ewma), x, ewma + self._alpha * (x - ewma))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            self.rate[idx] = (x - self.last[idx]) / (timestamp - self.last_time[idx])
+        self.last[idx] = x
+        self.last_time[idx] = timestamp
+        return AnomalyFlags(timestamp, z, outlier, step)
@@ -0,0 +1,317 @@
+"""
+Synthetic feeder and measurement stream for sizing and benchmarking the app.
+
+``SyntheticFeeder`` builds a radial feeder of a given number of buses and
+answers the requests ``get_meas_mrid``, ``get_base_voltages`` and
+``get_line_terminals`` make with data shaped like the platform's:
+``QUERY_OBJECT_MEASUREMENTS`` metadata for ACLineSegment, LoadBreakSwitch and
+PowerTransformer and SPARQL bindings for the switches, regulators, line
+terminals and base voltages.  It then produces simulation output messages in
+which a fraction of the measurements change on every timestep, and applies
+the switch and tap commands sent to it so their effect shows in the
+following timesteps.
+
+It can stand in for the ``GridAPPSD`` object of the app::
+
+    feeder = SyntheticFeeder.for_measurements(100000)
+    ACline, loadsw, reg, switches, regulators = get_meas_mrid(feeder, feeder.model_mrid, topic)
+    for message in feeder.messages(100):
+        app.on_message({}, message)
+
+Run the module to time the discovery post-processing and ``on_message`` of
+``NodalVoltage`` on feeders from 100 to 1M measurements.
+"""
+
+import argparse
+import json
+import logging
+import time
+
+import numpy as np
+
+_log = logging.getLogger(__name__)
+
+PHASES = ('A', 'B', 'C')
+ANGLES = {'A': 0.0, 'B': -120.0, 'C': 120.0}
+# measurement types of every phase of an ACLineSegment
+LINE_TYPES = ('PNV', 'VA', 'A')
+DEFAULT_PHASE_MIX = (0.2, 0.1, 0.7)
+DEFAULT_BASE_VOLTAGE = 4160.0
+DEFAULT_TIME_STEP = 3
+REGULATOR_LOW_STEP = -16
+REGULATOR_HIGH_STEP = 16
+
+
+def _binding(**values):
+    return {key: {'type': 'literal', 'value': str(value)} for key, value in values.items()}
+
+
+class SyntheticFeeder(object):
+    """ A generated feeder answering model queries and producing simulation output """
+
+    def __init__(self, buses=100, phase_mix=DEFAULT_PHASE_MIX, switches=5, regulators=1, change_rate=0.1,
+                 base_voltage=DEFAULT_BASE_VOLTAGE, spread=0.04, seed=0, model_mrid='_SYNTHETIC_FEEDER'):
+        """ Create a ``SyntheticFeeder``
+
+        Parameters
+        ----------
+        buses: int
+            Buses of the feeder, each fed by one ACLineSegment from an earlier bus.
+        phase_mix: tuple(float)
+            Fractions of single, two and three phase buses.
+        switches: int
+            Load break switches between two buses.
+        regulators: int
+            Three phase regulators, one tank and tap changer per phase.
+        change_rate: float
+            Fraction of the measurements that change on every timestep.
+        base_voltage: float
+            Nominal line-to-line voltage of every bus.
+        spread: float
+            Standard deviation of the per-unit voltages around 1.0.
+        seed: int
+            Seed of the random generator, the same seed gives the same feeder
+            and stream.
+        """
+        self.model_mrid = model_mrid
+        self.change_rate = change_rate
+        self.base_voltage = base_voltage
+        self._spread = spread
+        self._rng = np.random.default_rng(seed)
+        self.sent = []
+
+        rng = self._rng
+        counts = rng.choice([1, 2, 3], size=buses, p=np.asarray(phase_mix) / np.sum(phase_mix))
+        counts[0] = 3
+        self.buses = ['B{}'.format(i) for i in range(buses)]
+        self.bus_phases = [PHASES[:n] if n == 3 else tuple(sorted(rng.choice(PHASES, n, replace=False)))
+                           for n in counts]
+        self.parents = np.concatenate([[-1], (rng.random(buses - 1) * np.arange(1, buses)).astype(int)]) \
+            if buses > 1 else np.array([-1])
+
+        self.line_measurements = []
+        for i in range(1, buses):
+            eqid = '_LINE_{}'.format(i)
+            eqname = 'line{}'.format(i)
+            for phase in self.bus_phases[i]:
+                for kind in LINE_TYPES:
+                    self.line_measurements.append(dict(
+                        measid='_M_{}_{}_{}'.format(eqname, phase, kind), type=kind, eqid=eqid, eqname=eqname,
+                        bus=self.buses[i], phases=phase, eqtype='ACLineSegment'))
+
+        self.switch_bindings = []
+        self.switch_measurements = []
+        for k in range(switches):
+            i = 1 + (k * max(1, (buses - 1) // max(1, switches))) % max(1, buses - 1)
+            mrid = '_SW_{}'.format(k)
+            name = 'sw{}'.format(k)
+            bus1, bus2 = self.buses[self.parents[i]], self.buses[i]
+            self.switch_bindings.append(_binding(cimtype='LoadBreakSwitch', name=name, bus1=bus1, bus2=bus2, id=mrid))
+            for phase in self.bus_phases[i]:
+                for kind in ('Pos', 'A', 'PNV'):
+                    self.switch_measurements.append(dict(
+                        measid='_M_{}_{}_{}'.format(name, phase, kind), type=kind, eqid=mrid, eqname=name,
+                        bus=bus2, phases=phase, eqtype='LoadBreakSwitch'))
+
+        self.regulator_bindings = []
+        self.regulator_measurements = []
+        for k in range(regulators):
+            pxfid = '_REG_XF_{}'.format(k)
+            pname = 'reg{}'.format(k)
+            bus = self.buses[min(buses - 1, k * max(1, buses // max(1, regulators)))]
+            for phase in PHASES:
+                self.regulator_bindings.append(_binding(
+                    rname='creg{}{}'.format(k, phase.lower()), id='_RTC_{}_{}'.format(k, phase), pname=pname,
+                    pxfid=pxfid, tname='{}{}'.format(pname, phase.lower()), wnum=2, phs=phase, incr=0.625,
+                    mode='voltage', enabled='true', highStep=REGULATOR_HIGH_STEP, lowStep=REGULATOR_LOW_STEP,
+                    neutralStep=0, normalStep=0, step=0))
+                for kind in ('Pos', 'PNV', 'VA'):
+                    self.regulator_measurements.append(dict(
+                        measid='_M_{}_{}_{}'.format(pname, phase, kind), type=kind, eqid=pxfid, eqname=pname,
+                        bus=bus, phases=phase, eqtype='PowerTransformer'))
+
+        self._build_state()
+
+    @classmethod
+    def for_measurements(cls, measurements, **kwargs):
+        """ A feeder with about ``measurements`` ACLineSegment, switch and regulator measurements """
+        mix = np.asarray(kwargs.get('phase_mix', DEFAULT_PHASE_MIX), dtype=float)
+        per_bus = len(LINE_TYPES) * float(np.dot(mix / mix.sum(), [1, 2, 3]))
+        buses = max(2, int(round(measurements / per_bus)))
+        kwargs.setdefault('switches', max(1, buses // 200))
+        kwargs.setdefault('regulators', max(1, buses // 2000))
+        return cls(buses=buses, **kwargs)
+
+    def __len__(self):
+        return len(self._measids)
+
+    def _build_state(self):
+        everything = self.line_measurements + self.switch_measurements + self.regulator_measurements
+        self._measids = [d['measid'] for d in everything]
+        kinds = np.array([d['type'] for d in everything])
+        angles = np.array([ANGLES[d['phases']] for d in everything])
+        n = len(everything)
+        base_ln = self.base_voltage / np.sqrt(3)
+
+        # PNV and VA carry magnitude/angle, Pos carries value, A a current magnitude/angle
+        self._voltage = np.flatnonzero(kinds == 'PNV')
+        self._power = np.flatnonzero(kinds == 'VA')
+        self._current = np.flatnonzero(kinds == 'A')
+        self._position = np.flatnonzero(kinds == 'Pos')
+        self._positions = set(self._position.tolist())
+        self._magnitude = np.zeros(n)
+        self._angle = angles.copy()
+        self._value = np.zeros(n, dtype=int)
+        self._magnitude[self._voltage] = base_ln * self._rng.normal(1.0, self._spread, len(self._voltage))
+        self._magnitude[self._power] = self._rng.uniform(1e3, 1e5, len(self._power))
+        self._magnitude[self._current] = self._rng.uniform(1.0, 200.0, len(self._current))
+        # switches start closed, regulators in neutral
+        self._value[self._position] = [1 if d['eqtype'] == 'LoadBreakSwitch' else 0
+                                       for d in (everything[i] for i in self._position)]
+
+        self._slot = {measid: i for i, measid in enumerate(self._measids)}
+        self._pos_of = {}
+        for d in self.switch_measurements + self.regulator_measurements:
+            if d['type'] == 'Pos':
+                self._pos_of.setdefault(d['eqid'], []).append(self._slot[d['measid']])
+        for b in self.regulator_bindings:
+            self._pos_of[b['id']['value']] = [self._slot['_M_{}_{}_Pos'.format(b['pname']['value'],
+                                                                                 b['phs']['value'])]]
+        self._state = {measid: self._measurement(i) for i, measid in enumerate(self._measids)}
+
+    def _measurement(self, i):
+        if i in self._positions:
+            return {'measurement_mrid': self._measids[i], 'value': int(self._value[i])}
+        return {'measurement_mrid': self._measids[i], 'magnitude': float(self._magnitude[i]),
+                'angle': float(self._angle[i])}
+
+    # --- requests, shaped like the platform's answers ------------------------------------------
+
+    def get_response(self, topic, message, timeout=5):
+        if isinstance(message, str):
+            message = json.loads(message)
+        if 'queryString' in message:
+            # a query sent as a request, the way ``RequestChannel.query_data`` does
+            return self.query_data(message['queryString'], timeout)
+        object_type = message.get('objectType')
+        if object_type == 'ACLineSegment':
+            return {'data': list(self.line_measurements)}
+        if object_type == 'LoadBreakSwitch':
+            return {'data': list(self.switch_measurements)}
+        if object_type == 'PowerTransformer':
+            return {'data': list(self.regulator_measurements)}
+        return {'error': 'Unsupported request {}'.format(message)}
+
+    def query_data(self, query, timeout=30):
+        if 'RatioTapChanger' in query:
+            bindings = self.regulator_bindings
+        elif 'LoadBreakSwitch' in query:
+            bindings = self.switch_bindings
+        elif 'c:ACLineSegment' in query:
+            bindings = [_binding(name='line{}'.format(i), id='_LINE_{}'.format(i),
+                                 bus1=self.buses[self.parents[i]], bus2=self.buses[i])
+                        for i in range(1, len(self.buses))]
+        elif 'BaseVoltage' in query:
+            bindings = [_binding(bus=bus, nomv=self.base_voltage) for bus in self.buses]
+        else:
+            bindings = []
+        return {'data': {'results': {'bindings': list(bindings)}}}
+
+    def send(self, topic, message):
+        """ Apply the switch and tap commands of a difference message """
+        self.sent.append((topic, message))
+        if isinstance(message, str):
+            try:
+                message = json.loads(message)
+            except ValueError:
+                return
+        if not isinstance(message, dict):
+            return
+        differences = message.get('input', {}).get('message', {}).get('forward_differences', [])
+        for d in differences:
+            slots = self._pos_of.get(d['object'], ())
+            if d['attribute'] == 'Switch.open':
+                value = 0 if int(d['value']) else 1
+            elif d['attribute'] == 'TapChanger.step':
+                value = int(d['value'])
+            else:
+                continue
+            for i in slots:
+                self._value[i] = value
+                self._state[self._measids[i]] = self._measurement(i)
+
+    # --- simulation output ---------------------------------------------------------------------
+
+    def step(self):
+        """ Change ``change_rate`` of the measurements and return the indices that changed """
+        rng = self._rng
+        changed = np.flatnonzero(rng.random(len(self._measids)) < self.change_rate)
+        voltage = np.intersect1d(changed, self._voltage, assume_unique=True)
+        base_ln = self.base_voltage / np.sqrt(3)
+        self._magnitude[voltage] += base_ln * rng.normal(0.0, self._spread / 4, len(voltage))
+        analog = np.setdiff1d(changed, np.concatenate([self._voltage, self._position]), assume_unique=True)
+        self._magnitude[analog] *= rng.uniform(0.9, 1.1, len(analog))
+        self._angle[changed] += rng.normal(0.0, 0.5, len(changed))
+        # positions are left to the commands sent to the feeder
+        changed = np.setdiff1d(changed, self._position, assume_unique=True)
+        for i in changed.tolist():
+            self._state[self._measids[i]] = self._measurement(i)
+        return changed
+
+    def messages(self, timesteps, start=None, time_step=DEFAULT_TIME_STEP, simulation_id='1'):
+        """ Yield ``timesteps`` simulation output messages """
+        timestamp = int(time.time()) if start is None else start
+        for _ in range(timesteps):
+            yield {'simulation_id': simulation_id,
+                   'message': {'timestamp': timestamp, 'measurements': dict(self._state)}}
+            self.step()
+            timestamp += time_step
+
+
+def _benchmark(sizes, timesteps, change_rate, stages):
+    from gridappsd.topics import simulation_output_topic
+    from abodh_app import (NodalVoltage, get_meas_mrid, get_base_voltages, get_regulator_pos_measids,
+                           get_line_terminals, get_topology)
+
+    for size in sizes:
+        start = time.perf_counter()
+        feeder = SyntheticFeeder.for_measurements(size, change_rate=change_rate)
+        built = time.perf_counter() - start
+
+        start = time.perf_counter()
+        ACline, loadsw, reg, switches, regulators = get_meas_mrid(feeder, feeder.model_mrid,
+                                                                  simulation_output_topic('1'))
+        base_voltages = get_base_voltages(feeder, feeder.model_mrid)
+        get_regulator_pos_measids(reg, regulators)
+        topology = get_topology(get_line_terminals(feeder, feeder.model_mrid), switches, regulators, reg)
+        discovered = time.perf_counter() - start
+
+        app = NodalVoltage('1', feeder, ACline, loadsw, reg, switches, regulators,
+                           base_voltages=base_voltages, stages=stages, topology=topology)
+        timings = []
+        for message in feeder.messages(timesteps):
+            start = time.perf_counter()
+            app.on_message({}, message)
+            timings.append(time.perf_counter() - start)
+        app.close()
+        print("{:>9} measurements  build {:7.3f}s  discovery {:7.3f}s  on_message mean {:8.2f}ms  max {:8.2f}ms"
+              .format(len(feeder), built, discovered, 1e3 * np.mean(timings), 1e3 * np.max(timings)))
+
+
+def _main():
+    parser = argparse.ArgumentParser(description="Time NodalVoltage on synthetic feeders")
+    parser.add_argument("--sizes", default="100,1000,10000,100000,1000000",
+                        help="Comma separated numbers of measurements.")
+    parser.add_argument("--timesteps", default=10, help="Timesteps sent to on_message per feeder.")
+    parser.add_argument("--change_rate", default=0.1, help="Fraction of measurements changing per timestep.")
+    parser.add_argument("--stages",
+                        default="switch_status,regulator_tap,voltage_bands,bus_aggregation,anomalies,neighbourhood,"
+                                "control,snapshot",
+                        help="Pipeline stages to run, the interactive operator stage is left out by default.")
+    opts = parser.parse_args()
+    _benchmark([int(s) for s in opts.sizes.split(',')], int(opts.timesteps), float(opts.change_rate),
+               opts.stages.split(','))
+
+
+if __name__ == "__main__":
+    _main()
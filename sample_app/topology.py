@@ -0,0 +1,191 @@
+"""
+Bus connectivity of the feeder.
+
+``TopologyIndex`` stores the buses connected by ACLineSegments and switches
+as an undirected graph in CSR form (``indptr``/``indices`` arrays) and runs
+breadth first searches over it one frontier at a time with array
+operations.  The hop distance of every bus up to ``max_hops`` from each
+device (switch or regulator) is computed once.  ``device_masks`` turns these
+neighbourhoods into a boolean (devices, measurements) matrix over any
+measurement order, so "which buses within k hops of this device are out of
+band" is one mask product with the classified magnitudes of a timestep.
+
+Without ``sources`` (the buses of the feeder head) the graph has no
+direction: the part of the feeder downstream of a device is then everything
+it reaches.  That holds for regulators, as transformers are not edges and
+the bus a regulator is measured at only reaches its load side.
+"""
+
+import numpy as np
+
+DEFAULT_MAX_HOPS = 3
+
+
+class TopologyIndex(object):
+    """ CSR adjacency of the feeder buses with precomputed device neighbourhoods """
+
+    def __init__(self, edges, devices=None, max_hops=DEFAULT_MAX_HOPS, sources=None):
+        """ Create a ``TopologyIndex``
+
+        Parameters
+        ----------
+        edges: list(tuple(str, str))
+            Pairs of connected buses (line and switch terminals).
+        devices: dict
+            Device name to the list of buses it sits on.
+        max_hops: int
+            Hop distance precomputed around every device.
+        sources: list(str)
+            Buses the feeder is supplied from, gives ``downstream`` its
+            direction.
+        """
+        names = sorted({bus.upper() for edge in edges for bus in edge} |
+                       {bus.upper() for buses in (devices or {}).values() for bus in buses})
+        self.buses = np.array(names)
+        self.index = {bus: i for i, bus in enumerate(names)}
+        n = len(names)
+
+        if edges:
+            pairs = np.array([(self.index[a.upper()], self.index[b.upper()]) for a, b in edges
+                              if a.upper() != b.upper()], dtype=np.intp).reshape(-1, 2)
+        else:
+            pairs = np.zeros((0, 2), dtype=np.intp)
+        src = np.concatenate([pairs[:, 0], pairs[:, 1]])
+        dst = np.concatenate([pairs[:, 1], pairs[:, 0]])
+        order = np.lexsort((dst, src))
+        src, dst = src[order], dst[order]
+        # parallel lines and switches between the same buses are one edge
+        keep = np.r_[True, (src[1:] != src[:-1]) | (dst[1:] != dst[:-1])] if len(src) else np.zeros(0, dtype=bool)
+        src, dst = src[keep], dst[keep]
+        self.indptr = np.zeros(n + 1, dtype=np.intp)
+        np.cumsum(np.bincount(src, minlength=n), out=self.indptr[1:])
+        self.indices = dst
+
+        self.max_hops = max_hops
+        self._layers = {}
+        self._scratch = np.full(n, -1, dtype=np.intp)
+        for name, buses in (devices or {}).items():
+            self._layers[name] = self.layers([self.index[bus.upper()] for bus in buses], max_hops)
+        self._source_distance = None
+        if sources:
+            roots = self.slots(sources)
+            self._source_distance = self.distances(roots[roots >= 0])
+
+    def __len__(self):
+        return len(self.buses)
+
+    @property
+    def devices(self):
+        return list(self._layers)
+
+    def device(self, name):
+        """ Key of a device given by its key or by the name of the switch or regulator """
+        for key in (name, 'regulator:' + name, 'switch:' + name):
+            if key in self._layers:
+                return key
+        raise KeyError("Unknown device {}".format(name))
+
+    def slots(self, buses):
+        """ Index of every bus of ``buses`` in the index, -1 for the unknown ones """
+        return np.array([self.index.get(bus.upper(), -1) for bus in buses], dtype=np.intp)
+
+    def neighbours(self, frontier):
+        """ Buses adjacent to any bus of ``frontier`` (with repetitions) """
+        starts = self.indptr[frontier]
+        counts = self.indptr[frontier + 1] - starts
+        if not counts.sum():
+            return np.zeros(0, dtype=np.intp)
+        offsets = np.repeat(starts - np.cumsum(np.r_[0, counts[:-1]]), counts)
+        return self.indices[offsets + np.arange(counts.sum())]
+
+    def layers(self, sources, max_hops):
+        """ ``(buses, distances)`` of the buses at most ``max_hops`` from ``sources``
+
+        Only touches the buses it reaches, so it stays cheap on large feeders.
+        """
+        distance = self._scratch
+        frontier = np.unique(np.asarray(sources, dtype=np.intp))
+        distance[frontier] = 0
+        reached = [frontier]
+        for hop in range(1, max_hops + 1):
+            if not len(frontier):
+                break
+            adjacent = self.neighbours(frontier)
+            frontier = np.unique(adjacent[distance[adjacent] < 0])
+            distance[frontier] = hop
+            reached.append(frontier)
+        reached = np.concatenate(reached)
+        result = reached, distance[reached].copy()
+        distance[reached] = -1
+        return result
+
+    def distances(self, sources, max_hops=None):
+        """ Hop distance from the nearest of ``sources`` to every bus, -1 beyond ``max_hops`` """
+        distance = np.full(len(self.buses), -1, dtype=np.intp)
+        frontier = np.unique(np.asarray(sources, dtype=np.intp))
+        distance[frontier] = 0
+        hop = 0
+        while len(frontier) and (max_hops is None or hop < max_hops):
+            hop += 1
+            reached = self.neighbours(frontier)
+            frontier = np.unique(reached[distance[reached] < 0])
+            distance[frontier] = hop
+        return distance
+
+    def _within(self, device, hops):
+        reached, distance = self._layers[device]
+        if hops > self.max_hops:
+            return self.layers(reached[distance == 0], hops)[0]
+        return reached[distance <= hops]
+
+    def within(self, device, hops):
+        """ Buses at most ``hops`` away from ``device`` """
+        return self.buses[self._within(device, hops)]
+
+    def around(self, bus, hops):
+        """ ``(buses, distances)`` of the buses at most ``hops`` from ``bus`` """
+        reached, distance = self.layers([self.index[bus.upper()]], hops)
+        return self.buses[reached], distance
+
+    def downstream(self, device, hops=None):
+        """ Buses fed through ``device``, at most ``hops`` from it
+
+        With ``sources`` these are the buses whose shortest path from the
+        feeder head passes through the bus of the device farthest from it.
+        """
+        reached, distance = self._layers[self.device(device)]
+        roots = reached[distance == 0]
+        if self._source_distance is None or (self._source_distance[roots] < 0).all():
+            # no direction, or a part of the feeder the sources do not reach
+            found = self.distances(roots, hops)
+            return self.buses[found >= 0]
+        root = roots[np.argmax(self._source_distance[roots])]
+        found = self.distances([root], hops)
+        below = (found >= 0) & (self._source_distance == self._source_distance[root] + found)
+        return self.buses[below]
+
+    def device_masks(self, buses, hops):
+        """ ``(devices, masks)``, ``masks[d, i]`` tells whether ``buses[i]`` is within ``hops`` of device ``d`` """
+        slots = self.slots(buses)
+        known = slots >= 0
+        masks = np.zeros((len(self._layers), len(slots)), dtype=bool)
+        within = np.zeros(len(self.buses), dtype=bool)
+        for d, device in enumerate(self._layers):
+            within[:] = False
+            within[self._within(device, hops)] = True
+            masks[d, known] = within[slots[known]]
+        return list(self._layers), masks
+
+    def near(self, buses, hops):
+        """ Device name to the buses of ``buses`` within ``hops`` of it, devices with none left out """
+        selected = np.zeros(len(self.buses), dtype=bool)
+        selected[[self.index[bus] for bus in {bus.upper() for bus in buses} if bus in self.index]] = True
+        found = {}
+        if not selected.any():
+            return found
+        for device in self._layers:
+            close = self._within(device, hops)
+            close = close[selected[close]]
+            if len(close):
+                found[device] = self.buses[close].tolist()
+        return found
@@ -0,0 +1,134 @@
+"""
+Per-unit voltage violation engine.
+
+Phase-to-neutral voltage (PNV) magnitudes are converted to per-unit with the
+nominal voltage of the bus they are measured at, and classified against the
+ANSI C84.1 service voltage ranges.  Three phase buses are based on their
+line-to-line nominal over sqrt(3); the s1 and s2 legs of a split-phase
+secondary are based on half of it (120 V of a 240 V service).  The base
+voltages are looked up once when the engine is built so every timestep is a
+handful of array operations over the whole feeder.
+"""
+
+import logging
+import math
+
+import numpy as np
+
+from decoder import MeasurementDecoder
+
+_log = logging.getLogger(__name__)
+
+# ANSI C84.1 service voltage ranges in per-unit
+RANGE_A = (0.95, 1.05)
+RANGE_B = (0.917, 1.058)
+
+# Classification codes returned by ``VoltageViolationEngine.classify``
+BELOW_B, LOW_A, NORMAL, HIGH_A, ABOVE_B = range(5)
+CLASS_NAMES = ('below_b', 'low_a', 'normal', 'high_a', 'above_b')
+
+PHASES = ('A', 'B', 'C', 's1', 's2')
+SPLIT_PHASES = ('s1', 's2')
+
+
+class ViolationReport(object):
+    """ Violations found in one timestep, grouped by phase
+
+    ``counts[phase][name]`` holds the number of measurements in each class of
+    ``CLASS_NAMES`` and ``buses[phase][name]`` the buses of every class except
+    ``normal``.
+    """
+
+    def __init__(self, timestamp, counts, buses):
+        self.timestamp = timestamp
+        self.counts = counts
+        self.buses = buses
+
+    def violations(self, phase=None):
+        """ Number of measurements outside range A, optionally for a single phase """
+        phases = [phase] if phase else list(self.counts)
+        return sum(self.counts[p][name] for p in phases
+                   for name in CLASS_NAMES if name != 'normal')
+
+    def __repr__(self):
+        return "ViolationReport(timestamp={}, violations={})".format(self.timestamp, self.violations())
+
+
+class VoltageViolationEngine(object):
+    """ Classify PNV measurements against ANSI ranges in per-unit
+
+    The measurement order given to the constructor fixes the position of
+    every measid in the magnitude arrays the engine works on.
+    """
+
+    def __init__(self, pnv_measurements, base_voltages, range_a=RANGE_A, range_b=RANGE_B):
+        """ Create a ``VoltageViolationEngine``
+
+        Parameters
+        ----------
+        pnv_measurements: list(dict)
+            PNV measurement descriptions as returned by ``QUERY_OBJECT_MEASUREMENTS``
+            (``measid``, ``bus`` and ``phases`` keys are used).
+        base_voltages: dict
+            Nominal line-to-line voltage in volts keyed by upper case bus name.
+        range_a: tuple(float)
+            Per-unit (low, high) limits of ANSI range A.
+        range_b: tuple(float)
+            Per-unit (low, high) limits of ANSI range B.
+        """
+        self.measids = [d['measid'] for d in pnv_measurements]
+        self.buses = np.array([d['bus'].upper() for d in pnv_measurements])
+        phases = [d['phases'] for d in pnv_measurements]
+        self.phase_names = [p for p in PHASES if p in set(phases)]
+        self.phase_names += sorted(set(phases) - set(self.phase_names))
+        codes = {p: i for i, p in enumerate(self.phase_names)}
+        self.phase_codes = np.array([codes[p] for p in phases], dtype=np.intp)
+
+        # Base voltages are line-to-line, the measurements are phase-to-neutral
+        base = np.array([base_voltages.get(bus, np.nan) for bus in self.buses], dtype=float)
+        missing = np.isnan(base)
+        if missing.any():
+            _log.warning("No base voltage for {} of {} PNV measurements".format(
+                int(missing.sum()), len(base)))
+        split = np.array([p in SPLIT_PHASES for p in phases], dtype=bool)
+        self.base_ln = base / np.where(split, 2.0, math.sqrt(3))
+        self._inv_base = 1.0 / self.base_ln
+        self._bins = np.array([range_b[0], range_a[0], range_a[1], range_b[1]])
+        self._decoder = MeasurementDecoder(self.measids, buffers=1)
+
+    def gather(self, measurements):
+        """ Magnitudes of this timestep in engine order, NaN where a measid is missing """
+        values, _ = self._decoder.decode(measurements)
+        return values['magnitude'].copy()
+
+    def per_unit(self, magnitude):
+        """ Convert magnitudes of shape (..., n_measids) to per-unit """
+        return magnitude * self._inv_base
+
+    def classify(self, per_unit):
+        """ Class code of every per-unit value, see ``CLASS_NAMES``
+
+        Values that are NaN (missing measurement or unknown base) are reported
+        as ``NORMAL`` so they never raise a violation.
+        """
+        codes = np.digitize(per_unit, self._bins, right=False)
+        codes[np.isnan(per_unit)] = NORMAL
+        return codes
+
+    def evaluate(self, timestamp, magnitude):
+        """ Build the ``ViolationReport`` of one timestep from raw magnitudes """
+        codes = self.classify(self.per_unit(magnitude))
+        n_classes = len(CLASS_NAMES)
+        table = np.bincount(self.phase_codes * n_classes + codes,
+                            minlength=len(self.phase_names) * n_classes)
+        table = table.reshape(len(self.phase_names), n_classes)
+
+        counts = {}
+        buses = {}
+        violating = np.flatnonzero(codes != NORMAL)
+        for p, phase in enumerate(self.phase_names):
+            counts[phase] = dict(zip(CLASS_NAMES, table[p].tolist()))
+            buses[phase] = {name: [] for name in CLASS_NAMES if name != 'normal'}
+        for i in violating:
+            buses[self.phase_names[self.phase_codes[i]]][CLASS_NAMES[codes[i]]].append(self.buses[i])
+        return ViolationReport(timestamp, counts, buses)
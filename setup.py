@@ -52,6 +52,6 @@ README = (HERE / "README.md").read_text()
 setup(
     name="gridappsd",
     version=__version__,
-    install_requires=['PyYaml', 'stomp.py', 'pytz'],
+    install_requires=['PyYaml', 'stomp.py', 'pytz', 'numpy'],
     packages=['sample_app'],
 )
@@ -0,0 +1,26 @@
+import numpy as np
+
+from aggregation import BusAggregator
+
+
+def test_per_bus_reduction_ignores_nan():
+    aggregator = BusAggregator(['B2', 'B1', 'B2', 'B1'], ['A', 'A', 'B', 'B'])
+    assert aggregator.buses.tolist() == ['B1', 'B2']
+    minimum, maximum, mean = aggregator.reduce(np.array([1.0, 2.0, 3.0, np.nan]))
+    assert minimum.tolist() == [2.0, 1.0]
+    assert maximum.tolist() == [2.0, 3.0]
+    assert mean.tolist() == [2.0, 2.0]
+
+
+def test_balanced_and_unbalanced_buses():
+    buses = ['B1'] * 3 + ['B2'] * 3 + ['B3']
+    phases = ['A', 'B', 'C'] * 2 + ['A']
+    aggregator = BusAggregator(buses, phases)
+    magnitude = np.array([1.0, 1.0, 1.0, 1.0, 0.9, 1.1, 1.0])
+    angle = np.array([0.0, -120.0, 120.0, 0.0, -120.0, 120.0, 0.0])
+    vuf = aggregator.unbalance(magnitude, angle)
+    assert vuf[0] < 1e-9
+    assert 0.05 < vuf[1] < 0.07
+    assert np.isnan(vuf[2])
+    aggregates = aggregator.aggregate(magnitude, magnitude, angle)
+    assert aggregates.unbalanced(0.02) == ['B2']
@@ -0,0 +1,161 @@
+import importlib
+import json
+import signal
+import sys
+import types
+
+import pytest
+
+from lifecycle import COMPLETE
+from synthetic import SyntheticFeeder
+
+SIMULATION_ID = '123'
+FRAMES = 150
+
+
+class _DifferenceBuilder(object):
+
+    def __init__(self, simulation_id):
+        self.simulation_id = simulation_id
+        self.clear()
+
+    def add_difference(self, mrid, attribute, forward, reverse):
+        self._forward.append(dict(object=mrid, attribute=attribute, value=forward))
+        self._reverse.append(dict(object=mrid, attribute=attribute, value=reverse))
+
+    def get_message(self):
+        return {'command': 'update', 'input': {'simulation_id': self.simulation_id, 'message': {
+            'timestamp': 0, 'difference_mrid': '_diff', 'forward_differences': list(self._forward),
+            'reverse_differences': list(self._reverse)}}}
+
+    def clear(self):
+        self._forward = []
+        self._reverse = []
+
+
+def _gridappsd_modules():
+    """ A ``gridappsd`` package with what the app imports from it """
+    gridappsd = types.ModuleType('gridappsd')
+    topics = types.ModuleType('gridappsd.topics')
+    topics.simulation_input_topic = '/topic/goss.gridappsd.simulation.input.{}'.format
+    topics.simulation_output_topic = '/topic/goss.gridappsd.simulation.output.{}'.format
+    topics.simulation_log_topic = '/topic/goss.gridappsd.simulation.log.{}'.format
+    gridappsd.topics = topics
+    gridappsd.utils = types.SimpleNamespace(get_gridappsd_address=lambda: ('localhost', 61613),
+                                            get_gridappsd_user=lambda: 'user', get_gridappsd_pass=lambda: 'pass')
+    gridappsd.GridAPPSD = None
+    gridappsd.GOSS = object
+    gridappsd.DifferenceBuilder = _DifferenceBuilder
+    return {'gridappsd': gridappsd, 'gridappsd.topics': topics, 'gridappsd.utils': gridappsd.utils}
+
+
+class _Platform(SyntheticFeeder):
+    """ Every connection of the app, the simulation runs and completes while the model is discovered """
+
+    def __init__(self, frames=FRAMES):
+        super(_Platform, self).__init__(buses=30, switches=2, regulators=1, seed=1)
+        self.frames = frames
+        self.connections = 0
+        self.disconnections = 0
+        self.subscriptions = {}
+
+    def connect(self, *args, **kwargs):
+        self.connections += 1
+        return self
+
+    def subscribe(self, topic, callback):
+        # like GridAPPSD, a callable or an object with an on_message method
+        callback = getattr(callback, 'on_message', callback)
+        self.subscriptions[topic] = callback
+        if topic == '/topic/goss.gridappsd.simulation.output.{}'.format(SIMULATION_ID):
+            for message in self.messages(self.frames, start=1000, simulation_id=SIMULATION_ID):
+                callback({}, json.dumps(message))
+        elif topic == '/topic/goss.gridappsd.simulation.log.{}'.format(SIMULATION_ID):
+            callback({}, dict(processId=SIMULATION_ID, processStatus=COMPLETE))
+
+    def disconnect(self):
+        self.disconnections += 1
+
+
+@pytest.fixture
+def app(monkeypatch):
+    """ The ``abodh_app`` module imported against the stub ``gridappsd``, with the objects ``_main`` builds """
+    for name, module in _gridappsd_modules().items():
+        monkeypatch.setitem(sys.modules, name, module)
+    monkeypatch.delitem(sys.modules, 'abodh_app', raising=False)
+    handlers = {signum: signal.getsignal(signum) for signum in (signal.SIGINT, signal.SIGTERM)}
+    module = importlib.import_module('abodh_app')
+    built = types.SimpleNamespace(module=module, toggler=[], dispatchers=[], drained=[], registered=[])
+
+    class NodalVoltage(module.NodalVoltage):
+        def __init__(self, *args, **kwargs):
+            super(NodalVoltage, self).__init__(*args, **kwargs)
+            built.toggler.append(self)
+
+    class LagAwareDispatcher(module.LagAwareDispatcher):
+        def __init__(self, *args, **kwargs):
+            super(LagAwareDispatcher, self).__init__(*args, **kwargs)
+            built.dispatchers.append(self)
+
+    class SimulationLifecycle(module.SimulationLifecycle):
+        def register(self, name, close):
+            built.registered.append(name)
+            super(SimulationLifecycle, self).register(
+                name, lambda timeout: built.drained.append(name) or close(timeout))
+
+    monkeypatch.setattr(module, 'NodalVoltage', NodalVoltage)
+    monkeypatch.setattr(module, 'LagAwareDispatcher', LagAwareDispatcher)
+    monkeypatch.setattr(module, 'SimulationLifecycle', SimulationLifecycle)
+
+    def run(platform, *args):
+        monkeypatch.setattr(module, 'GridAPPSD', platform.connect)
+        request = json.dumps({'power_system_config': {'Line_name': platform.model_mrid}})
+        monkeypatch.setattr(sys, 'argv', ['abodh_app.py', SIMULATION_ID, request, '--drain_timeout', '5'] + list(args))
+        module._main()
+        return built
+
+    yield run
+    for signum, handler in handlers.items():
+        signal.signal(signum, handler)
+    sys.modules.pop('abodh_app', None)
+
+
+ANALYSIS = ['switch_status', 'regulator_tap', 'voltage_bands', 'bus_aggregation', 'anomalies', 'neighbourhood']
+
+
+def test_startup_output_is_processed_and_drained_in_order(app):
+    platform = _Platform()
+    # operators use the query server, nothing prompts on stdin
+    built = app(platform, '--query_port', '0')
+    toggler, = built.toggler
+    assert toggler.stages == ANALYSIS + ['schedule', 'commands', 'snapshot', 'output']
+    # more frames arrived during discovery than the default dispatcher queue holds, none was dropped
+    dispatcher, = built.dispatchers
+    assert FRAMES > built.module.DEFAULT_MAX_PENDING
+    assert dispatcher.received == dispatcher.processed == FRAMES and dispatcher.skipped == 0
+    # what feeds a buffer stops before the buffer is drained
+    assert built.registered == ['query server', 'output dispatcher', 'pipeline', 'command tracker',
+                                'difference sender', 'request pool']
+    assert built.drained == built.registered
+    assert platform.connections == platform.disconnections == 1 + built.module.DEFAULT_POOL_SIZE
+
+
+def test_shards_other_than_the_merger_only_analyse(app):
+    platform = _Platform(frames=3)
+    built = app(platform, '--shards', '2', '--shard_index', '1', '--stages', 'switch_status,output')
+    toggler, = built.toggler
+    assert toggler.stages == ['voltage_bands', 'bus_aggregation', 'anomalies', 'neighbourhood', 'partial']
+    assert len([topic for topic, _ in platform.sent if 'partial' in topic]) == 3
+    with pytest.raises(SystemExit):
+        app(platform, '--shards', '2', '--shard_index', '1', '--replay', 'recording')
+
+
+def test_recording_replays_without_the_platform(app, tmp_path, capsys):
+    recording = str(tmp_path / 'recording')
+    app(_Platform(frames=5), '--record_dir', recording, '--query_port', '0')
+    offline = _Platform()
+    built = app(offline, '--replay', recording)
+    assert offline.connections == 0
+    # operators cannot command a replay
+    assert built.toggler[-1].stages == ANALYSIS + ['schedule', 'snapshot', 'output']
+    assert 'Replayed 5 timesteps' in capsys.readouterr().out
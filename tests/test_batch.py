@@ -0,0 +1,70 @@
+import numpy as np
+import pytest
+
+from batch import BatchReplay, DryRunConnection, load_model, message_chunks, recording_chunks, save_model
+from recorder import MeasurementRecorder, RecordingReader
+
+MEASIDS = ['m1', 'm2']
+
+
+def _message(timestamp, **magnitudes):
+    return {'message': {'timestamp': timestamp, 'measurements': {
+        measid: dict(measurement_mrid=measid, magnitude=value) for measid, value in magnitudes.items()}}}
+
+
+def test_dry_run_keeps_what_would_be_sent():
+    connection = DryRunConnection()
+    connection.send('topic', '{"a": 1}')
+    assert connection.sent == [('topic', {'a': 1})]
+
+
+def test_model_is_kept_with_the_recording(tmp_path):
+    with pytest.raises(ValueError):
+        load_model(str(tmp_path))
+    model = dict(ACline=[dict(measid='m1', bus='b1', phases='A')], base_voltages={'B1': 4160.0}, switches=[])
+    save_model(str(tmp_path), model)
+    assert load_model(str(tmp_path)) == model
+
+
+def test_message_chunks_split_and_decode():
+    messages = [_message(t, m1=float(t), m2=float(-t)) for t in range(5)]
+    messages[3]['message']['measurements'].pop('m2')
+    chunks = list(message_chunks(messages, MEASIDS, chunk_rows=2))
+    assert [c[0].tolist() for c in chunks] == [[0, 1], [2, 3], [4]]
+    timestamps, values, present = chunks[1]
+    assert values['magnitude'][:, 0].tolist() == [2.0, 3.0]
+    assert present.tolist() == [[True, True], [True, False]]
+
+
+def test_recording_chunks_follow_the_requested_order(tmp_path):
+    recorder = MeasurementRecorder(str(tmp_path), MEASIDS, chunk_rows=2)
+    for t in range(3):
+        recorder.record(t, _message(t, m1=1.0 + t, m2=2.0 + t)['message']['measurements'])
+    assert recorder.close(5)
+    chunks = list(recording_chunks(RecordingReader(str(tmp_path)), ['m2', 'unknown', 'm1']))
+    timestamps = np.concatenate([c[0] for c in chunks])
+    values = np.concatenate([c[1] for c in chunks])
+    present = np.concatenate([c[2] for c in chunks])
+    assert timestamps.tolist() == [0, 1, 2]
+    assert values['magnitude'][:, 0].tolist() == [2.0, 3.0, 4.0]
+    assert np.isnan(values['magnitude'][:, 1]).all()
+    assert present.tolist() == [[True, False, True]] * 3
+
+
+class _App(object):
+
+    def __init__(self):
+        self.rows = []
+
+    def on_decoded(self, timestamp, values, present):
+        self.rows.append((timestamp, values['magnitude'].tolist(), present.tolist()))
+
+
+def test_replay_hands_every_row_to_the_app():
+    app = _App()
+    messages = [_message(100 + 3 * t, m1=float(t), m2=0.0) for t in range(4)]
+    replay = BatchReplay(app).run(message_chunks(messages, MEASIDS, chunk_rows=3))
+    assert [row[0] for row in app.rows] == [100, 103, 106, 109]
+    assert app.rows[2][1] == [2.0, 0.0]
+    assert replay.timesteps == 4
+    assert replay.simulated == 9
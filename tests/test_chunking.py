@@ -0,0 +1,79 @@
+import json
+import time
+
+from chunking import ChunkedSender, split
+
+
+def _message(n):
+    forward = [dict(object='cap{}'.format(i), attribute='ShuntCompensator.sections', value=1) for i in range(n)]
+    forward.append(dict(object='sw1', attribute='Switch.open', value=1))
+    reverse = [dict(d, value=0) for d in forward]
+    reverse.append(dict(object='reg1', attribute='TapChanger.step', value=3))
+    return {'command': 'update', 'input': {'simulation_id': '1', 'message': {
+        'timestamp': 10, 'difference_mrid': 'd1', 'forward_differences': forward, 'reverse_differences': reverse}}}
+
+
+def _differences(chunk, key):
+    return chunk['input']['message'][key]
+
+
+class _Connection(object):
+
+    def __init__(self):
+        self.sent = []
+
+    def send(self, topic, body):
+        self.sent.append((time.monotonic(), topic, json.loads(body)))
+
+
+def test_small_message_is_not_split():
+    message = _message(2)
+    assert split(message) == [message]
+
+
+def test_chunks_respect_the_bounds_and_keep_every_difference():
+    message = _message(40)
+    chunks = split(message, max_bytes=1500, max_differences=20)
+    assert len(chunks) > 1
+    for chunk in chunks:
+        assert len(json.dumps(chunk)) <= 1500
+        assert len(_differences(chunk, 'forward_differences')) + len(_differences(chunk, 'reverse_differences')) <= 20
+    for key in ('forward_differences', 'reverse_differences'):
+        found = [d for chunk in chunks for d in _differences(chunk, key)]
+        assert sorted(map(json.dumps, found)) == sorted(map(json.dumps, _differences(message, key)))
+    mrids = [chunk['input']['message']['difference_mrid'] for chunk in chunks]
+    assert mrids[0] == 'd1' and len(set(mrids)) == len(chunks)
+
+
+def test_chunks_keep_pairs_together_in_priority_order():
+    chunks = split(_message(10), max_differences=4)
+    first = chunks[0]['input']['message']
+    assert first['forward_differences'][0]['object'] == 'sw1'
+    assert first['reverse_differences'][:2] == [dict(object='sw1', attribute='Switch.open', value=0),
+                                                dict(object='reg1', attribute='TapChanger.step', value=3)]
+    for chunk in chunks:
+        body = chunk['input']['message']
+        forward = {d['object'] for d in body['forward_differences']}
+        assert forward <= {d['object'] for d in body['reverse_differences']}
+
+
+def test_unpaced_sender_sends_right_away():
+    connection = _Connection()
+    sender = ChunkedSender(connection, 'input', max_differences=10)
+    assert sender.send(_message(10)) == 3
+    assert len(connection.sent) == 3
+    assert sender.close()
+    assert sender.latency()['count'] == 3
+
+
+def test_paced_sender_spaces_chunks_and_flushes_on_close():
+    connection = _Connection()
+    sender = ChunkedSender(connection, 'input', max_differences=10, pace=0.05)
+    assert sender.send(_message(10)) == 3
+    deadline = time.monotonic() + 5
+    while len(connection.sent) < 2 and time.monotonic() < deadline:
+        time.sleep(0.005)
+    assert connection.sent[1][0] - connection.sent[0][0] >= 0.045
+    sender.send(_message(10))
+    assert sender.close(5)
+    assert sender.chunks == len(connection.sent) == 6
@@ -0,0 +1,56 @@
+from command_tracker import CommandTracker
+
+POS = [dict(eqid='sw1', measid='sw1-pos'), dict(eqid='cap1', measid='cap1-a'), dict(eqid='cap1', measid='cap1-b')]
+
+
+def _pos(**values):
+    return {measid: dict(measurement_mrid=measid, value=value) for measid, value in values.items()}
+
+
+def test_switch_open_is_confirmed_by_position_zero():
+    tracker = CommandTracker(POS)
+    tracker.track('sw1', 'Switch.open', 1, sent_at=0.0)
+    tracker.observe(1, _pos(**{'sw1-pos': 1}))
+    assert tracker.pending == 1
+    tracker.observe(2, _pos(**{'sw1-pos': 0}))
+    assert tracker.pending == 0
+    assert tracker.confirmed == 1
+    assert tracker.timesteps == {2: 1}
+
+
+def test_every_phase_must_reach_the_value():
+    tracker = CommandTracker(POS)
+    tracker.track('cap1', 'ShuntCompensator.sections', 1, sent_at=0.0)
+    tracker.observe(1, _pos(**{'cap1-a': 1, 'cap1-b': 0}))
+    assert tracker.confirmed == 0
+    tracker.observe(2, _pos(**{'cap1-a': 1, 'cap1-b': 1}))
+    assert tracker.confirmed == 1
+
+
+def test_unconfirmed_after_max_timesteps():
+    tracker = CommandTracker(POS, max_timesteps=2)
+    tracker.track('sw1', 'Switch.open', 0, sent_at=0.0)
+    tracker.observe(1, {})
+    tracker.observe(2, {})
+    assert tracker.pending == 0
+    assert len(tracker.unconfirmed) == 1
+
+
+def test_aliases_and_untracked_commands():
+    tracker = CommandTracker(POS, aliases={'tap1': ['reg-pos']})
+    tracker.track('tap1', 'TapChanger.step', 3, sent_at=0.0)
+    tracker.track('unknown', 'Switch.open', 1)
+    tracker.track('sw1', 'RegulatingControl.targetValue', 120)
+    assert tracker.pending == 1
+    assert tracker.untracked == 2
+    tracker.observe(1, _pos(**{'reg-pos': 3}))
+    assert tracker.confirmed == 1
+
+
+def test_track_message():
+    tracker = CommandTracker(POS)
+    message = {'input': {'message': {'forward_differences': [
+        dict(object='sw1', attribute='Switch.open', value=1),
+        dict(object='cap1', attribute='ShuntCompensator.sections', value=0)]}}}
+    tracker.track_message(message, sent_at=0.0)
+    assert tracker.pending == 2
@@ -0,0 +1,35 @@
+import numpy as np
+
+from decoder import MeasurementDecoder
+
+
+def test_full_and_incremental_messages():
+    decoder = MeasurementDecoder(['a', 'b', 'c'])
+    values, present = decoder.decode({'a': dict(magnitude=1.0, angle=2.0), 'b': dict(value=1),
+                                      'c': dict(magnitude=3.0), 'x': dict(value=9)})
+    assert present.tolist() == [True, True, True]
+    assert values['magnitude'][0] == 1.0 and values['value'][1] == 1.0
+    assert np.isnan(values['angle'][2])
+
+    values, present = decoder.decode({'b': dict(value=0)})
+    assert present.tolist() == [False, True, False]
+    assert np.isnan(values['magnitude'][0])
+
+
+def test_previous_timestep_stays_available():
+    decoder = MeasurementDecoder(['a'], buffers=2)
+    first, _ = decoder.decode({'a': dict(magnitude=1.0)})
+    second, _ = decoder.decode({'a': dict(magnitude=2.0)})
+    assert first['magnitude'][0] == 1.0 and second['magnitude'][0] == 2.0
+    third, _ = decoder.decode({'a': dict(magnitude=3.0)})
+    assert third is first
+
+
+def test_slots_and_load():
+    decoder = MeasurementDecoder(['a', 'b'])
+    assert decoder.slot_of(['b', 'a']).tolist() == [1, 0]
+    values = np.zeros(2, dtype=decoder.values.dtype)
+    values['magnitude'] = [5.0, 6.0]
+    loaded, present = decoder.load(values, np.array([True, False]))
+    assert loaded['magnitude'].tolist() == [5.0, 6.0]
+    assert decoder.present.tolist() == [True, False]
@@ -0,0 +1,140 @@
+import threading
+
+from dispatch import LagAwareDispatcher, LagMonitor, StartupBuffer, DEFAULT_MAX_PENDING
+
+
+def _message(timestamp, measurements=None):
+    return dict(message=dict(timestamp=timestamp, measurements=measurements or {}))
+
+
+class _Recorder(object):
+
+    def __init__(self, block=None):
+        self.timestamps = []
+        self._block = block
+
+    def on_message(self, headers, message):
+        if self._block is not None:
+            self._block.wait(5)
+        self.timestamps.append(message['message']['timestamp'])
+
+
+def test_lag_is_measured_against_the_smallest_offset():
+    monitor = LagMonitor(threshold=6.0)
+    assert monitor.update(100, now=1000.0) == 0.0
+    assert monitor.update(103, now=1005.0) == 2.0
+    assert not monitor.lagging
+
+
+def test_lagging_has_hysteresis():
+    monitor = LagMonitor(threshold=6.0)
+    monitor.update(100, now=1000.0)
+    monitor.update(103, now=1010.0)
+    assert monitor.lagging and monitor.overloads == 1
+    # still over the recovery threshold of 3s
+    monitor.update(106, now=1010.0)
+    assert monitor.lagging
+    monitor.update(109, now=1011.0)
+    assert not monitor.lagging
+
+
+def test_idle_handler_sets_a_new_baseline():
+    monitor = LagMonitor(threshold=6.0)
+    monitor.update(100, now=1000.0)
+    monitor.update(103, now=1010.0)
+    assert monitor.lagging
+    # the simulation was paused, everything received has been processed since
+    monitor.idle()
+    assert monitor.update(106, now=1100.0) == 0.0
+    assert not monitor.lagging
+    assert monitor.update(109, now=1103.0) == 0.0
+
+
+def test_no_threshold_never_lags():
+    monitor = LagMonitor(threshold=0)
+    monitor.update(100, now=1000.0)
+    monitor.update(101, now=2000.0)
+    assert not monitor.lagging
+
+
+def test_dispatcher_processes_every_timestep_without_lag():
+    handler = _Recorder()
+    taps = []
+    dispatcher = LagAwareDispatcher(handler, LagMonitor(threshold=None),
+                                    taps=[lambda timestamp, measurements: taps.append(timestamp)])
+    for timestamp in range(5):
+        dispatcher.on_message({}, _message(timestamp))
+    assert dispatcher.close(5)
+    assert handler.timestamps == list(range(5))
+    assert taps == list(range(5))
+    assert dispatcher.skipped == 0
+
+
+def test_dispatcher_skips_stale_timesteps_when_lagging():
+    block = threading.Event()
+    handler = _Recorder(block)
+    monitor = LagMonitor(threshold=1.0)
+    dispatcher = LagAwareDispatcher(handler, monitor, merge_skipped=True)
+    # timestamps far in the past of the first one make every later timestep late
+    dispatcher.on_message({}, _message(10 ** 9, {'m1': 1}))
+    for timestamp in range(1, 5):
+        dispatcher.on_message({}, _message(10 ** 9 - 100 * timestamp, {'m{}'.format(timestamp): timestamp}))
+    block.set()
+    assert dispatcher.close(5)
+    assert handler.timestamps[0] == 10 ** 9
+    assert handler.timestamps[-1] == 10 ** 9 - 400
+    assert dispatcher.skipped + dispatcher.processed == 5
+    assert dispatcher.skipped > 0
+
+
+def test_startup_buffer_hands_over_in_order():
+    seen = []
+    buffer = StartupBuffer(max_frames=10, taps=[lambda headers, message: seen.append(message)])
+    for timestamp in range(3):
+        buffer.on_message({}, _message(timestamp))
+    handler = _Recorder()
+    assert buffer.attach(handler) == 3
+    buffer.on_message({}, _message(3))
+    assert handler.timestamps == [0, 1, 2, 3]
+    assert len(seen) == 4 and buffer.buffered == 3
+
+
+def test_startup_buffer_folds_the_oldest_frames():
+    buffer = StartupBuffer(max_frames=2)
+    for timestamp in range(4):
+        buffer.on_message({}, _message(timestamp, {'m{}'.format(timestamp): timestamp}))
+    handler = _Recorder()
+    received = []
+    handler.on_message = lambda headers, message: received.append(message['message'])
+    assert buffer.attach(handler) == 2
+    assert buffer.folded == 2
+    assert [m['timestamp'] for m in received] == [2, 3]
+    assert sorted(received[0]['measurements']) == ['m0', 'm1', 'm2']
+
+
+def test_startup_buffer_collapses_into_one_timestep():
+    buffer = StartupBuffer(collapse=True)
+    buffer.on_message({}, '{"message": {"timestamp": 0, "measurements": {"m1": 1, "m2": 2}}}')
+    buffer.on_message({}, _message(1, {'m1': 3}))
+    received = []
+    handler = _Recorder()
+    handler.on_message = lambda headers, message: received.append(message['message'])
+    assert buffer.attach(handler) == 1
+    assert received == [dict(timestamp=1, measurements={'m1': 3, 'm2': 2})]
+
+
+def test_startup_buffer_larger_than_the_dispatcher_queue_is_handed_over_whole():
+    frames = DEFAULT_MAX_PENDING + 50
+    buffer = StartupBuffer(max_frames=frames)
+    for timestamp in range(frames):
+        buffer.on_message({}, _message(timestamp))
+    block = threading.Event()
+    handler = _Recorder(block)
+    dispatcher = LagAwareDispatcher(handler, LagMonitor(threshold=None),
+                                    max_pending=max(DEFAULT_MAX_PENDING, buffer.max_frames))
+    # the handler is stuck on the first frame while the rest are queued
+    assert buffer.attach(dispatcher) == frames
+    block.set()
+    assert dispatcher.close(5)
+    assert dispatcher.skipped == 0
+    assert handler.timestamps == list(range(frames))
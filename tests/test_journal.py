@@ -0,0 +1,74 @@
+import json
+import os
+import time
+
+from journal import INDEX_SUFFIX, CommandJournal, JournalReader, entries
+
+
+def _difference(timestamp, mrid, forward, reverse):
+    return json.dumps({'command': 'update', 'input': {'simulation_id': '123', 'message': {
+        'timestamp': timestamp, 'difference_mrid': 'd{}'.format(timestamp),
+        'forward_differences': [dict(object=mrid, attribute='Switch.open', value=forward)],
+        'reverse_differences': [dict(object=mrid, attribute='Switch.open', value=reverse),
+                                dict(object='other', attribute='Switch.open', value=1)]}}})
+
+
+def _journal(directory, messages, **kwargs):
+    journal = CommandJournal(str(directory), fsync_interval=0, **kwargs)
+    for message in messages:
+        journal.append('topic', message)
+    assert journal.close(5)
+    return journal
+
+
+def test_entries_pair_forward_and_reverse_differences():
+    found = entries('topic', _difference(10, 'sw1', 1, 0), 0, 0.0)
+    assert [(e['mrid'], e['forward'], e['reverse']) for e in found] == [('sw1', 1, 0), ('other', None, 1)]
+    assert found[0]['simulation_id'] == '123' and found[0]['timestamp'] == 10
+
+
+def test_close_writes_and_indexes_the_segment(tmp_path):
+    journal = _journal(tmp_path, [_difference(t, 'sw1', 1, 0) for t in range(3)] + ['not json'])
+    assert journal.messages == 4
+    assert journal.written == 6
+    assert journal.syncs >= 1
+    reader = JournalReader(str(tmp_path))
+    assert reader.segments() == ['journal_00000']
+    first, last, offsets = reader.index('journal_00000')
+    assert (first, last) == (0, 2)
+    assert len(offsets['sw1']) == 3
+
+
+def test_segments_rotate_and_are_queried_by_mrid_and_time(tmp_path):
+    journal = CommandJournal(str(tmp_path), segment_bytes=500, fsync_interval=0)
+    for t in range(20):
+        journal.append('topic', _difference(t, 'sw{}'.format(t % 2), t % 2, 1 - t % 2))
+        # segments rotate between write batches
+        deadline = time.monotonic() + 5
+        while journal.written < 2 * (t + 1) and time.monotonic() < deadline:
+            time.sleep(0.001)
+    assert journal.close(5)
+    reader = JournalReader(str(tmp_path))
+    assert len(reader.segments()) > 1
+    assert [e['timestamp'] for e in reader.query('sw1', 5, 12)] == [5, 7, 9, 11]
+    assert len(list(reader.query())) == 40
+    assert list(reader.query('missing')) == []
+
+
+def test_segment_without_index_is_scanned(tmp_path):
+    _journal(tmp_path, [_difference(1, 'sw1', 1, 0), _difference(2, 'sw2', 1, 0)])
+    os.remove(os.path.join(str(tmp_path), 'journal_00000' + INDEX_SUFFIX))
+    with open(os.path.join(str(tmp_path), 'journal_00000.jsonl'), 'ab') as f:
+        f.write(b'{"cut short')
+    reader = JournalReader(str(tmp_path))
+    assert reader.index('journal_00000')[:2] == (1, 2)
+    assert [e['timestamp'] for e in reader.query('sw2')] == [2]
+
+
+def test_reopened_journal_continues_after_the_last_segment(tmp_path):
+    _journal(tmp_path, [_difference(1, 'sw1', 1, 0)])
+    _journal(tmp_path, [_difference(2, 'sw1', 0, 1)])
+    _journal(tmp_path, [])
+    reader = JournalReader(str(tmp_path))
+    assert reader.segments() == ['journal_00000', 'journal_00001']
+    assert [e['forward'] for e in reader.query('sw1')] == [1, 0]
@@ -0,0 +1,77 @@
+import json
+import threading
+import time
+
+from lifecycle import SimulationLifecycle, COMPLETE, IDLE, PAUSED
+
+
+def test_final_status_releases_wait():
+    lifecycle = SimulationLifecycle('123')
+    lifecycle.on_message({}, json.dumps(dict(processId='123', processStatus='RUNNING')))
+    assert not lifecycle.wait(0)
+    lifecycle.on_message({}, dict(processId='123', processStatus=COMPLETE, logMessage='done'))
+    assert lifecycle.wait(0)
+    assert lifecycle.reason == COMPLETE
+
+
+def test_other_simulations_and_pauses_are_ignored():
+    lifecycle = SimulationLifecycle('123')
+    lifecycle.on_message({}, dict(processId='456', processStatus=COMPLETE))
+    lifecycle.on_message({}, dict(processId='123', procesStatus=PAUSED))
+    lifecycle.on_message({}, 'not json')
+    assert lifecycle.status == PAUSED
+    assert not lifecycle.finished
+
+
+def test_drain_in_registration_order_and_reports_failures():
+    lifecycle = SimulationLifecycle()
+    drained = []
+    lifecycle.register('first', lambda timeout: drained.append('first') or True)
+    lifecycle.register('late', lambda timeout: drained.append('late') or False)
+
+    def broken(timeout):
+        raise RuntimeError("broken")
+    lifecycle.register('broken', broken)
+    assert not lifecycle.drain(1.0)
+    assert drained == ['first', 'late']
+
+
+def test_status_reported_before_wait_is_kept():
+    lifecycle = SimulationLifecycle('123', idle_timeout=60)
+    lifecycle.on_message({}, dict(processId='123', processStatus=COMPLETE))
+    assert lifecycle.wait()
+    assert lifecycle.reason == COMPLETE
+
+
+def test_wait_gives_up_on_an_idle_simulation():
+    lifecycle = SimulationLifecycle('123', idle_timeout=0.05)
+    assert not lifecycle.wait(0.01)
+    assert lifecycle.wait(5)
+    assert lifecycle.reason == IDLE
+
+
+def test_output_keeps_the_simulation_alive():
+    lifecycle = SimulationLifecycle('123', idle_timeout=0.2)
+    stop = threading.Event()
+
+    def output():
+        while not stop.wait(0.02):
+            lifecycle.seen({}, {})
+    thread = threading.Thread(target=output)
+    thread.start()
+    try:
+        assert not lifecycle.wait(0.5)
+    finally:
+        stop.set()
+        thread.join()
+    assert lifecycle.wait(5) and lifecycle.reason == IDLE
+
+
+def test_paused_simulation_is_not_given_up():
+    lifecycle = SimulationLifecycle('123', idle_timeout=0.05)
+    lifecycle.on_message({}, dict(processId='123', processStatus=PAUSED))
+    assert not lifecycle.wait(0.2)
+    start = time.monotonic()
+    lifecycle.on_message({}, dict(processId='123', processStatus='RUNNING'))
+    assert lifecycle.wait(5) and lifecycle.reason == IDLE
+    assert time.monotonic() - start >= 0.04
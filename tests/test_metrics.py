@@ -0,0 +1,29 @@
+import math
+
+from metrics import LatencyHistogram
+
+
+def test_empty_histogram():
+    histogram = LatencyHistogram()
+    assert math.isnan(histogram.percentile(50))
+    summary = histogram.summary()
+    assert summary['count'] == 0 and math.isnan(summary['max'])
+
+
+def test_percentiles_stay_within_the_samples():
+    histogram = LatencyHistogram()
+    for value in [0.003] * 90 + [0.4] * 10:
+        histogram.record(value)
+    assert histogram.count == 100
+    assert math.isclose(histogram.mean, 0.0427)
+    assert 0.003 <= histogram.percentile(50) <= 0.005
+    assert 0.2 <= histogram.percentile(95) <= 0.4
+    assert histogram.percentile(100) == 0.4
+
+
+def test_values_beyond_the_last_bound():
+    histogram = LatencyHistogram(bounds=(1.0,))
+    histogram.record(5.0)
+    histogram.record(15.0)
+    assert histogram.counts == [0, 2]
+    assert 5.0 <= histogram.percentile(50) <= 15.0
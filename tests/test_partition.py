@@ -0,0 +1,58 @@
+import pytest
+
+from partition import PartialResultMerger, ShardLock, merge, select_shard, shard_of
+
+PNV = [dict(bus='b{}'.format(i // 3), phases='ABC'[i % 3], eqid='line{}'.format(i // 3)) for i in range(60)]
+
+
+@pytest.mark.parametrize('key', ['bus', 'phase', 'equipment'])
+def test_shards_are_disjoint_and_complete(key):
+    shards = [select_shard(PNV, key, i, 3) for i in range(3)]
+    assert sum(len(s) for s in shards) == len(PNV)
+    assert all(shards)
+
+
+def test_bus_shard_keeps_the_phases_of_a_bus_together():
+    for d in PNV:
+        assert shard_of(d, 'bus', 4) == shard_of(dict(d, phases='A'), 'bus', 4)
+    with pytest.raises(ValueError):
+        shard_of(PNV[0], 'feeder', 2)
+
+
+def test_merge():
+    merged = merge([dict(violations={'A': {'low_a': 1}}, anomalous_buses=['b1'], regulator_taps={'r.A': 1},
+                         devices_near_violations={'sw1': ['b1']}, bands={'A': {'low_a': ['b1']}}),
+                    dict(violations={'A': {'low_a': 2}, 'B': {'low_a': 1}}, anomalous_buses=['b2', 'b1'],
+                         regulator_taps={'r.B': 2}, devices_near_violations={'sw1': ['b3'], 'sw2': ['b2']},
+                         bands={'A': {'low_a': ['b4']}, 'B': {'low_a': ['b2']}})])
+    assert merged['violations'] == {'A': {'low_a': 3}, 'B': {'low_a': 1}}
+    assert merged['anomalous_buses'] == ['b1', 'b2']
+    assert merged['regulator_taps'] == {'r.A': 1, 'r.B': 2}
+    assert merged['devices_near_violations'] == {'sw1': ['b1', 'b3'], 'sw2': ['b2']}
+    assert merged['bands'] == {'A': {'low_a': ['b1', 'b4']}, 'B': {'low_a': ['b2']}}
+
+
+def test_merger_waits_for_every_shard_or_newer_timesteps():
+    merged = []
+    merger = PartialResultMerger(2, lambda timestamp, values, missing: merged.append((timestamp, missing)),
+                                 max_wait=2)
+    merger.add(0, 0, {})
+    merger.add(0, 1, {})
+    assert merged == [(0, [])]
+    merger.add(1, 0, {})
+    merger.add(2, 0, {})
+    merger.add(3, 0, {})
+    assert merged == [(0, []), (1, [1])]
+    merger.close()
+    assert [ts for ts, _ in merged] == [0, 1, 2, 3]
+    assert merger.incomplete == 3
+
+
+def test_shard_lock_claims_free_shards(tmp_path):
+    first = ShardLock(str(tmp_path), 2)
+    second = ShardLock(str(tmp_path), 2)
+    assert (first.index, second.index) == (0, 1)
+    with pytest.raises(RuntimeError):
+        ShardLock(str(tmp_path), 2)
+    first.close()
+    assert ShardLock(str(tmp_path), 2).index == 0
@@ -0,0 +1,92 @@
+from pipeline import Pipeline, Stage
+
+GROUPS = {'pnv': ['v1', 'v2'], 'pos': ['p1']}
+
+
+def _measurements(v1=1.0, v2=2.0, p1=1):
+    return {'v1': dict(magnitude=v1, angle=0.0), 'v2': dict(magnitude=v2, angle=0.0), 'p1': dict(value=p1)}
+
+
+class _Total(Stage):
+    name = 'total'
+    inputs = ('pnv',)
+    provides = ('total',)
+
+    def run(self, context):
+        context.results['total'] = float(context.groups['pnv'].magnitude.sum())
+
+
+class _Position(Stage):
+    name = 'position'
+    inputs = ('pos',)
+    provides = ('position',)
+
+    def run(self, context):
+        context.results['position'] = int(context.groups['pos'].value[0])
+
+
+class _Alarm(Stage):
+    name = 'alarm'
+    exclusive = True
+    inputs = ('pnv',)
+    requires = ('total',)
+    provides = ('alarms',)
+    events = ('alarms',)
+
+    def run(self, context):
+        if context.results['total'] > 5:
+            context.results['alarms'] = ['high']
+
+
+class _Report(Stage):
+    name = 'report'
+    requires = ('total', 'position', 'alarms')
+
+    def __init__(self):
+        self.reports = []
+
+    def run(self, context):
+        self.reports.append({key: context.results.get(key) for key in self.requires})
+
+
+def _pipeline(**kwargs):
+    report = _Report()
+    return Pipeline(GROUPS, [_Total(), _Position(), _Alarm(), report], **kwargs), report
+
+
+def test_waves_follow_dependencies_and_exclusive_stages():
+    pipeline, _ = _pipeline()
+    assert pipeline.waves == [['total', 'position'], ['alarm'], ['report']]
+
+
+def test_stages_with_unchanged_inputs_are_skipped():
+    pipeline, report = _pipeline()
+    pipeline.run(0, _measurements())
+    context = pipeline.run(1, _measurements(p1=0))
+    assert context.ran == ['position', 'report']
+    assert context.skipped == ['total', 'alarm']
+    assert report.reports[-1] == dict(total=3.0, position=0, alarms=None)
+
+
+def test_events_do_not_carry_over_to_skipped_timesteps():
+    pipeline, report = _pipeline()
+    pipeline.run(0, _measurements(v1=4.0))
+    assert report.reports[-1]['alarms'] == ['high']
+    # PNV unchanged, the alarm stage is skipped and its alarms are not repeated
+    pipeline.run(1, _measurements(v1=4.0, p1=0))
+    assert report.reports[-1] == dict(total=6.0, position=0, alarms=None)
+
+
+def test_disabled_stages():
+    pipeline = Pipeline(GROUPS, [_Total(), _Position()], enabled=['position'])
+    assert pipeline.stages == ['position']
+
+
+def test_concurrent_waves_give_the_same_results():
+    sequential, expected = _pipeline()
+    concurrent, report = _pipeline(workers=2)
+    for timestamp, kwargs in enumerate([{}, dict(v1=4.0), dict(p1=0), dict(v1=0.5)]):
+        sequential.run(timestamp, _measurements(**kwargs))
+        concurrent.run(timestamp, _measurements(**kwargs))
+    concurrent.close()
+    assert report.reports == expected.reports
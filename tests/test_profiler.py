@@ -0,0 +1,53 @@
+import json
+import os
+
+from profiler import TimestepProfiler
+
+
+class _Handler(object):
+
+    def __init__(self):
+        self.calls = 0
+
+    def on_message(self, headers, message):
+        self.calls += 1
+        return sum(range(1000))
+
+
+def test_idle_until_requested(tmp_path):
+    handler = _Handler()
+    profiler = TimestepProfiler(handler, str(tmp_path))
+    profiler.on_message({}, {})
+    assert handler.calls == 1
+    assert profiler.captures == []
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_capture_of_the_requested_timesteps(tmp_path):
+    handler = _Handler()
+    profiler = TimestepProfiler(handler, str(tmp_path), sample_interval=0.001)
+    profiler.on_control({}, json.dumps(dict(command='profile', timesteps=2)))
+    for _ in range(3):
+        profiler.on_message({}, {})
+    assert handler.calls == 3
+    assert len(profiler.captures) == 1
+    for suffix in ('.pstats', '.txt', '.collapsed'):
+        assert os.path.exists(profiler.captures[0] + suffix)
+    with open(profiler.captures[0] + '.txt') as f:
+        assert 'on_message' in f.read()
+
+
+def test_close_writes_a_capture_in_progress(tmp_path):
+    profiler = TimestepProfiler(_Handler(), str(tmp_path))
+    profiler.request(5)
+    profiler.on_message({}, {})
+    assert profiler.close()
+    assert len(profiler.captures) == 1
+
+
+def test_other_control_messages_are_ignored(tmp_path):
+    profiler = TimestepProfiler(_Handler(), str(tmp_path))
+    profiler.on_control({}, 'not json')
+    profiler.on_control({}, dict(command='stop'))
+    profiler.on_message({}, {})
+    assert profiler.captures == []
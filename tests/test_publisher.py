@@ -0,0 +1,100 @@
+import json
+import threading
+
+from publisher import AnalyticsPublisher, decode, flatten, DELTA, FULL
+
+
+class _Connection(object):
+
+    def __init__(self):
+        self.sent = []
+        self.lock = threading.Lock()
+
+    def send(self, topic, body):
+        with self.lock:
+            self.sent.append(body)
+
+
+def test_flatten():
+    assert flatten(dict(a=dict(b=1, c=dict(d=2)), e=[], f={})) == {'a.b': 1, 'a.c.d': 2, 'e': [], 'f': {}}
+
+
+def test_deltas_rebuild_the_results():
+    publisher = AnalyticsPublisher(_Connection(), 'topic', keyframe_interval=3, compress=True)
+    history = [dict(a=1, b=dict(c=2)), dict(a=1, b=dict(c=3)), dict(a=2), dict(a=2, d=4)]
+    state = None
+    for i, values in enumerate(history):
+        message = publisher.encode(i, values)
+        state = decode(message, state)
+        assert state == flatten(values)
+    publisher.close(1)
+
+
+def test_delta_only_holds_the_changes():
+    publisher = AnalyticsPublisher(_Connection(), 'topic')
+    assert json.loads(publisher.encode(0, dict(a=1, b=2)))['type'] == FULL
+    document = json.loads(publisher.encode(1, dict(a=1, c=3)))
+    assert document['type'] == DELTA
+    assert document['changed'] == {'c': 3}
+    assert document['removed'] == ['b']
+    assert decode(document) is None
+    publisher.close(1)
+
+
+def test_timesteps_are_coalesced_to_the_rate():
+    connection = _Connection()
+    publisher = AnalyticsPublisher(connection, 'topic', max_rate=0.5)
+    for i in range(20):
+        publisher.publish(i, dict(i=i))
+    assert publisher.close(5)
+    assert publisher.published + publisher.coalesced == 20
+    assert publisher.published <= 3
+    state = None
+    for body in connection.sent:
+        state = decode(body, state)
+    assert state == {'i': 19}
+
+
+def test_set_keys_are_sent_as_added_and_removed_members():
+    publisher = AnalyticsPublisher(_Connection(), 'topic')
+    history = [dict(bands=dict(A=dict(low_a=['b1', 'b2'])), open_switches=['sw1'], fired_rules=['r2', 'r1']),
+               dict(bands=dict(A=dict(low_a=['b3', 'b2'])), open_switches=['sw1'], fired_rules=['r2', 'r1']),
+               dict(bands=dict(A=dict(low_a=['b2'])), open_switches=[], fired_rules=['r1'])]
+    state = decode(publisher.encode(0, history[0]))
+    document = json.loads(publisher.encode(1, history[1]))
+    assert document['changed'] == {}
+    assert document['members'] == {'bands.A.low_a': dict(added=['b3'], removed=['b1'])}
+    state = decode(document, state)
+    assert state['bands.A.low_a'] == ['b2', 'b3']
+    document = json.loads(publisher.encode(2, history[2]))
+    assert document['changed'] == {'fired_rules': ['r1']}
+    assert document['members'] == {'bands.A.low_a': dict(added=[], removed=['b3']),
+                                   'open_switches': dict(added=[], removed=['sw1'])}
+    state = decode(document, state)
+    assert state == {'bands.A.low_a': ['b2'], 'open_switches': [], 'fired_rules': ['r1']}
+    assert state.sequence == 2 and state.timestamp == 2
+    publisher.close(1)
+
+
+def test_gap_in_sequence_waits_for_a_full_message():
+    publisher = AnalyticsPublisher(_Connection(), 'topic', keyframe_interval=3)
+    messages = [publisher.encode(i, dict(a=i)) for i in range(4)]
+    state = decode(messages[0])
+    assert decode(messages[2], state) is None
+    assert decode(messages[3]) == {'a': 3}
+    assert decode(messages[1], decode(messages[0])) == {'a': 1}
+    publisher.close(1)
+
+
+def test_summary_holds_the_buses_of_every_band():
+    import numpy as np
+
+    from stages import summarize
+    from violations import VoltageViolationEngine
+
+    pnv = [dict(measid='m1', bus='b1', phases='A'), dict(measid='m2', bus='b2', phases='A')]
+    engine = VoltageViolationEngine(pnv, {'B1': 4160.0, 'B2': 4160.0})
+    values = summarize(dict(violations=engine.evaluate(0, np.array([2000.0, 2400.0]))))
+    assert values['bands'] == {'A': dict(below_b=['B1'], low_a=[], high_a=[], above_b=[])}
+    assert values['violations']['A']['below_b'] == 1
+    json.dumps(values)
@@ -0,0 +1,102 @@
+import json
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+
+import numpy as np
+import pytest
+
+from query_server import CommandError, CommandQueue, QueryServer
+from snapshot import SnapshotStore
+from topology import TopologyIndex
+from violations import VoltageViolationEngine
+
+SWITCHES = [dict(name='sw1', mrid='_sw1')]
+REGULATORS = [dict(name='reg1', mrid='_reg1', low_step=-16, high_step=16)]
+
+
+def _results(t):
+    return dict(open_switches=['sw1'], regulator_taps={'reg1.A': t},
+                pnv_magnitude=np.array([7000.0, 7300.0, 7500.0]), pnv_per_unit=np.array([0.97, 1.01, 1.04]),
+                pnv_buses=np.array(['B1', 'B2', 'B3']), pnv_phases=np.array(['A', 'A', 'B']))
+
+
+@pytest.fixture
+def server():
+    store = SnapshotStore(history=5)
+    server = QueryServer(store, CommandQueue(SWITCHES, REGULATORS), port=0)
+    yield server
+    assert server.close(5)
+
+
+def test_command_queue_checks_and_drains_in_order():
+    queue = CommandQueue(SWITCHES, REGULATORS)
+    assert queue.submit(dict(switch='sw1', action='open')) == dict(switch='sw1', action='open', mrid='_sw1', id=1)
+    assert queue.submit(dict(regulator='reg1', step='4'))['step'] == 4
+    for command in ([], dict(switch='sw2', action='open'), dict(switch='sw1', action='toggle'),
+                    dict(regulator='reg1', step='x'), dict(regulator='reg1', step=17), dict(capacitor='c1')):
+        with pytest.raises(CommandError):
+            queue.submit(command)
+    assert len(queue) == 2
+    assert [c['id'] for c in queue.drain()] == [1, 2]
+    assert queue.drain() == []
+
+
+def test_get_before_and_after_the_first_timestep(server):
+    assert server.get('/status', {}) == (200, dict(version=0, timestamp=None, queued_commands=0))
+    assert server.get('/taps', {})[0] == 503
+    assert server.get('/unknown', {})[0] == 404
+    server.snapshots.publish(10, _results(1))
+    server.snapshots.publish(11, _results(2))
+    assert server.get('/taps', {}) == (200, dict(version=2, timestamp=11, regulator_taps={'reg1.A': 2}))
+    assert server.get('/switches', {})[1]['open_switches'] == ['sw1']
+    assert server.get('/bands', {})[0] == 503
+    assert [h['timestamp'] for h in server.get('/history', dict(start=['11']))[1]] == [11]
+
+
+def test_bus_queries(server):
+    server.snapshots.publish(10, _results(1))
+    assert server.get('/buses', dict(min=['7100'], max=['8000']))[1]['buses'] == ['B2', 'B3']
+    assert server.get('/buses', dict(phase=['A'], min=['0.96'], max=['1.0'], per_unit=['1']))[1]['buses'] == ['B1']
+    with pytest.raises(ValueError):
+        server.get('/buses', dict(min=['low'], max=['1']))
+
+
+def test_http_round_trip(server):
+    server.snapshots.publish(10, _results(1))
+    url = 'http://{}'.format(server.address)
+    request = Request(url + '/commands', data=json.dumps(dict(switch='sw1', action='close')).encode('utf-8'),
+                      method='POST')
+    with urlopen(request, timeout=5) as response:
+        assert response.status == 202
+        assert json.loads(response.read())['queued']['mrid'] == '_sw1'
+    with urlopen(url + '/status', timeout=5) as response:
+        assert json.loads(response.read())['queued_commands'] == 1
+    with pytest.raises(HTTPError) as error:
+        urlopen(url + '/buses?min=a&max=1', timeout=5)
+    assert error.value.code == 400
+    request = Request(url + '/commands', data=b'{"switch": "sw9", "action": "open"}', method='POST')
+    with pytest.raises(HTTPError) as error:
+        urlopen(request, timeout=5)
+    assert error.value.code == 400
+
+
+def test_neighbourhood():
+    topology = TopologyIndex([('b1', 'b2'), ('b2', 'b3'), ('b3', 'b4')], {'switch:sw1': ['b3', 'b4']})
+    store = SnapshotStore()
+    server = QueryServer(store, CommandQueue(SWITCHES, REGULATORS), port=0, topology=topology)
+    try:
+        status, document = server.get('/neighbourhood', dict(bus=['b2'], hops=['1']))
+        assert status == 200
+        assert document == dict(bus='B2', hops=1, buses=dict(B2=0, B1=1, B3=1), devices=['switch:sw1'])
+        pnv = [dict(measid='m1', bus='b1', phases='A'), dict(measid='m4', bus='b4', phases='A')]
+        engine = VoltageViolationEngine(pnv, {'B1': 4160.0, 'B4': 4160.0})
+        store.publish(10, dict(violations=engine.evaluate(10, np.array([2000.0, 2000.0]))))
+        assert server.get('/neighbourhood', dict(bus=['b2'], hops=['1']))[1]['out_of_band'] == ['B1']
+        assert server.get('/neighbourhood', dict(bus=['b9']))[0] == 404
+        assert server.get('/neighbourhood', dict(bus=['b1']))[1]['hops'] == topology.max_hops
+    finally:
+        server.close(5)
+
+
+def test_neighbourhood_needs_the_topology(server):
+    assert server.get('/neighbourhood', dict(bus=['b1']))[0] == 503
@@ -0,0 +1,75 @@
+import os
+
+import numpy as np
+import pytest
+
+from recorder import MeasurementRecorder, RecorderError, RecordingReader
+
+MEASIDS = ['m1', 'm2', 'm3']
+
+
+def _measurements(i):
+    return {measid: dict(measurement_mrid=measid, magnitude=float(i * 10 + k), angle=1.0)
+            for k, measid in enumerate(MEASIDS)}
+
+
+def _record(directory, timestamps, **kwargs):
+    recorder = MeasurementRecorder(str(directory), MEASIDS, chunk_rows=2, **kwargs)
+    for i in timestamps:
+        recorder.record(i, _measurements(i))
+    assert recorder.close(5)
+    return recorder
+
+
+def test_round_trip(tmp_path):
+    _record(tmp_path, range(5))
+    reader = RecordingReader(str(tmp_path))
+    assert reader.column('timestamp').tolist() == [0, 1, 2, 3, 4]
+    magnitude = reader.column('magnitude', ['m2'])
+    assert magnitude[:, 0].tolist() == [1.0, 11.0, 21.0, 31.0, 41.0]
+
+
+def test_compressed_round_trip(tmp_path):
+    _record(tmp_path, range(3), compress=True)
+    assert RecordingReader(str(tmp_path)).column('timestamp').tolist() == [0, 1, 2]
+
+
+def test_reused_directory_continues_segments(tmp_path):
+    _record(tmp_path, range(3))
+    recorder = _record(tmp_path, range(3, 8))
+    assert recorder.recorded == 5
+    assert RecordingReader(str(tmp_path)).column('timestamp').tolist() == list(range(8))
+
+
+def test_more_than_ten_segments_read_in_order(tmp_path):
+    _record(tmp_path, range(25))
+    assert RecordingReader(str(tmp_path)).column('timestamp').tolist() == list(range(25))
+
+
+def test_reused_directory_with_other_measids_is_rejected(tmp_path):
+    _record(tmp_path, range(2))
+    with pytest.raises(ValueError):
+        MeasurementRecorder(str(tmp_path), ['other'])
+
+
+def test_stale_temporary_segment_is_removed(tmp_path):
+    os.makedirs(os.path.join(str(tmp_path), '.segment_00000'))
+    with open(os.path.join(str(tmp_path), '.segment_00000', 'timestamp.npy'), 'w') as f:
+        f.write('partial')
+    _record(tmp_path, range(3))
+    assert not os.path.exists(os.path.join(str(tmp_path), '.segment_00000'))
+    assert RecordingReader(str(tmp_path)).column('timestamp').tolist() == [0, 1, 2]
+
+
+def test_flush_failure_is_raised_by_close(tmp_path, monkeypatch):
+    recorder = MeasurementRecorder(str(tmp_path), MEASIDS, chunk_rows=2)
+
+    def fail(*args, **kwargs):
+        raise OSError("disk full")
+    monkeypatch.setattr(np, 'save', fail)
+    for i in range(3):
+        recorder.record(i, _measurements(i))
+    with pytest.raises(RecorderError):
+        recorder.close(5)
+    assert recorder.lost == 3
+    assert not recorder._thread.is_alive()
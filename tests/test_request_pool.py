@@ -0,0 +1,73 @@
+import json
+import threading
+import time
+
+import pytest
+
+from request_pool import RequestChannelPool, RequestTimeout, REQUEST_POWERGRID_DATA
+
+
+class _Connection(object):
+    """ Answers every request with the request itself after ``delay`` seconds """
+
+    def __init__(self, delay=0.0, answer=True):
+        self.delay = delay
+        self.answer = answer
+        self.waiting = 0
+        self.most_waiting = 0
+        self.disconnected = False
+        self._lock = threading.Lock()
+
+    def get_response(self, topic, message, timeout=5):
+        with self._lock:
+            self.waiting += 1
+            self.most_waiting = max(self.most_waiting, self.waiting)
+        time.sleep(self.delay)
+        with self._lock:
+            self.waiting -= 1
+        return dict(topic=topic, request=json.loads(message)) if self.answer else None
+
+    def disconnect(self):
+        self.disconnected = True
+
+
+def test_query_data_goes_through_get_response():
+    connections = []
+    pool = RequestChannelPool(lambda: connections.append(_Connection()) or connections[-1], size=1)
+    response = pool.query_data("SELECT ?s")
+    assert response['topic'] == REQUEST_POWERGRID_DATA
+    assert response['request']['queryString'] == "SELECT ?s"
+    assert pool.close()
+    assert connections[0].disconnected
+
+
+def test_one_request_in_flight_per_connection():
+    connections = []
+    pool = RequestChannelPool(lambda: connections.append(_Connection(delay=0.02)) or connections[-1], size=3)
+    futures = [pool.submit('get_response', 'topic', {'n': n}) for n in range(12)]
+    assert sorted(f.result(5)['request']['n'] for f in futures) == list(range(12))
+    pool.close()
+    assert [c.most_waiting for c in connections] == [1, 1, 1]
+
+
+def test_missing_response_raises_timeout():
+    pool = RequestChannelPool(lambda: _Connection(answer=False), size=1)
+    with pytest.raises(RequestTimeout):
+        pool.get_response('topic', {'n': 1}, timeout=0.1)
+    # the channel is usable again
+    with pytest.raises(RequestTimeout):
+        pool.get_response('topic', '{"n": 2}', timeout=0.1)
+
+
+def test_waiting_for_a_channel_is_bounded_by_the_timeout():
+    pool = RequestChannelPool(lambda: _Connection(delay=0.3), size=1)
+    busy = pool.submit('get_response', 'topic', {'n': 1}, timeout=5)
+    time.sleep(0.05)
+    assert pool.idle == 0
+    start = time.monotonic()
+    with pytest.raises(RequestTimeout):
+        pool.get_response('topic', {'n': 2}, timeout=0.05)
+    assert time.monotonic() - start < 0.2
+    assert busy.result(5)['request'] == {'n': 1}
+    assert pool.idle == 1
+    pool.close()
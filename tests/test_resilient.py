@@ -0,0 +1,94 @@
+import threading
+import time
+
+import pytest
+
+from resilient import RequestDeadlineExceeded, RequestFailed, ResilientRequester
+
+
+class _Target(object):
+    """ Answers ``get_response`` with the next scripted reply, an exception or a delay """
+
+    def __init__(self, replies):
+        self._replies = list(replies)
+        self._lock = threading.Lock()
+        self.calls = 0
+
+    def get_response(self, topic, message, timeout=None):
+        with self._lock:
+            self.calls += 1
+            reply = self._replies.pop(0) if len(self._replies) > 1 else self._replies[0]
+        if isinstance(reply, Exception):
+            raise reply
+        if isinstance(reply, tuple):
+            time.sleep(reply[0])
+            return reply[1]
+        return reply
+
+
+def _requester(target, **kwargs):
+    kwargs.setdefault('base_delay', 0.001)
+    kwargs.setdefault('hedge_percentile', 0)
+    return ResilientRequester(target, **kwargs)
+
+
+def test_retries_until_an_answer():
+    target = _Target([TimeoutError(), ConnectionError(), dict(data=[1])])
+    requester = _requester(target)
+    assert requester.get_response('topic', {'requestType': 'x'}) == dict(data=[1])
+    assert target.calls == 3
+    stats = requester.stats()
+    assert stats['retries'] == 2 and stats['failures'] == 0
+    assert stats['latency']['topic:x']['count'] == 1
+    assert requester.close()
+
+
+def test_gives_up_after_the_retries():
+    target = _Target([TimeoutError()])
+    requester = _requester(target, retries=2)
+    with pytest.raises(TimeoutError):
+        requester.get_response('topic', {})
+    assert target.calls == 3
+    assert requester.stats()['failures'] == 1
+    requester.close()
+
+
+def test_platform_errors_are_not_retried():
+    target = _Target([dict(error='bad request')])
+    requester = _requester(target, retries=2)
+    with pytest.raises(RequestFailed):
+        requester.get_response('topic', {})
+    assert target.calls == 1
+    assert requester.stats()['retries'] == 0
+    requester.close()
+
+
+def test_deadline_bounds_the_retries():
+    requester = _requester(_Target([TimeoutError()]), retries=100, deadline=0.05, base_delay=0.02)
+    with pytest.raises(RequestDeadlineExceeded):
+        requester.get_response('topic', {})
+    requester.close()
+
+
+def test_slow_requests_are_hedged():
+    target = _Target([dict(data=1)] * 5 + [(1.0, dict(data='slow')), dict(data='hedge')])
+    requester = _requester(target, hedge_percentile=90, hedge_min_samples=5)
+    for _ in range(5):
+        requester.get_response('topic', {})
+    start = time.monotonic()
+    assert requester.submit('get_response', 'topic', {}).result() == dict(data='hedge')
+    assert time.monotonic() - start < 0.9
+    assert requester.stats()['hedges'] == 1 and requester.stats()['hedge_wins'] == 1
+    requester.close()
+
+
+def test_no_hedge_without_an_idle_channel():
+    target = _Target([dict(data=1)] * 5 + [(0.1, dict(data='slow')), dict(data='hedge')])
+    requester = _requester(target, hedge_percentile=90, hedge_min_samples=5)
+    for _ in range(5):
+        requester.get_response('topic', {})
+    target.idle = 0
+    assert requester.get_response('topic', {}) == dict(data='slow')
+    assert requester.stats()['hedges'] == 0
+    assert target.calls == 6
+    requester.close()
@@ -0,0 +1,107 @@
+import math
+
+import numpy as np
+import pytest
+
+from rules import RuleEngine, RuleError
+from violations import VoltageViolationEngine
+
+BASE = 4160.0 / math.sqrt(3)
+PNV = [dict(measid='v1', bus='n1', phases='A'), dict(measid='v2', bus='n2', phases='A'),
+       dict(measid='v3', bus='n2', phases='B')]
+SWITCHES = [dict(name='sw1', mrid='sw1-mrid')]
+REGULATORS = [dict(name='reg1', mrid='reg1-mrid', low_step=-16, high_step=16)]
+
+
+class _Diff(object):
+
+    def __init__(self):
+        self.differences = []
+
+    def add_difference(self, mrid, attribute, forward, reverse):
+        self.differences.append((mrid, attribute, forward, reverse))
+
+
+def _engine(rules):
+    violations = VoltageViolationEngine(PNV, {'N1': 4160.0, 'N2': 4160.0})
+    return RuleEngine(rules, violations, SWITCHES, REGULATORS, {'reg1-mrid': ['reg1-pos']},
+                      {'sw1-mrid': ['sw1-pos-a', 'sw1-pos-b']})
+
+
+def _pos(**values):
+    return {measid.replace('_', '-'): dict(value=value) for measid, value in values.items()}
+
+
+def test_reductions_by_group():
+    engine = _engine([dict(name='min A', when=dict(phases=['A'], reduce='min', op='<', value=0.95),
+                           then=dict(switch='sw1')),
+                      dict(name='mean n2', when=dict(buses=['n2'], reduce='mean', op='>', value=1.0),
+                           then=dict(switch='sw1')),
+                      dict(name='max volts', when=dict(reduce='max', op='>', value=3000, unit='V'),
+                           then=dict(switch='sw1'))])
+    magnitude = np.array([0.9, 1.0, 1.1]) * BASE
+    assert np.allclose(engine.reduce(magnitude)[:2], [0.9, 1.05])
+    assert engine.fired(0, magnitude).tolist() == [0, 1]
+
+
+def test_tap_step_within_limits():
+    engine = _engine([dict(when=dict(op='<', value=0.95), then=dict(regulator='reg1', step=2))])
+    diff = _Diff()
+    magnitude = np.full(3, 0.9 * BASE)
+    assert engine.evaluate(0, magnitude, _pos(reg1_pos=15), diff) == ['rule 0']
+    assert diff.differences == [('reg1-mrid', 'TapChanger.step', 16, 15)]
+
+
+def test_switch_command_skipped_when_already_in_target_state():
+    engine = _engine([dict(name='open', when=dict(op='<', value=0.95), then=dict(switch='sw1', open=True))])
+    magnitude = np.full(3, 0.9 * BASE)
+    diff = _Diff()
+    assert engine.evaluate(0, magnitude, _pos(sw1_pos_a=1, sw1_pos_b=1), diff) == ['open']
+    assert diff.differences == [('sw1-mrid', 'Switch.open', 1, 0)]
+
+    # the switch reports open on every phase, nothing is sent again
+    diff = _Diff()
+    assert engine.evaluate(3, magnitude, _pos(sw1_pos_a=0, sw1_pos_b=0), diff) == []
+    assert diff.differences == []
+
+    # one phase still closed
+    assert engine.evaluate(6, magnitude, _pos(sw1_pos_a=0, sw1_pos_b=1), diff) == ['open']
+
+
+def test_cooldown():
+    engine = _engine([dict(when=dict(op='<', value=0.95), then=dict(object='x', attribute='a', value=1),
+                           cooldown=10)])
+    magnitude = np.full(3, 0.9 * BASE)
+    assert engine.evaluate(0, magnitude, {}, _Diff())
+    assert not engine.evaluate(5, magnitude, {}, _Diff())
+    assert engine.evaluate(10, magnitude, {}, _Diff())
+
+
+def test_unknown_devices_are_rejected():
+    with pytest.raises(RuleError):
+        _engine([dict(when=dict(value=1), then=dict(switch='nope'))])
+    with pytest.raises(RuleError):
+        _engine([dict(when=dict(value=1, reduce='median'), then=dict(switch='sw1'))])
+
+
+def test_buses_selected_by_device():
+    from topology import TopologyIndex
+
+    topology = TopologyIndex([('n1', 'n2'), ('n2', 'n3')], {'regulator:reg1': ['n2'], 'switch:sw1': ['n3']},
+                             sources=['n1'])
+    violations = VoltageViolationEngine(PNV, {'N1': 4160.0, 'N2': 4160.0})
+    rules = [dict(name='near', when=dict(near='sw1', hops=1, reduce='min', op='<', value=0.95),
+                  then=dict(switch='sw1')),
+             dict(name='feeds', when=dict(downstream='reg1', reduce='max', op='>', value=1.05),
+                  then=dict(switch='sw1')),
+             dict(name='far', when=dict(near='reg1', hops=0, phases=['B'], op='<', value=0.95),
+                  then=dict(switch='sw1'))]
+    engine = RuleEngine(rules, violations, SWITCHES, REGULATORS, topology=topology)
+    # n1 is upstream of the regulator and two hops from the switch
+    magnitude = np.array([0.9, 1.0, 1.1]) * BASE
+    assert np.allclose(engine.reduce(magnitude), [1.0, 1.1, 1.1])
+    assert engine.fired(0, magnitude).tolist() == [1]
+    with pytest.raises(RuleError):
+        RuleEngine([dict(when=dict(near='sw9'), then=dict(switch='sw1'))], violations, SWITCHES, topology=topology)
+    with pytest.raises(RuleError):
+        RuleEngine(rules[:1], violations, SWITCHES)
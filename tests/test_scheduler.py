@@ -0,0 +1,86 @@
+import json
+
+import pytest
+
+from scheduler import Scheduler, load_schedule
+
+
+def _names(fired):
+    return [scheduled.name for scheduled, _ in fired]
+
+
+def test_actions_due_before_the_first_timestep_fire_with_it():
+    scheduler = Scheduler()
+    scheduler.at(105, lambda t: t, name='later')
+    scheduler.at(50, lambda t: t, name='past')
+    assert _names(scheduler.advance(100)) == ['past']
+
+
+def test_at_fires_on_timestamps_not_messages():
+    scheduler = Scheduler()
+    handle = scheduler.at(105, lambda t: t, name='a')
+    scheduler.advance(100)
+    assert scheduler.advance(103) == []
+    assert scheduler.advance(109) == [(handle, 109)]
+    assert scheduler.advance(120) == []
+    assert len(scheduler) == 0 and handle.fired == 1
+
+
+def test_after_and_every_before_the_first_timestep_count_from_it():
+    scheduler = Scheduler()
+    scheduler.after(5, lambda t: t, name='after')
+    periodic = scheduler.every(10, lambda t: t, name='every')
+    assert len(scheduler) == 2
+    assert scheduler.advance(1000) == []
+    assert _names(scheduler.advance(1005)) == ['after']
+    assert _names(scheduler.advance(1010)) == ['every']
+    assert periodic.due == 1020
+    assert scheduler.after(3, lambda t: t).due == 1013
+
+
+def test_missed_periods_collapse_into_one_call():
+    scheduler = Scheduler()
+    calls = []
+    periodic = scheduler.every(10, calls.append, start=0)
+    scheduler.advance(0)
+    scheduler.advance(45)
+    assert calls == [0, 45]
+    assert periodic.due == 50
+    scheduler.advance(50)
+    assert calls == [0, 45, 50]
+
+
+def test_fractional_period_fires_once_per_period():
+    scheduler = Scheduler()
+    calls = []
+    periodic = scheduler.every(1.5, calls.append, start=1.5)
+    for timestamp in range(10):
+        scheduler.advance(timestamp)
+    assert calls == [2, 3, 5, 6, 8, 9]
+    assert periodic.fired == 6 and periodic.due == 10.5
+    assert _names(scheduler.advance(11)) == [None]
+
+
+def test_cancel_and_failing_actions():
+    scheduler = Scheduler(resolution=5)
+    cancelled = scheduler.at(10, lambda t: 'never')
+    failing = scheduler.every(5, lambda t: 1 / 0, start=10)
+    scheduler.cancel(cancelled)
+    scheduler.cancel(cancelled)
+    assert len(scheduler) == 1
+    assert scheduler.advance(12) == [(failing, None)]
+    scheduler.cancel(failing)
+    assert scheduler.advance(100) == []
+    with pytest.raises(ValueError):
+        scheduler.every(0, print)
+
+
+def test_schedule_commands(tmp_path):
+    path = tmp_path / 'schedule.json'
+    path.write_text(json.dumps({'schedule': [
+        dict(name='sw1', attribute='Switch.open', forward=1, reverse=0, at=100),
+        dict(mrid='_reg1', attribute='TapChanger.step', forward=2, reverse=1, every=60, start=120)]}))
+    scheduler = Scheduler()
+    scheduler.schedule_commands(load_schedule(str(path)), {'sw1': '_sw1'})
+    assert [result for _, result in scheduler.advance(100)] == [[('_sw1', 'Switch.open', 1, 0)]]
+    assert [result for _, result in scheduler.advance(180)] == [[('_reg1', 'TapChanger.step', 2, 1)]]
@@ -0,0 +1,45 @@
+import numpy as np
+import pytest
+
+from snapshot import Snapshot, SnapshotStore, freeze
+
+
+def test_freeze_shares_data_read_only():
+    array = np.arange(3.0)
+    frozen = freeze({'a': array, 'b': [1, {'c': 2}], 'd': {3}})
+    assert np.shares_memory(frozen['a'], array)
+    with pytest.raises(ValueError):
+        frozen['a'][0] = 1.0
+    with pytest.raises(TypeError):
+        frozen['b'][1]['c'] = 3
+    assert frozen['b'] == (1, {'c': 2})
+    assert frozen['d'] == frozenset({3})
+    array[0] = 5.0
+    assert frozen['a'][0] == 5.0
+
+
+def test_snapshot_is_immutable():
+    snapshot = Snapshot(1, 10, {'violations': {'A': 1}})
+    assert snapshot['violations']['A'] == 1
+    assert 'violations' in snapshot and snapshot.get('missing') is None
+    with pytest.raises(AttributeError):
+        snapshot.timestamp = 11
+
+
+def test_store_keeps_a_bounded_history():
+    store = SnapshotStore(history=3)
+    assert store.latest is None
+    for t in range(5):
+        store.publish(t, {'t': t})
+    assert store.version == 5
+    assert store.latest.timestamp == 4
+    assert [s.timestamp for s in store.history()] == [2, 3, 4]
+    assert [s.version for s in store.history(3)] == [4, 5]
+    assert [s.timestamp for s in store.history(end=2)] == [2]
+
+
+def test_single_snapshot_history():
+    store = SnapshotStore(history=1)
+    store.publish(0, {})
+    store.publish(1, {})
+    assert [s.timestamp for s in store.history()] == [1]
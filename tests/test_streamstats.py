@@ -0,0 +1,48 @@
+import numpy as np
+
+from streamstats import StreamingStatistics
+
+
+def feed(stats, rows):
+    flags = None
+    for t, row in enumerate(rows):
+        flags = stats.update(float(t), np.array(row, dtype=float))
+    return flags
+
+
+def test_running_statistics_match_numpy():
+    rng = np.random.default_rng(0)
+    rows = rng.normal(120.0, 2.0, size=(50, 3))
+    stats = StreamingStatistics(3)
+    feed(stats, rows)
+    np.testing.assert_allclose(stats.mean, rows.mean(axis=0))
+    np.testing.assert_allclose(stats.variance, rows.var(axis=0, ddof=1))
+    assert np.array_equal(stats.last, rows[-1])
+
+
+def test_missing_values_keep_the_state():
+    stats = StreamingStatistics(2)
+    feed(stats, [[1.0, 2.0], [np.nan, 4.0]])
+    assert stats.count.tolist() == [1, 2]
+    assert stats.mean.tolist() == [1.0, 3.0]
+
+
+def test_constant_slot_does_not_flag_rounding_noise():
+    stats = StreamingStatistics(2, warmup=5)
+    flags = feed(stats, [[7200.0, 0.0]] * 10 + [[7200.0 + 1e-9, 0.0]])
+    assert abs(flags.zscore[0]) < 1e-6 and flags.zscore[1] == 0.0
+    assert not flags.outlier.any()
+
+
+def test_constant_slot_flags_a_real_change():
+    stats = StreamingStatistics(1, warmup=5)
+    flags = feed(stats, [[7200.0]] * 10 + [[6800.0]])
+    assert flags.outlier.tolist() == [True]
+
+
+def test_no_zscore_during_warmup_and_steps():
+    stats = StreamingStatistics(1, warmup=5, step_threshold=10.0)
+    flags = feed(stats, [[100.0], [120.0]])
+    assert np.isnan(flags.zscore[0])
+    assert flags.step.tolist() == [True]
+    assert len(flags) == 1
@@ -0,0 +1,41 @@
+import json
+
+from synthetic import SyntheticFeeder
+
+
+def test_same_seed_gives_the_same_stream():
+    first = [m['message']['measurements'] for m in SyntheticFeeder(buses=20).messages(3, start=0)]
+    second = [m['message']['measurements'] for m in SyntheticFeeder(buses=20).messages(3, start=0)]
+    assert first == second
+
+
+def test_size_and_timestamps():
+    feeder = SyntheticFeeder.for_measurements(1000)
+    assert 800 < len(feeder) < 1200
+    messages = list(feeder.messages(3, start=100, time_step=3))
+    assert [m['message']['timestamp'] for m in messages] == [100, 103, 106]
+    assert len(messages[0]['message']['measurements']) == len(feeder)
+
+
+def test_change_rate():
+    feeder = SyntheticFeeder(buses=500, change_rate=0.1)
+    changed = feeder.step()
+    assert 0.05 * len(feeder) < len(changed) < 0.15 * len(feeder)
+
+
+def test_model_queries():
+    feeder = SyntheticFeeder(buses=20, switches=2, regulators=1)
+    switches = feeder.query_data("SELECT ... LoadBreakSwitch")['data']['results']['bindings']
+    assert [b['name']['value'] for b in switches] == ['sw0', 'sw1']
+    lines = feeder.get_response('topic', dict(objectType='ACLineSegment'))['data']
+    assert {d['type'] for d in lines} == {'PNV', 'VA', 'A'}
+
+
+def test_switch_commands_show_in_the_positions():
+    feeder = SyntheticFeeder(buses=20, switches=1)
+    measid = next(d['measid'] for d in feeder.switch_measurements if d['type'] == 'Pos')
+    message = dict(input=dict(message=dict(forward_differences=[
+        dict(object='_SW_0', attribute='Switch.open', value=1)])))
+    feeder.send('topic', json.dumps(message))
+    state = next(feeder.messages(1))['message']['measurements']
+    assert state[measid]['value'] == 0
@@ -0,0 +1,86 @@
+import numpy as np
+import pytest
+
+from topology import TopologyIndex
+
+# a - b - c - d - e, with a branch c - f and a parallel line b - c
+EDGES = [('a', 'b'), ('b', 'c'), ('B', 'C'), ('c', 'd'), ('d', 'e'), ('c', 'f'), ('e', 'e')]
+DEVICES = {'sw1': ['a', 'b'], 'reg1': ['e']}
+
+
+def test_csr_has_one_edge_per_pair_of_buses():
+    topology = TopologyIndex(EDGES)
+    assert len(topology) == 6
+    assert topology.indptr[-1] == 2 * 5
+    c = topology.index['C']
+    assert sorted(topology.buses[topology.neighbours(np.array([c]))]) == ['B', 'D', 'F']
+
+
+def test_distances():
+    topology = TopologyIndex(EDGES)
+    distance = topology.distances([topology.index['A']])
+    assert dict(zip(topology.buses, distance.tolist())) == dict(A=0, B=1, C=2, D=3, F=3, E=4)
+    assert topology.distances([topology.index['A']], max_hops=1).tolist().count(-1) == 4
+
+
+def test_layers_match_distances_and_leave_no_state():
+    topology = TopologyIndex(EDGES)
+    sources = [topology.index['A'], topology.index['E']]
+    reached, distance = topology.layers(sources, 2)
+    full = topology.distances(sources)
+    assert sorted(reached.tolist()) == sorted(np.flatnonzero((full >= 0) & (full <= 2)).tolist())
+    assert distance.tolist() == full[reached].tolist()
+    assert (topology._scratch == -1).all()
+
+
+def test_within_and_near():
+    topology = TopologyIndex(EDGES, DEVICES, max_hops=2)
+    assert sorted(topology.within('sw1', 1)) == ['A', 'B', 'C']
+    assert sorted(topology.within('reg1', 3)) == ['B', 'C', 'D', 'E', 'F']
+    assert topology.near(['f', 'unknown'], 2) == {'sw1': ['F']}
+    assert topology.near(['d', 'a'], 1) == {'sw1': ['A'], 'reg1': ['D']}
+    assert topology.near(['unknown'], 1) == {}
+
+
+def test_device_masks_over_a_measurement_order():
+    topology = TopologyIndex(EDGES, DEVICES, max_hops=2)
+    devices, masks = topology.device_masks(['a', 'c', 'c', 'x', 'e'], 1)
+    assert devices == ['sw1', 'reg1']
+    assert masks.tolist() == [[True, True, True, False, False], [False, False, False, False, True]]
+
+
+def test_around_and_device_names():
+    topology = TopologyIndex(EDGES, {'switch:s1': ['a', 'b'], 'regulator:r1': ['e']})
+    buses, distance = topology.around('c', 1)
+    assert dict(zip(buses.tolist(), distance.tolist())) == dict(C=0, B=1, D=1, F=1)
+    assert topology.device('r1') == 'regulator:r1'
+    assert topology.device('switch:s1') == 'switch:s1'
+    with pytest.raises(KeyError):
+        topology.device('missing')
+
+
+def test_downstream_follows_the_sources():
+    # a is the feeder head, the switch between c and d feeds d and e
+    topology = TopologyIndex(EDGES, {'sw': ['c', 'd'], 'reg1': ['e']}, sources=['a'])
+    assert sorted(topology.downstream('sw')) == ['D', 'E']
+    assert sorted(topology.downstream('sw', hops=0)) == ['D']
+    # without sources a device feeds everything it reaches
+    undirected = TopologyIndex([('x', 'y'), ('y', 'z')], {'reg': ['y']})
+    assert sorted(undirected.downstream('reg', hops=1)) == ['X', 'Y', 'Z']
+
+
+def test_neighbourhood_stage_masks_the_out_of_band_measurements():
+    from pipeline import Pipeline
+    from stages import PNV, NeighbourhoodStage
+    from violations import VoltageViolationEngine
+
+    pnv = [dict(measid='m' + bus, bus=bus, phases='A') for bus in 'abcdef']
+    engine = VoltageViolationEngine(pnv, {bus: 4160.0 for bus in 'ABCDEF'})
+    pipeline = Pipeline({PNV: [d['measid'] for d in pnv]},
+                        [NeighbourhoodStage(TopologyIndex(EDGES, DEVICES), engine, 1)])
+    nominal = 4160.0 / np.sqrt(3)
+    low = {'ma': 0.9, 'md': 0.9}
+    measurements = {d['measid']: dict(measurement_mrid=d['measid'], magnitude=nominal * low.get(d['measid'], 1.0))
+                    for d in pnv}
+    context = pipeline.run(0, measurements)
+    assert context.results['devices_near_violations'] == {'sw1': ['A'], 'reg1': ['D']}
@@ -0,0 +1,44 @@
+import math
+
+import numpy as np
+
+from violations import VoltageViolationEngine, NORMAL, LOW_A, BELOW_B, HIGH_A, ABOVE_B
+
+
+def _engine():
+    measurements = [dict(measid='a', bus='n1', phases='A'),
+                    dict(measid='b', bus='n1', phases='B'),
+                    dict(measid='s1', bus='tx1', phases='s1'),
+                    dict(measid='s2', bus='tx1', phases='s2')]
+    return VoltageViolationEngine(measurements, {'N1': 4160.0, 'TX1': 240.0})
+
+
+def test_three_phase_base_is_line_to_neutral():
+    engine = _engine()
+    assert np.isclose(engine.base_ln[0], 4160.0 / math.sqrt(3))
+
+
+def test_split_phase_base_is_half_of_nominal():
+    engine = _engine()
+    assert engine.base_ln[2:].tolist() == [120.0, 120.0]
+
+
+def test_healthy_feeder_has_no_violations():
+    engine = _engine()
+    magnitude = np.array([4160.0 / math.sqrt(3), 2400.0, 120.0, 121.0])
+    report = engine.evaluate(0, magnitude)
+    assert report.violations() == 0
+    assert report.counts['s1']['normal'] == 1
+
+
+def test_classes():
+    engine = _engine()
+    codes = engine.classify(np.array([0.9, 0.93, 1.0, 1.055, 1.1, np.nan]))
+    assert codes.tolist() == [BELOW_B, LOW_A, NORMAL, HIGH_A, ABOVE_B, NORMAL]
+
+
+def test_violating_buses_are_reported_by_phase():
+    engine = _engine()
+    report = engine.evaluate(0, np.array([2400.0, 2400.0, 105.0, 120.0]))
+    assert report.buses['s1']['below_b'] == ['TX1']
+    assert report.violations('s2') == 0